@@ -3,11 +3,12 @@ from skbio import TreeNode
 
 import t2t.nlevel as nl
 import t2t.validate as val
+import t2t.util as ut
 import bp
 
 
 def fetch(tree, as_tree=False):
-    t = bp.to_skbio_treenode(bp.parse_newick(tree.read()))
+    t = bp.to_skbio_treenode(ut.read_tree(tree))
     ranks = set(nl.RANK_ORDER)
     res = []
     error = True
@@ -26,14 +27,21 @@ def fetch(tree, as_tree=False):
             res.append("\tA tip ID from the clade: %s" % tip_id)
             res.append("\tCurrent lineage in tree: %s" % '; '.join(path[::-1]))
 
+    elif as_tree:
+        res = nl.pull_consensus_strings(t, as_tree=True)
+        error = False
     else:
-        res = nl.pull_consensus_strings(t, as_tree=as_tree)
+        res = nl.iter_consensus_strings(t)
         error = False
 
     return res, error
 
 
 def validate(lines, limit, flat_errors, hierarchy_errors):
+    # both checks read the lines, otherwise they are streamed once
+    if flat_errors and hierarchy_errors:
+        lines = list(lines)
+
     res = []
     if flat_errors:
         flat = val.flat_errors(lines)
@@ -2,7 +2,7 @@
 
 from collections import defaultdict
 
-from numpy import mean
+from numpy import array, full, maximum, mean, zeros
 
 __author__ = "Donovan Park"
 __copyright__ = "Copyright 2014, The tax2tree project"
@@ -34,7 +34,7 @@ class Consistency(object):
         self.taxa_counts = taxa_counts
         self.n_ranks = n_ranks
 
-    def calculate(self, tree, rooted):
+    def calculate(self, tree, rooted, index=None):
         """Return taxonomic consistency of each taxa in tree.
 
         Consistency is at every node and the highest consistency
@@ -45,7 +45,14 @@ class Consistency(object):
         tree : TreeNode
         rooted : Boolean
             Indicates if tree should be treated as rooted
+        index : TaxonRangeIndex, optional
+            If provided, the taxa counts of each node are obtained from the
+            index rather than from the TaxaCount attribute set by
+            decorate_name_counts, and the consistency of all taxa at a rank
+            is computed at once
         """
+        if index is not None:
+            return self._calculate_indexed(tree, rooted, index)
 
         # determine total number of informative tips in tree for each rank
         total_informative_tips = defaultdict(int)
@@ -80,6 +87,105 @@ class Consistency(object):
 
         return consistency_index
 
+    def _calculate_indexed(self, tree, rooted, index):
+        """Return taxonomic consistency of each taxa using a TaxonRangeIndex
+
+        Only the taxa present within each clade are scored at the node. The
+        consistency of a taxon over the other subtree of a clade it is
+        absent from only grows with the size of the clade, so for unrooted
+        trees it is scored once per taxon, from the largest clade the
+        taxon is absent from. Those clades are children of clades the
+        taxon is present in.
+        """
+        total_informative_tips = defaultdict(int)
+        for n in tree.tips():
+            for rank in range(self.n_ranks):
+                total_informative_tips[rank] += n.NumTipsRank[rank]
+
+        # align the names of the index with the totals
+        positions = []
+        totals = []
+        best = []
+        largest_absent = []
+        in_child = []
+        for rank in range(self.n_ranks):
+            lookup = {name: i for i, name in enumerate(index.names[rank])}
+            names = list(self.taxa_counts[rank])
+            position = full(len(index.names[rank]), -1, dtype=int)
+            absent = full(len(names), -1, dtype=int)
+            for i, name in enumerate(names):
+                name_id = lookup.get(name)
+                if name_id is None:
+                    # absent from every clade, the whole tree included
+                    absent[i] = total_informative_tips[rank]
+                else:
+                    position[name_id] = i
+            positions.append(position)
+            totals.append(array([self.taxa_counts[rank][name]
+                                 for name in names], dtype=int))
+            best.append(zeros(len(names)))
+            largest_absent.append(absent)
+            in_child.append(zeros(len(names), dtype=bool))
+
+        # the taxa present within each clade whose parent is yet to be
+        # visited, by rank, if unrooted
+        pending = {}
+        for n in tree.postorder(include_self=True):
+            present = []
+            for rank in range(self.n_ranks):
+                name_ids, node_taxa_count = index.present(n, rank)
+                keep = positions[rank][name_ids]
+                node_taxa_count = node_taxa_count[keep >= 0]
+                keep = keep[keep >= 0]
+                present.append(keep)
+                if not len(keep):
+                    continue
+
+                total_taxa_cnt = totals[rank][keep]
+                incongruent_taxa = n.NumTipsRank[rank] - node_taxa_count
+                c = node_taxa_count / (total_taxa_cnt + incongruent_taxa)
+                best[rank][keep] = maximum(best[rank][keep], c)
+
+                if not rooted:
+                    # consider consistency of taxa in other subtree since
+                    # the tree is unrooted
+                    node_taxa_count = total_taxa_cnt - node_taxa_count
+                    incongruent_taxa = total_informative_tips[rank] - \
+                        n.NumTipsRank[rank] - \
+                        node_taxa_count
+                    c = node_taxa_count / (total_taxa_cnt + incongruent_taxa)
+                    best[rank][keep] = maximum(best[rank][keep], c)
+
+            if rooted:
+                continue
+            for child in n.children:
+                child_present = pending.pop(id(child))
+                for rank in range(self.n_ranks):
+                    marked = in_child[rank]
+                    marked[child_present[rank]] = True
+                    absent = present[rank][~marked[present[rank]]]
+                    marked[child_present[rank]] = False
+                    largest_absent[rank][absent] = maximum(
+                        largest_absent[rank][absent], child.NumTipsRank[rank])
+            pending[id(n)] = present
+
+        consistency_index = {i: defaultdict(int) for i in range(self.n_ranks)}
+        for rank in range(self.n_ranks):
+            if not rooted:
+                # the taxa absent from a clade are all in its other subtree
+                absent = largest_absent[rank] >= 0
+                total_taxa_cnt = totals[rank][absent]
+                node_taxa_count = total_taxa_cnt
+                incongruent_taxa = total_informative_tips[rank] - \
+                    largest_absent[rank][absent] - node_taxa_count
+                c = node_taxa_count / (total_taxa_cnt + incongruent_taxa)
+                best[rank][absent] = maximum(best[rank][absent], c)
+
+            names = self.taxa_counts[rank]
+            consistency_index[rank].update(zip(names, best[rank].tolist()))
+
+        return consistency_index
+
     def write_taxon_consistency(self, output_file, consistency_index):
         """Write consistency of each taxon to file.
 
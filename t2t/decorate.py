@@ -0,0 +1,1285 @@
+#!/usr/bin/env python
+
+"""Array-backed decoration of balanced parentheses trees
+
+The methods in t2t.nlevel operate on skbio.TreeNode objects and store their
+intermediate state as attributes of each node. The methods here perform the
+core of the decoration (the equivalent of load_tree through
+set_preliminary_name_and_rank) directly on a bp.BP tree, keeping per node
+state in arrays indexed by the preorder position of the node.
+"""
+
+from multiprocessing import Pool
+
+import numpy as np
+import bp
+
+import t2t.nlevel as nl
+
+__author__ = "Daniel McDonald"
+__copyright__ = "Copyright 2011, The tax2tree project"
+__credits__ = ["Daniel McDonald"]
+__license__ = "BSD"
+__version__ = "1.0"
+__maintainer__ = "Daniel McDonald"
+__email__ = "mcdonadt@colorado.edu"
+__status__ = "Development"
+
+# the minimum number of tips of the clades aggregated in parallel by default
+CLADE_TIPS = 10000
+
+
+def add_nameholders(tree):
+    """Add single descendent nodes without length to hold names
+
+    Backbone trees may not have nodes allocated for representing lineage
+    names, particularly if the tree is constructed with single members
+    per lineage.
+
+    Tax2tree does not place lineage information on tips. As such, we miss out
+    on lineage data if there is a conflict in the parent of a tip as would
+    occur with "(flexneri, coli)escherichia;". In this case, the tips
+    "flexneri" and "coli" are where labels should go, but tax2tree needs
+    the labels to the the actual identifiers.
+
+    So, instead, we add a node inbetween the tip and parent, which can hold
+    tax information. Rather, we do "((X)flexneri, (Y)coli)escherichia);"
+
+    The name holders are placed after the internal children of a node,
+    preserving the child order of the original TreeNode implementation.
+
+    Parameters
+    ----------
+    tree : bp.BP
+        The tree to operate on
+
+    Returns
+    -------
+    bp.BP
+        A new tree with name holder nodes. The name holders are given new
+        edge numbers, in preorder, following the largest existing edge
+        number as t2t.util._edge_label would.
+    """
+    B = []
+    names = []
+    lengths = []
+    edges = []
+    next_edge = [max(tree.edge(i) for i in np.flatnonzero(tree.B)) + 1]
+
+    def open_node(idx):
+        B.append(1)
+        names.append(tree.name(idx))
+        lengths.append(tree.length(idx))
+        edges.append(tree.edge(idx))
+
+    def open_holder():
+        B.append(1)
+        names.append(None)
+        lengths.append(0.0)
+        edges.append(next_edge[0])
+        next_edge[0] += 1
+
+    def close():
+        B.append(0)
+        names.append(None)
+        lengths.append(0.0)
+        edges.append(0)
+
+    tasks = [('node', tree.root())]
+    while tasks:
+        kind, idx = tasks.pop()
+        if kind == 'close':
+            close()
+        elif kind == 'tip':
+            open_holder()
+            open_node(idx)
+            close()
+            close()
+        else:
+            open_node(idx)
+            tasks.append(('close', None))
+
+            internal = []
+            tips = []
+            child = tree.fchild(idx)
+            while child != 0:
+                if tree.isleaf(child):
+                    tips.append(('tip', child))
+                else:
+                    internal.append(('node', child))
+                child = tree.nsibling(child)
+
+            tasks.extend((internal + tips)[::-1])
+
+    return bp.BP(np.array(B, dtype=np.uint8),
+                 names=np.array(names, dtype=object),
+                 lengths=np.array(lengths, dtype=np.double),
+                 edges=np.array(edges, dtype=np.int32))
+
+
+def _merge(acc, other, totals, min_count):
+    """Merge the smaller of two [counts, heavy, heavy_sum] into the larger
+
+    counts is a {name id: count} dict and heavy the set of name ids in counts
+    which are retained (count >= min_count) and have a relative frequency of
+    at least 0.5, and heavy_sum the sum of the ids in heavy. Counts only
+    increase when merging so a heavy name remains heavy, and only the names
+    of the smaller dict need to be examined.
+    """
+    if len(acc[0]) < len(other[0]):
+        acc, other = other, acc
+
+    counts, heavy = acc[0], acc[1]
+    added = 0
+    for name_id, count in other[0].items():
+        total = counts.get(name_id, 0) + count
+        counts[name_id] = total
+        if total >= min_count and 2 * total >= totals[name_id] and \
+                name_id not in heavy:
+            heavy.add(name_id)
+            added += name_id
+    acc[2] += added
+
+    return acc
+
+
+def _rank_candidates(args):
+    """Find the name which could be picked at each node for a single rank
+
+    Parameters
+    ----------
+    args : tuple
+        (postorder, parents, column, totals, min_count, seeds), the preorder
+        index of each node to visit in postorder, the preorder index of the
+        parent of each node (-1 for the root), the name id at the rank of
+        each tip visited (-1 if not set), the number of tips of each name id,
+        the minimum count for a name to be retained, and optionally a dict
+        of {node: [counts, heavy, heavy_sum]} for nodes whose subtrees have
+        already been aggregated. A tuple so this can be mapped over a process
+        pool
+
+    Returns
+    -------
+    np.ndarray of int32
+        For each node in preorder, the id of the single name with a relative
+        frequency >= 0.5, or -1 if there is no such name or several. Always
+        -1 for tips and seeded nodes
+    np.ndarray of int64
+        The number of tips of that name which descend
+    np.ndarray of int32
+        The number of names with a relative frequency >= 0.5 at each node,
+        0 for tips and seeded nodes
+    np.ndarray of int64
+        The sum of the ids of those names
+    list
+        The [counts, heavy, heavy_sum] of the root
+    """
+    postorder, parents, column, totals, min_count, seeds = args
+    n_nodes = len(parents)
+    parents = parents.tolist()
+    tip_ids = iter(column.tolist())
+    heavy_ids = np.full(n_nodes, -1, dtype=np.int32)
+    heavy_counts = np.zeros(n_nodes, dtype=np.int64)
+    n_heavy = np.zeros(n_nodes, dtype=np.int32)
+    heavy_sums = np.zeros(n_nodes, dtype=np.int64)
+    root_acc = None
+
+    # the [counts, heavy, heavy_sum] of each node, held until merged into the parent
+    accs = [None] * n_nodes
+    for v in postorder.tolist():
+        acc = accs[v]
+        if seeds and v in seeds:
+            acc = seeds[v]
+        elif acc is None:
+            # a tip, these are visited in the same order as in preorder
+            acc = [{}, set(), 0]
+            name_id = next(tip_ids)
+            if name_id >= 0:
+                acc[0][name_id] = 1
+                if 1 >= min_count and 2 >= totals[name_id]:
+                    acc[1].add(name_id)
+                    acc[2] = name_id
+        else:
+            accs[v] = None
+            n_heavy[v] = len(acc[1])
+            heavy_sums[v] = acc[2]
+            if len(acc[1]) == 1:
+                name_id = next(iter(acc[1]))
+                heavy_ids[v] = name_id
+                heavy_counts[v] = acc[0][name_id]
+
+        parent = parents[v]
+        if parent >= 0:
+            parent_acc = accs[parent]
+            if parent_acc is None:
+                accs[parent] = acc
+            else:
+                accs[parent] = _merge(parent_acc, acc, totals, min_count)
+        else:
+            root_acc = acc
+
+    return heavy_ids, heavy_counts, n_heavy, heavy_sums, root_acc
+
+
+def _partition(all_tips, parents, is_tip, clade_tips):
+    """Select large disjoint clades of the tree
+
+    Parameters
+    ----------
+    all_tips : np.ndarray of int
+        The number of tips that descend from each node, in preorder
+    parents : np.ndarray of int
+        The parent of each node, -1 for the root
+    is_tip : np.ndarray of bool
+        Whether each node is a tip
+    clade_tips : int
+        The maximum number of tips of a clade
+
+    Returns
+    -------
+    np.ndarray of int
+        The preorder index of the root of each clade. These are the largest
+        clades with at most clade_tips tips, excluding clades with fewer than
+        half that number which are left with the backbone of the tree
+    """
+    parent_tips = np.where(parents >= 0, all_tips[np.maximum(parents, 0)],
+                           np.iinfo(np.int64).max)
+    return np.flatnonzero((all_tips <= clade_tips) &
+                          (parent_tips > clade_tips) &
+                          (2 * all_tips >= clade_tips) & ~is_tip)
+
+
+def _aggregate(pool, postorder, parents, ids, totals, min_count, clades,
+               first_tips, sizes, all_tips):
+    """Find the name which could be picked at each node and rank
+
+    The clades are aggregated first, each rank of each clade as a separate
+    task. The backbone of the tree, the nodes outside of the clades, is then
+    aggregated per rank, seeded with the summaries of the clades.
+
+    Returns
+    -------
+    np.ndarray of int32
+        The heavy name id of each node (rows, in preorder) and rank (columns)
+    np.ndarray of int64
+        The corresponding counts
+    np.ndarray of int32
+        The number of names with a relative frequency >= 0.5 of each node
+        and rank
+    np.ndarray of int64
+        The sum of the ids of those names
+    """
+    n_nodes, n_ranks = len(parents), ids.shape[1]
+    map_f = map if pool is None else \
+        (lambda f, tasks: pool.map(f, tasks, chunksize=1))
+
+    position = np.empty(n_nodes, dtype=np.int64)
+    position[postorder] = np.arange(n_nodes)
+
+    interior = np.zeros(n_nodes + 1, dtype=np.int64)
+    clade_tip = np.zeros(ids.shape[0] + 1, dtype=np.int64)
+    tasks = []
+    for root in clades:
+        size = sizes[root]
+        pos = position[root]
+        first = first_tips[root]
+        n_tips = all_tips[root]
+
+        local_postorder = postorder[pos - size + 1:pos + 1] - root
+        local_parents = parents[root:root + size] - root
+        local_parents[0] = -1
+        for rank in range(n_ranks):
+            tasks.append((local_postorder, local_parents,
+                          ids[first:first + n_tips, rank], totals[rank],
+                          min_count, None))
+
+        interior[root + 1] += 1
+        interior[root + size] -= 1
+        clade_tip[first] += 1
+        clade_tip[first + n_tips] -= 1
+
+    results = iter(list(map_f(_rank_candidates, tasks)))
+    seeds = [{} for _ in range(n_ranks)]
+    clade_results = []
+    for root in clades:
+        for rank in range(n_ranks):
+            clade_result = next(results)
+            seeds[rank][root] = clade_result[-1]
+            clade_results.append((root, rank, clade_result[:-1]))
+
+    # the backbone, with the clade roots standing in for their clades
+    backbone = postorder[np.cumsum(interior[:-1])[postorder] == 0]
+    backbone_tips = np.cumsum(clade_tip[:-1]) == 0
+    tasks = [(backbone, parents, ids[backbone_tips, rank], totals[rank],
+              min_count, seeds[rank]) for rank in range(n_ranks)]
+    backbone_results = list(map_f(_rank_candidates, tasks))
+
+    columns = [np.vstack([r[i] for r in backbone_results]).T
+               for i in range(4)]
+    for root, rank, clade_columns in clade_results:
+        size = len(clade_columns[0])
+        for column, clade_column in zip(columns, clade_columns):
+            column[root:root + size, rank] = clade_column
+
+    return tuple(columns)
+
+
+def _picked(heavy_ids):
+    """Whether the heavy name of each node and rank is picked
+
+    A rank is safe if a single name has >= 50% relative frequency. Names are
+    set at safe ranks until the first unsafe rank following a safe rank.
+    """
+    safe = heavy_ids >= 0
+    started = np.logical_or.accumulate(safe, axis=1)
+    stopped = np.logical_or.accumulate(started & ~safe, axis=1)
+    return safe & ~stopped
+
+
+class Topology(object):
+    """The taxonomy independent structure of a tree, as used by decorate
+
+    Parameters
+    ----------
+    tree : bp.BP
+        The tree
+
+    Attributes
+    ----------
+    tree : bp.BP
+        The tree
+    names : list
+        The name of each node in preorder, with quotes removed from tip
+        names
+    tip_names : list
+        The names of the tips in preorder
+    bootstrap : np.ndarray of float
+        The bootstrap support of each node in preorder, nan if not set
+    is_tip : np.ndarray of bool
+        Whether each node is a tip
+    parents : np.ndarray of int64
+        The parent of each node, -1 for the root
+    first_tips : np.ndarray of int64
+        The index, in tip order, of the first tip of each node
+    all_tips : np.ndarray of int64
+        The number of tips that descend from each node
+    sizes : np.ndarray of int64
+        The number of nodes in the subtree of each node
+    postorder : np.ndarray of int64
+        The nodes in postorder
+    postorder_position : np.ndarray of int64
+        The position of each node in postorder
+    """
+
+    def __init__(self, tree):
+        B = tree.B
+        opens = np.flatnonzero(B)
+        (self.is_tip, self.parents, self.first_tips, self.all_tips,
+         self.postorder_position, close) = _structure(B)
+        self.sizes = (close - opens + 1) // 2
+        self.postorder = np.argsort(self.postorder_position)
+        self.tree = tree
+
+        names = [tree.name(i) for i in opens.tolist()]
+        bootstrap = np.full(len(opens), np.nan)
+        tip_names = []
+        for idx, tip in enumerate(self.is_tip.tolist()):
+            name = names[idx]
+            if tip:
+                if name:
+                    name = name.replace("'", "")
+                    names[idx] = name
+                tip_names.append(name)
+            elif name is not None:
+                try:
+                    bootstrap[idx] = float(name)
+                except ValueError:
+                    pass
+
+        self.names = names
+        self.tip_names = tip_names
+        self.bootstrap = bootstrap
+
+
+def decorate(tree, tipname_map, min_count, score_f=nl.fmeasure,
+             verbose=False, jobs=1, clade_tips=None, return_state=False,
+             topology=None):
+    """Perform the initial decoration of names on a tree
+
+    This is equivalent to running load_tree, collect_names_at_ranks_counts,
+    decorate_ntips, decorate_name_relative_freqs, set_ranksafe, pick_names,
+    name_node_score_fold (with the min_tips tiebreak) and
+    set_preliminary_name_and_rank, but operates on the balanced parentheses
+    structure. For each rank, subtree name counts are aggregated in a single
+    postorder pass, and for each node only the name which could be picked
+    (a single name with a relative frequency >= 0.5 at a rank) is retained.
+    The ranks, and disjoint clades, are independent until the names are
+    picked, so they can be processed in parallel.
+
+    WARNING: operates inplace
+
+    Parameters
+    ----------
+    tree : bp.BP
+        The tree to decorate
+    tipname_map : dict or t2t.nlevel.CompiledTaxonomy
+        {id_: [tax, string]}, as returned by load_consensus_map
+    min_count : int
+        The minimum number of tips that must represent a name for that name
+        to be considered
+    score_f : function, optional
+        The function to score a name at a node with, given the precision and
+        recall, see t2t.nlevel.score_pairs
+    verbose : bool, optional
+        Report progress
+    jobs : int, optional
+        The number of processes to use. Large clades of the tree are
+        aggregated independently, per rank, and the remaining backbone of the
+        tree is then aggregated per rank from the clade summaries
+    clade_tips : int, optional
+        The maximum number of tips in a clade aggregated independently when
+        jobs > 1. Defaults to a quarter of the tips per process, and at least
+        CLADE_TIPS
+    return_state : bool, optional
+        Also return the DecorationState, from which tips can later be added
+        without decorating the whole tree again
+    topology : Topology, optional
+        The Topology of tree, so that it is only computed once when a tree
+        is decorated with several consensus maps
+
+    Returns
+    -------
+    bp.BP
+        The tree with the names set. Tip names have quotes removed and
+        internal nodes hold the preliminary names
+    np.ndarray of int
+        The rank of the name set on each node in preorder, -1 if not named
+    np.ndarray of float
+        The bootstrap support of each node in preorder, nan if not set
+    dict
+        {rank: [(name, score)]}, the score of the node picked for each name
+    DecorationState
+        If return_state
+    """
+    if verbose:
+        print("Decorating names...")
+
+    if topology is None:
+        topology = Topology(tree)
+
+    n_ranks = len(nl.RANK_ORDER)
+    missing_tax = [None] * n_ranks
+
+    B = tree.B
+    opens = np.flatnonzero(B)
+    n_nodes = len(opens)
+    is_tip = topology.is_tip
+    names = topology.names[:]
+    bootstrap = topology.bootstrap.copy()
+    parents = topology.parents
+    first_tips = topology.first_tips
+    all_tips = topology.all_tips
+    postorder = topology.postorder
+
+    if isinstance(tipname_map, nl.CompiledTaxonomy):
+        rank_names = [[] for _ in range(n_ranks)]
+        ids = tipname_map.encode(topology.tip_names, rank_names)
+    else:
+        tip_consensus = [tipname_map.get(name, missing_tax)
+                         for name in topology.tip_names]
+        ids, rank_names = nl.encode_consensus(tip_consensus, n_ranks)
+    informative = (ids >= 0).any(axis=1)
+    totals = []
+    for rank in range(n_ranks):
+        column = ids[:, rank]
+        totals.append(np.bincount(column[column >= 0],
+                                  minlength=len(rank_names[rank])).tolist())
+
+    # the number of informative tips of each node
+    prefix = np.zeros(len(informative) + 1, dtype=np.int64)
+    prefix[1:] = np.cumsum(informative)
+    num_tips = prefix[first_tips + all_tips] - prefix[first_tips]
+
+    if jobs > 1:
+        if clade_tips is None:
+            clade_tips = max(len(informative) // (4 * jobs), CLADE_TIPS)
+        clades = _partition(all_tips, parents, is_tip, clade_tips).tolist()
+        pool = Pool(jobs)
+    else:
+        clades = []
+        pool = None
+
+    try:
+        heavy_ids, heavy_counts, n_heavy, heavy_sums = \
+            _aggregate(pool, postorder, parents, ids, totals, min_count,
+                       clades, first_tips, topology.sizes, all_tips.tolist())
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    picked = _picked(heavy_ids)
+    postorder_position = topology.postorder_position
+
+    rank_col = np.full(n_nodes, -1, dtype=int)
+    name_col = np.full(n_nodes, -1, dtype=np.int64)
+    best_nodes = np.zeros((n_nodes, n_ranks), dtype=bool)
+    best_scores = []
+    scores = {}
+    for rank in range(n_ranks):
+        nodes = np.flatnonzero(picked[:, rank])
+        name_ids = heavy_ids[nodes, rank]
+        counts = heavy_counts[nodes, rank].astype(float)
+        precision = counts / num_tips[nodes]
+        recall = counts / np.asarray(totals[rank], dtype=float)[name_ids]
+        rank_scores = nl.score_pairs(score_f, precision, recall)
+
+        # the best scoring node is kept, ties favor the node with the
+        # fewest tips and then the last node in postorder
+        order = np.lexsort((-postorder_position[nodes], all_tips[nodes],
+                            -rank_scores, name_ids))
+        sorted_ids = name_ids[order]
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = sorted_ids[1:] != sorted_ids[:-1]
+        best = order[first]
+
+        # internal nodes are named by the deepest name they were picked for
+        rank_col[nodes[best]] = rank
+        name_col[nodes[best]] = name_ids[best]
+        best_nodes[nodes[best], rank] = True
+        rank_best_scores = np.full(len(rank_names[rank]), np.nan)
+        rank_best_scores[name_ids[best]] = rank_scores[best]
+        best_scores.append(rank_best_scores)
+
+        scores[rank] = [(rank_names[rank][name_id], score) for name_id, score
+                        in zip(name_ids[best].tolist(),
+                               rank_scores[best].tolist())]
+
+    for idx, tip in enumerate(is_tip.tolist()):
+        if not tip:
+            rank = rank_col[idx]
+            names[idx] = None if rank < 0 else \
+                rank_names[rank][name_col[idx]]
+
+    all_names = np.full(B.size, None, dtype=object)
+    all_names[opens] = names
+    tree.set_names(all_names)
+
+    if not return_state:
+        return tree, rank_col, bootstrap, scores
+
+    state = DecorationState(B.copy(), topology.names[:],
+                            np.array([tree.length(i) for i in opens.tolist()],
+                                     dtype=np.double),
+                            np.array([tree.edge(i) for i in opens.tolist()],
+                                     dtype=np.int32),
+                            bootstrap.copy(), ids, rank_names, n_heavy,
+                            heavy_sums, best_nodes, best_scores, min_count)
+    return tree, rank_col, bootstrap, scores, state
+
+
+def _structure(B):
+    """The shape of a balanced parentheses tree as arrays, in preorder
+
+    Parameters
+    ----------
+    B : np.ndarray of uint8
+        The balanced parentheses
+
+    Returns
+    -------
+    np.ndarray of bool
+        Whether each node is a tip
+    np.ndarray of int64
+        The parent of each node, -1 for the root
+    np.ndarray of int64
+        The index, in tip order, of the first tip of each node
+    np.ndarray of int64
+        The number of tips that descend from each node
+    np.ndarray of int64
+        The position of each node in postorder
+    np.ndarray of int64
+        The position in B at which each node closes
+    """
+    B = np.asarray(B, dtype=np.int64)
+    positions = np.arange(B.size)
+    opens = np.flatnonzero(B)
+    n_nodes = len(opens)
+    excess = np.cumsum(2 * B - 1)
+
+    # the depth of the node opened or closed at each position. Within a
+    # depth, opens and closes alternate, so a stable sort by depth pairs
+    # each open with its close
+    depth = np.where(B == 1, excess, excess + 1)
+    pairs = np.lexsort((positions, depth)).reshape(-1, 2)
+    node_index = np.cumsum(B) - 1
+    close = np.empty(n_nodes, dtype=np.int64)
+    close[node_index[pairs[:, 0]]] = pairs[:, 1]
+
+    is_tip = close == opens + 1
+    tip_prefix = np.zeros(B.size + 1, dtype=np.int64)
+    tip_prefix[opens[is_tip] + 1] = 1
+    tip_prefix = np.cumsum(tip_prefix)
+    first_tips = tip_prefix[opens]
+    all_tips = tip_prefix[close + 1] - first_tips
+    postorder_position = (np.cumsum(1 - B) - 1)[close]
+
+    # the parent is the last node opened before a node, one level up
+    open_depth = depth[opens]
+    by_depth = np.lexsort((opens, open_depth))
+    depth_keys = open_depth[by_depth] * B.size + opens[by_depth]
+    found = np.searchsorted(depth_keys, (open_depth - 1) * B.size + opens) - 1
+    parents = np.where(open_depth > 1, by_depth[np.maximum(found, 0)], -1)
+
+    return is_tip, parents, first_tips, all_tips, postorder_position, close
+
+
+def _splice(values, pieces):
+    """Insert pieces into an array
+
+    Parameters
+    ----------
+    values : np.ndarray
+        The array to insert into
+    pieces : list of tuple
+        (index, values), sorted by index. Each is inserted before the
+        element at index
+
+    Returns
+    -------
+    np.ndarray
+    """
+    result = []
+    start = 0
+    for index, piece in pieces:
+        result.append(values[start:index])
+        result.append(np.asarray(piece, dtype=values.dtype))
+        start = index
+    result.append(values[start:])
+    return np.concatenate(result)
+
+
+def _heavy_region(keys, n_tips, name_ids, totals, min_count, first_tips,
+                  all_tips, child_starts, children):
+    """Find the nodes at which each name has a relative frequency >= 0.5
+
+    The counts of a name only increase toward the root, so the nodes at
+    which a name is retained with a relative frequency >= 0.5 form a subtree
+    containing the root. It is found by descending from the root, for all of
+    the names at once.
+
+    Parameters
+    ----------
+    keys : np.ndarray of int64
+        name id * n_tips + tip index of each counted tip, sorted
+    n_tips : int
+        The number of tips of the tree
+    name_ids : np.ndarray of int
+        The names to find the nodes of
+    totals : np.ndarray of int64
+        The number of tips of each name id
+    min_count : int
+        The minimum count for a name to be retained
+    first_tips, all_tips : np.ndarray of int64
+        The first tip, and the number of tips, of each node
+    child_starts, children : np.ndarray of int64
+        The children of node i are children[child_starts[i]:
+        child_starts[i + 1]]
+
+    Returns
+    -------
+    np.ndarray of int64
+        The node of each (node, name) pair
+    np.ndarray of int64
+        The name id of each pair
+    np.ndarray of int64
+        The count of the name at the node
+    """
+    nodes = np.zeros(len(name_ids), dtype=np.int64)
+    names = np.asarray(name_ids, dtype=np.int64)
+    found = []
+    while len(nodes):
+        base = names * n_tips + first_tips[nodes]
+        counts = np.searchsorted(keys, base + all_tips[nodes]) - \
+            np.searchsorted(keys, base)
+        keep = (counts > 0) & (counts >= min_count) & \
+            (2 * counts >= totals[names])
+        nodes, names = nodes[keep], names[keep]
+        found.append((nodes, names, counts[keep]))
+
+        starts = child_starts[nodes]
+        n_children = child_starts[nodes + 1] - starts
+        owner = np.repeat(np.arange(len(nodes)), n_children)
+        offsets = np.arange(len(owner)) - \
+            np.repeat(np.cumsum(n_children) - n_children, n_children)
+        nodes = children[starts[owner] + offsets]
+        names = names[owner]
+
+    return tuple(np.concatenate(x) for x in zip(*found))
+
+
+def _encode_tips(tip_names, tipname_map, rank_names):
+    """Intern the consensus names of tips following existing names
+
+    Parameters
+    ----------
+    tip_names : list of str
+        The tips to encode
+    tipname_map : dict or t2t.nlevel.CompiledTaxonomy
+        {id_: [tax, string]}, as returned by load_consensus_map
+    rank_names : list of list
+        The names for each rank indexed by id. Names not yet present are
+        appended
+
+    Returns
+    -------
+    np.ndarray of int32
+        A tips x ranks matrix of name ids, -1 where a name is missing
+    """
+    if isinstance(tipname_map, nl.CompiledTaxonomy):
+        return tipname_map.encode(tip_names, rank_names)
+
+    n_ranks = len(rank_names)
+    missing_tax = [None] * n_ranks
+    consensus = [tipname_map.get(name, missing_tax) for name in tip_names]
+    if consensus and min(map(len, consensus)) < n_ranks:
+        consensus = [list(con) + missing_tax[len(con):] for con in consensus]
+    ids = np.full((len(tip_names), n_ranks), -1, dtype=np.int32)
+
+    # a rank at a time, new names are interned in order of occurrence
+    for rank in range(n_ranks):
+        column = [con[rank] for con in consensus]
+        names = rank_names[rank]
+        lookup = {name: i for i, name in enumerate(names)}
+        for name in dict.fromkeys(column):
+            if name is not None and name not in lookup:
+                lookup[name] = len(names)
+                names.append(name)
+        get = lookup.get
+        ids[:, rank] = [get(name, -1) for name in column]
+    return ids
+
+
+class DecorationState(object):
+    """The state of a decoration, from which it can be updated incrementally
+
+    For each internal node and rank, the number of names with a relative
+    frequency >= 0.5 and the sum of their ids are kept, which is sufficient
+    to know the single heavy name of a node, if any, as names gain or lose
+    that status. These change only along the paths to the root of new tips,
+    and where the totals of the names of new tips change.
+
+    Parameters
+    ----------
+    B : np.ndarray of uint8
+        The balanced parentheses of the tree
+    names : list
+        The name of each node in preorder as given to decorate, with quotes
+        removed from tip names
+    lengths : np.ndarray of double
+        The length of each node in preorder
+    edges : np.ndarray of int32
+        The edge number of each node in preorder
+    bootstrap : np.ndarray of float
+        The bootstrap support of each node in preorder, nan if not set
+    ids : np.ndarray of int32
+        The tips x ranks name ids, see t2t.nlevel.encode_consensus
+    rank_names : list of list
+        The names for each rank indexed by id
+    n_heavy : np.ndarray of int32
+        The nodes x ranks number of names with a relative frequency >= 0.5,
+        0 for tips
+    heavy_sums : np.ndarray of int64
+        The nodes x ranks sum of the ids of those names
+    best : np.ndarray of bool
+        The nodes x ranks whether the node was picked for its name at a rank
+    best_scores : list of np.ndarray of float
+        For each rank, the score of the node picked for each name id, nan if
+        none was
+    min_count : int
+        The minimum number of tips that must represent a name
+    nameholders : bool, optional
+        Whether the tips have name holders, see add_nameholders. If so, new
+        tips are given name holders as well
+    """
+
+    def __init__(self, B, names, lengths, edges, bootstrap, ids, rank_names,
+                 n_heavy, heavy_sums, best, best_scores, min_count,
+                 nameholders=False):
+        self.B = B
+        self.names = names
+        self.lengths = lengths
+        self.edges = edges
+        self.bootstrap = bootstrap
+        self.ids = ids
+        self.rank_names = rank_names
+        self.n_heavy = n_heavy
+        self.heavy_sums = heavy_sums
+        self.best = best
+        self.best_scores = best_scores
+        self.min_count = min_count
+        self.nameholders = nameholders
+
+    def heavy_ids(self):
+        """The single heavy name id of each node and rank, -1 if none"""
+        return np.where(self.n_heavy == 1, self.heavy_sums, -1)
+
+    def decoration(self):
+        """The decoration as returned by decorate
+
+        Returns
+        -------
+        bp.BP
+            The tree with the names set
+        np.ndarray of int
+            The rank of the name set on each node in preorder, -1 if not
+            named
+        np.ndarray of float
+            The bootstrap support of each node in preorder, nan if not set
+        dict
+            {rank: [(name, score)]}, the score of the node picked for each
+            name
+        """
+        B = self.B
+        opens = np.flatnonzero(B)
+        is_tip = B[opens + 1] == 0
+        n_ranks = self.best.shape[1]
+
+        # internal nodes are named by the deepest name they were picked for
+        rank_col = np.where(self.best.any(axis=1),
+                            n_ranks - 1 -
+                            np.argmax(self.best[:, ::-1], axis=1), -1)
+        names = self._node_names(is_tip)
+        names[is_tip] = np.array(self.names, dtype=object)[is_tip]
+
+        all_names = np.full(B.size, None, dtype=object)
+        all_names[opens] = names
+        lengths = np.zeros(B.size, dtype=np.double)
+        lengths[opens] = self.lengths
+        edges = np.zeros(B.size, dtype=np.int32)
+        edges[opens] = self.edges
+        tree = bp.BP(B.copy(), names=all_names, lengths=lengths, edges=edges)
+
+        scores = {}
+        for rank, rank_scores in enumerate(self.best_scores):
+            name_ids = np.flatnonzero(~np.isnan(rank_scores))
+            scores[rank] = [(self.rank_names[rank][name_id], score)
+                            for name_id, score in
+                            zip(name_ids.tolist(),
+                                rank_scores[name_ids].tolist())]
+
+        return tree, rank_col, self.bootstrap.copy(), scores
+
+    def insert(self, insertions, tipname_map, score_f=nl.fmeasure):
+        """Place new tips and update the decoration
+
+        Each new tip is placed by splitting the edge above an existing tip,
+        or above its name holder, with a new node holding both. The result
+        is that of decorate on the tree with the tips placed. Only the
+        counts of the names of the new tips, and the counts along the paths
+        to the root of the new tips, are updated, and only the names with a
+        node whose counts or status changed are scored again.
+
+        WARNING: operates inplace
+
+        Parameters
+        ----------
+        insertions : iterable of tuple
+            (name, anchor) or (name, anchor, length), the name of a new tip,
+            the existing tip to place it next to, and optionally its length.
+            Tips placed next to the same anchor are placed in order, each
+            next to the anchor
+        tipname_map : dict or t2t.nlevel.CompiledTaxonomy
+            {id_: [tax, string]}, as returned by load_consensus_map, holding
+            the taxonomy of the new tips
+        score_f : function, optional
+            The function to score a name at a node with, as for decorate
+
+        Returns
+        -------
+        tuple
+            The decoration, as returned by decorate
+
+        Raises
+        ------
+        ValueError
+            If an anchor is not a tip of the tree, or a new tip name is
+            already in use
+        """
+        B = self.B
+        opens = np.flatnonzero(B)
+        n_ranks = self.best.shape[1]
+        is_tip, parents, _, _, _, close = _structure(B)
+        sizes = (close - opens + 1) // 2
+        tip_nodes = np.flatnonzero(is_tip).tolist()
+        tip_index = {self.names[i]: i for i in tip_nodes}
+
+        anchors = {}
+        new_names = set()
+        for insertion in insertions:
+            name, anchor = insertion[0], insertion[1]
+            length = 0.0
+            if len(insertion) > 2 and insertion[2] is not None:
+                length = float(insertion[2])
+            if name in tip_index or name in new_names:
+                raise ValueError("%s is already a tip of the tree" % name)
+            node = tip_index.get(anchor)
+            if node is None:
+                raise ValueError("%s is not a tip of the tree" % anchor)
+            if self.nameholders:
+                node = parents[node]
+            new_names.add(name)
+            anchors.setdefault(node, []).append((name, length))
+
+        # the new nodes holding an anchor open just before it, and the new
+        # tips follow the subtree of the anchor, the last placed first
+        b_pieces = []
+        node_pieces = []
+        for node, placed in anchors.items():
+            k = len(placed)
+            bits = []
+            names = []
+            lengths = []
+            for name, length in placed[::-1]:
+                if self.nameholders:
+                    bits.extend([1, 1, 0, 0])
+                    names.extend([None, name])
+                    lengths.extend([0.0, length])
+                else:
+                    bits.extend([1, 0])
+                    names.append(name)
+                    lengths.append(length)
+                bits.append(0)
+
+            # pieces at the same index are in tree order, the new tips of
+            # an anchor before the new nodes holding the next anchor
+            b_pieces.append((opens[node], 1, [1] * k))
+            b_pieces.append((close[node] + 1, 0, bits))
+            node_pieces.append((node, 1, [None] * k, [0.0] * k))
+            node_pieces.append((node + sizes[node], 0, names, lengths))
+
+        b_pieces = [(i, bits) for i, _, bits in
+                    sorted(b_pieces, key=lambda piece: piece[:2])]
+        node_pieces = [(i, n, l) for i, _, n, l in
+                       sorted(node_pieces, key=lambda piece: piece[:2])]
+
+        n_old = len(opens)
+        new_B = _splice(B, b_pieces)
+        is_new = _splice(np.zeros(n_old, dtype=bool),
+                         [(i, [True] * len(n)) for i, n, _ in node_pieces])
+        old_to_new = np.flatnonzero(~is_new)
+        n_nodes = len(is_new)
+
+        names = _splice(np.array(self.names, dtype=object),
+                        [(i, n) for i, n, _ in node_pieces])
+        lengths = _splice(self.lengths, [(i, l) for i, _, l in node_pieces])
+        edges = _splice(self.edges, [(i, [0] * len(n))
+                                     for i, n, _ in node_pieces])
+        next_edge = self.edges.max() + 1 if n_old else 0
+        edges[is_new] = next_edge + np.arange(is_new.sum())
+        bootstrap = np.full(n_nodes, np.nan)
+        bootstrap[old_to_new] = self.bootstrap
+
+        new_opens = np.flatnonzero(new_B)
+        new_is_tip = new_B[new_opens + 1] == 0
+        tip_is_new = is_new[new_is_tip]
+
+        # the names of the new tips, interned following the existing names
+        rank_names = [names_[:] for names_ in self.rank_names]
+        old_ids = np.full((len(tip_is_new), n_ranks), -1, dtype=np.int32)
+        old_ids[~tip_is_new] = self.ids
+        ids = old_ids.copy()
+        ids[tip_is_new] = _encode_tips(names[new_is_tip][tip_is_new].tolist(),
+                                       tipname_map, rank_names)
+
+        self._update(new_B, names.tolist(), lengths, edges, bootstrap, is_new,
+                     old_ids, ids, rank_names, score_f)
+        return self.decoration()
+
+    def relabel(self, tipname_map, score_f=nl.fmeasure):
+        """Update the decoration for a new taxonomy of the tips
+
+        The taxonomy of each tip is compared with that of the state, and
+        only the counts of the names of the tips whose taxonomy changed are
+        updated. The result is that of decorate with the new taxonomy.
+
+        WARNING: operates inplace
+
+        Parameters
+        ----------
+        tipname_map : dict or t2t.nlevel.CompiledTaxonomy
+            {id_: [tax, string]}, as returned by load_consensus_map
+        score_f : function, optional
+            The function to score a name at a node with, as for decorate
+
+        Returns
+        -------
+        tuple
+            The decoration, as returned by decorate
+        list of tuple
+            (node, before, after), the preorder index of each internal node
+            whose name changed, and its names before and after
+        """
+        opens = np.flatnonzero(self.B)
+        is_tip = self.B[opens + 1] == 0
+        before = self._node_names(is_tip)
+
+        rank_names = [names_[:] for names_ in self.rank_names]
+        tip_names = [self.names[i] for i in np.flatnonzero(is_tip).tolist()]
+        ids = _encode_tips(tip_names, tipname_map, rank_names)
+        self._update(self.B, self.names, self.lengths, self.edges,
+                     self.bootstrap, np.zeros(len(opens), dtype=bool),
+                     self.ids, ids, rank_names, score_f)
+
+        after = self._node_names(is_tip)
+        nodes = np.flatnonzero(before != after)
+        changed = list(zip(nodes.tolist(), before[nodes].tolist(),
+                           after[nodes].tolist()))
+        return self.decoration(), changed
+
+    def _node_names(self, is_tip):
+        """The name of each internal node in preorder, None if not named"""
+        names = np.full(len(is_tip), None, dtype=object)
+        heavy_ids = self.heavy_ids()
+        n_ranks = self.best.shape[1]
+        nodes = np.flatnonzero(self.best.any(axis=1))
+        ranks = n_ranks - 1 - np.argmax(self.best[nodes, ::-1], axis=1)
+        names[nodes] = [self.rank_names[rank][name_id] for rank, name_id in
+                        zip(ranks.tolist(), heavy_ids[nodes, ranks].tolist())]
+        return names
+
+    def _update(self, B, names, lengths, edges, bootstrap, is_new, old_ids,
+                ids, rank_names, score_f):
+        """Update the counts and scores for a changed tree or taxonomy
+
+        Parameters
+        ----------
+        B : np.ndarray of uint8
+            The balanced parentheses of the tree, which is that of the state
+            with the nodes of is_new added
+        names, lengths, edges, bootstrap
+            The attributes of the nodes of the tree, in preorder
+        is_new : np.ndarray of bool
+            Whether each node in preorder is new
+        old_ids : np.ndarray of int32
+            The tips x ranks name ids of the state, -1 for new tips
+        ids : np.ndarray of int32
+            The tips x ranks name ids to update to
+        rank_names : list of list
+            The names for each rank indexed by id, extending those of the
+            state
+        score_f : function
+            The function to score a name at a node with
+        """
+        n_ranks = self.best.shape[1]
+        n_nodes = len(is_new)
+        old_to_new = np.flatnonzero(~is_new)
+        (is_tip, parents, first_tips, all_tips, postorder_position,
+         _) = _structure(B)
+        tip_is_new = is_new[is_tip]
+        n_tips = len(tip_is_new)
+
+        old_totals = []
+        totals = []
+        for rank in range(n_ranks):
+            n_names = len(rank_names[rank])
+            column = old_ids[:, rank]
+            old_totals.append(np.bincount(column[column >= 0],
+                                          minlength=n_names))
+            column = ids[:, rank]
+            totals.append(np.bincount(column[column >= 0],
+                                      minlength=n_names))
+
+        # the number of tips, and informative tips, of each node before and
+        # after
+        def tip_counts(flags):
+            prefix = np.zeros(n_tips + 1, dtype=np.int64)
+            prefix[1:] = np.cumsum(flags)
+            return prefix[first_tips + all_tips] - prefix[first_tips]
+
+        old_all_tips = tip_counts(~tip_is_new)
+        old_num_tips = tip_counts((old_ids >= 0).any(axis=1))
+        num_tips = tip_counts((ids >= 0).any(axis=1))
+
+        n_heavy = np.zeros((n_nodes, n_ranks), dtype=np.int32)
+        n_heavy[old_to_new] = self.n_heavy
+        heavy_sums = np.zeros((n_nodes, n_ranks), dtype=np.int64)
+        heavy_sums[old_to_new] = self.heavy_sums
+        best = np.zeros((n_nodes, n_ranks), dtype=bool)
+        best[old_to_new] = self.best
+        old_heavy_ids = np.where(n_heavy == 1, heavy_sums, -1)
+        old_picked = _picked(old_heavy_ids)
+
+        children = np.argsort(parents, kind='stable')[1:]
+        child_starts = np.searchsorted(parents[children],
+                                       np.arange(n_nodes + 1))
+        old_internal = ~is_new & ~is_tip
+
+        # the tips of each new internal node
+        new_internal = np.flatnonzero(is_new & ~is_tip)
+        counts = all_tips[new_internal]
+        new_internal_owner = np.repeat(np.arange(len(new_internal)), counts)
+        new_internal_tips = np.repeat(first_tips[new_internal], counts) + \
+            np.arange(len(new_internal_owner)) - \
+            np.repeat(np.cumsum(counts) - counts, counts)
+
+        affected = []
+        for rank in range(n_ranks):
+            old_column = old_ids[:, rank].astype(np.int64)
+            column = ids[:, rank].astype(np.int64)
+            n_names = len(rank_names[rank])
+            differ = old_column != column
+            names_ = np.unique(np.concatenate([old_column[differ],
+                                               column[differ]]))
+            names_ = names_[names_ >= 0]
+            affected.append(names_)
+
+            # the existing nodes at which the names of the changed tips gain
+            # or lose a relative frequency >= 0.5
+            if len(names_):
+                regions = []
+                for tip_ids, rank_totals in ((old_column, old_totals[rank]),
+                                             (column, totals[rank])):
+                    tips = np.flatnonzero(np.isin(tip_ids, names_))
+                    nodes, region_names, _ = _heavy_region(
+                        np.sort(tip_ids[tips] * n_tips + tips), n_tips,
+                        names_, rank_totals, self.min_count, first_tips,
+                        all_tips, child_starts, children)
+                    keep = old_internal[nodes]
+                    regions.append(nodes[keep] * n_names + region_names[keep])
+
+                for pairs, sign in ((np.setdiff1d(*regions), -1),
+                                    (np.setdiff1d(*regions[::-1]), 1)):
+                    np.add.at(n_heavy[:, rank], pairs // n_names, sign)
+                    np.add.at(heavy_sums[:, rank], pairs // n_names,
+                              sign * (pairs % n_names))
+
+            # the new internal nodes hold few tips and are counted directly
+            tip_names = column[new_internal_tips]
+            known = tip_names >= 0
+            pairs, counts = np.unique(new_internal_owner[known] * n_names +
+                                      tip_names[known], return_counts=True)
+            pair_names = pairs % n_names
+            keep = (counts >= self.min_count) & \
+                (2 * counts >= totals[rank][pair_names])
+            np.add.at(n_heavy[:, rank], new_internal[pairs[keep] // n_names],
+                      1)
+            np.add.at(heavy_sums[:, rank],
+                      new_internal[pairs[keep] // n_names], pair_names[keep])
+
+        heavy_ids = np.where(n_heavy == 1, heavy_sums, -1)
+        picked = _picked(heavy_ids)
+        changed = is_new | (num_tips != old_num_tips) | \
+            (all_tips != old_all_tips) | \
+            (heavy_ids != old_heavy_ids).any(axis=1) | \
+            (picked != old_picked).any(axis=1)
+
+        best_scores = []
+        for rank in range(n_ranks):
+            rank_scores = np.full(len(rank_names[rank]), np.nan)
+            rank_scores[:len(self.best_scores[rank])] = \
+                self.best_scores[rank]
+            best_scores.append(rank_scores)
+
+            # the names which gained or lost a candidate node, or whose
+            # scores may have changed
+            touched = np.unique(np.concatenate([
+                affected[rank],
+                old_heavy_ids[changed & old_picked[:, rank], rank],
+                heavy_ids[changed & picked[:, rank], rank]]))
+            if not len(touched):
+                continue
+
+            best[:, rank] &= ~np.isin(old_heavy_ids[:, rank], touched)
+            rank_scores[touched] = np.nan
+
+            nodes = np.flatnonzero(picked[:, rank] &
+                                   np.isin(heavy_ids[:, rank], touched))
+            name_ids = heavy_ids[nodes, rank]
+            column = ids[:, rank].astype(np.int64)
+            tips = np.flatnonzero(np.isin(column, touched))
+            keys = np.sort(column[tips] * n_tips + tips)
+            base = name_ids * n_tips + first_tips[nodes]
+            counts = (np.searchsorted(keys, base + all_tips[nodes]) -
+                      np.searchsorted(keys, base)).astype(float)
+            precision = counts / num_tips[nodes]
+            recall = counts / totals[rank][name_ids]
+            node_scores = nl.score_pairs(score_f, precision, recall)
+
+            # as in decorate, ties favor the node with the fewest tips and
+            # then the last node in postorder
+            order = np.lexsort((-postorder_position[nodes], all_tips[nodes],
+                                -node_scores, name_ids))
+            sorted_ids = name_ids[order]
+            first = np.ones(len(order), dtype=bool)
+            first[1:] = sorted_ids[1:] != sorted_ids[:-1]
+            picks = order[first]
+            best[nodes[picks], rank] = True
+            rank_scores[name_ids[picks]] = node_scores[picks]
+
+        self.B = B
+        self.names = names
+        self.lengths = lengths
+        self.edges = edges
+        self.bootstrap = bootstrap
+        self.ids = ids
+        self.rank_names = rank_names
+        self.n_heavy = n_heavy
+        self.heavy_sums = heavy_sums
+        self.best = best
+        self.best_scores = best_scores
+
+
+def to_treenode(tree, rank, bootstrap):
+    """Convert a decorated tree to a DecoratedNode for the remaining stages
+
+    Parameters
+    ----------
+    tree : bp.BP
+        A tree from decorate
+    rank : np.ndarray of int
+        The rank column from decorate
+    bootstrap : np.ndarray of float
+        The bootstrap column from decorate
+
+    Returns
+    -------
+    t2t.nlevel.DecoratedNode
+        The tree with Rank and Bootstrap set on internal nodes, as
+        set_preliminary_name_and_rank and load_tree would. As with
+        bp.to_skbio_treenode, edge_num holds the edge number of each node
+    """
+    B = tree.B
+    opens = np.flatnonzero(B)
+    is_tip = (B[opens + 1] == 0).tolist()
+    ranks = rank.tolist()
+    bootstraps = bootstrap.tolist()
+
+    root = None
+    stack = []
+    for idx, i in enumerate(opens.tolist()):
+        node = nl.DecoratedNode(name=tree.name(i), length=tree.length(i))
+        node.edge_num = tree.edge(i)
+
+        if not is_tip[idx]:
+            r = ranks[idx]
+            b = bootstraps[idx]
+            node.Rank = None if r < 0 else r
+            node.Bootstrap = None if np.isnan(b) else b
+
+        # pop the ancestors whose subtrees have been closed
+        while stack and stack[-1][1] < i:
+            stack.pop()
+
+        if stack:
+            parent = stack[-1][0]
+            node.parent = parent
+            parent.children.append(node)
+        else:
+            root = node
+            node.length = None
+
+        if not is_tip[idx]:
+            stack.append((node, tree.close(i)))
+
+    return root
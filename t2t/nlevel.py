@@ -1,12 +1,26 @@
 #!/usr/bin/env python
 
+from bisect import bisect_right
 from collections import defaultdict
+from collections.abc import Mapping
+from copy import copy, deepcopy
+from itertools import accumulate, chain
 from operator import itemgetter
-from numpy import argmin, array, where
+from numpy import (argmin, argsort, arange, array, asarray,
+                   ascontiguousarray, bincount, concatenate, frexp,
+                   frombuffer, flatnonzero, full, int32, int64, lexsort,
+                   maximum, minimum, searchsorted, uint8, unique, vectorize,
+                   where, zeros)
 from skbio import TreeNode
-from skbio.tree import MissingNodeError
-from t2t.util import unzip
+from sys import intern
+from t2t.util import _read_arrays, _write_arrays
+import bz2
+import gzip
+import io
+import lzma
+import os
 import re
+import sys
 
 __author__ = "Daniel McDonald"
 __copyright__ = "Copyright 2011, The tax2tree project"
@@ -25,6 +39,71 @@ BAD_NAMES = [
 
 BAD_NAMES_REGEX = re.compile("(%s)" % ')|('.join(map(str.lower, BAD_NAMES)))
 
+# the records per chunk streamed by iter_consensus_map
+CONSENSUS_CHUNK_SIZE = 1000
+
+# the leading bytes of the compressed consensus maps open_consensus_map reads
+COMPRESSION_MAGIC = [(b'\x1f\x8b', gzip.open),
+                     (b'BZh', bz2.open),
+                     (b'\xfd7zXZ\x00', lzma.open)]
+
+# the leading bytes of a consensus map compiled by compile_taxonomy
+COMPILED_TAXONOMY_MAGIC = b'T2TTAX\x00\x01'
+
+
+class TaxonLabel(str):
+    """The name of a node that holds one or more taxon names
+
+    A TaxonLabel is the newick form of the name, the taxon names joined by
+    '; ' and prefixed by "bootstrap:" if a bootstrap is held, so it can be
+    used and written as any other name. The taxon names are kept, interned,
+    in .names so that the stages which operate on them do not need to split
+    the name again.
+    """
+    def __new__(cls, names, bootstrap=None):
+        """Construct a label
+
+        Parameters
+        ----------
+        names : iterable of str
+            The taxon names, ordered by rank
+        bootstrap : float, optional
+            A support value for the node
+        """
+        names = tuple(intern(name) for name in names)
+        text = '; '.join(names)
+        if bootstrap is not None:
+            if names:
+                text = ':'.join([str(bootstrap), text])
+            else:
+                text = str(bootstrap)
+
+        label = super(TaxonLabel, cls).__new__(cls, text)
+        label.names = names
+        label.bootstrap = bootstrap
+        return label
+
+    def __getnewargs__(self):
+        return (self.names, self.bootstrap)
+
+
+def label_names(name):
+    """The taxon names held by a node name
+
+    Parameters
+    ----------
+    name : str
+        A node name, '; ' delimited if it holds multiple names
+
+    Returns
+    -------
+    sequence of str
+        The .names of a TaxonLabel, or otherwise the name split on '; '
+    """
+    if isinstance(name, TaxonLabel):
+        return name.names
+    return name.split('; ')
+
 
 def lineage_cache(t):
     """Cache ancestral lineage information on a tree"""
@@ -34,7 +113,7 @@ def lineage_cache(t):
         else:
             n.lineage_cache = n.parent.lineage_cache[:]
             if n.name is not None and n.name[1:3] == '__':
-                n.lineage_cache.extend(n.name.split('; '))
+                n.lineage_cache.extend(label_names(n.name))
 
 
 def equal_ignoring_polyphyletic(name_a, name_b):
@@ -59,32 +138,142 @@ def equal_ignoring_polyphyletic(name_a, name_b):
     else:
         return True
 
+
+class LineageIndex(object):
+    """Lineages of the nodes of trees as chains of interned names
+
+    Every name in a lineage is held once, as an element that points to the
+    element of the name before it, so a node shares the lineage of its
+    ancestors rather than holding a copy of it. Nodes without a name share
+    the element of their parent. An empty lineage is the element -1.
+    """
+    def __init__(self):
+        self.names = []
+        self._name_ids = {}
+        self._element_names = []
+        self._parents = []
+        self._lengths = []
+        self._conflicts = {}
+
+    def add(self, tree):
+        """Add the lineages of a tree, as lineage_cache would cache them
+
+        Parameters
+        ----------
+        tree : TreeNode
+            The tree to add
+
+        Returns
+        -------
+        dict
+            {id(node): element}, the lineage of every node in the tree
+        """
+        elements = {}
+        for n in tree.preorder(include_self=True):
+            if n.is_root():
+                element = -1
+            else:
+                element = elements[id(n.parent)]
+                if n.name is not None and n.name[1:3] == '__':
+                    for name in label_names(n.name):
+                        element = self._append(element, name)
+            elements[id(n)] = element
+        return elements
+
+    def _append(self, parent, name):
+        name_id = self._name_ids.get(name)
+        if name_id is None:
+            name_id = self._name_ids[name] = len(self.names)
+            self.names.append(name)
+
+        self._element_names.append(name_id)
+        self._parents.append(parent)
+        self._lengths.append(self.length(parent) + 1)
+        return len(self._parents) - 1
+
+    def length(self, element):
+        """The number of names in a lineage"""
+        return 0 if element == -1 else self._lengths[element]
+
+    def name(self, element):
+        """The last name of a lineage"""
+        return self.names[self._element_names[element]]
+
+    def lineage(self, element):
+        """The names of a lineage from the root"""
+        names = []
+        while element != -1:
+            names.append(self.names[self._element_names[element]])
+            element = self._parents[element]
+        return names[::-1]
+
+    def conflict(self, a, b):
+        """Test whether two lineages differ other than in polyphyletic tags
+
+        The lineages are compared name by name from the root, up to the
+        length of the shorter one. The comparison is made by walking both
+        chains together toward the root, and the result for each pair of
+        elements is kept so that a shared part of a lineage is only compared
+        once.
+        """
+        parents = self._parents
+        while self.length(a) > self.length(b):
+            a = parents[a]
+        while self.length(b) > self.length(a):
+            b = parents[b]
+
+        conflicts = self._conflicts
+        path = []
+        while a != -1 and (a, b) not in conflicts:
+            path.append((a, b))
+            a = parents[a]
+            b = parents[b]
+        result = conflicts.get((a, b), False)
+
+        names = self._element_names
+        for a, b in reversed(path):
+            if not result and names[a] != names[b]:
+                result = not equal_ignoring_polyphyletic(
+                    self.names[names[a]], self.names[names[b]])
+            conflicts[(a, b)] = result
+        return result
+
+
 def correct_decorated(decorated_tree, input_taxonomy_tree, verbose=False):
     """Remove taxon if a violation with input taxonomy is observed"""
-    # cache paths
-    lineage_cache(decorated_tree)
-    lineage_cache(input_taxonomy_tree)
+    # index paths
+    lineages = LineageIndex()
+    observed = lineages.add(decorated_tree)
+    expected = lineages.add(input_taxonomy_tree)
+
+    # the lineage of each name in the input taxonomy, resolved as
+    # TreeNode.find would resolve the name
+    taxa = {}
+    for n in input_taxonomy_tree.postorder(include_self=True):
+        if n.name is None:
+            continue
+        if n.is_tip():
+            taxa[n.name] = expected[id(n)]
+        else:
+            taxa.setdefault(n.name, expected[id(n)])
+
     for n in decorated_tree.preorder(include_self=False):
         if n.name is not None and n.name[1:3] == '__':
-            try:
-                input_node = input_taxonomy_tree.find(n.lineage_cache[-1])
-            except MissingNodeError:
+            element = observed[id(n)]
+            input_element = taxa.get(lineages.name(element))
+            if input_element is None:
                 # the lineage must be in the secondary taxonomy, and we
                 # already assume the secondary taxonomy may vary
                 # relative to the input
                 continue
 
-            if n.lineage_cache != input_node.lineage_cache:
-                for o, e in zip(n.lineage_cache, input_node.lineage_cache):
-                    if not equal_ignoring_polyphyletic(o, e):
-                        if verbose:
-                            print(f"AFFECTED: {len(list(n.tips()))}\t"
-                                  f"EXAMPLE: {list(n.tips())[0].name}\t"
-                                  f"OBSERVED: {n.lineage_cache}\t"
-                                  f"EXPECTED: {input_node.lineage_cache}")
-                        n.name = None
-                        break
-
+            if lineages.conflict(element, input_element):
+                if verbose:
+                    print(f"AFFECTED: {len(list(n.tips()))}\t"
+                          f"EXAMPLE: {list(n.tips())[0].name}\t"
+                          f"OBSERVED: {lineages.lineage(element)}\t"
+                          f"EXPECTED: {lineages.lineage(input_element)}")
+                n.name = None
 
 
 def set_rank_order(order):
@@ -104,12 +293,261 @@ def determine_rank_order(con):
 
 def has_badname(name):
     """Boolean, if name contains a badname"""
-    return len(BAD_NAMES_REGEX.findall(name)) > 0
+    return BAD_NAMES_REGEX.search(name) is not None
+
+
+def find_badnames(names):
+    """The names which contain a badname, ignoring case
+
+    The names are scanned for all badnames in a single pass of
+    BAD_NAMES_REGEX over the names joined by newlines, rather than a search
+    per name.
+
+    Parameters
+    ----------
+    names : iterable of str
+        The names to check
+
+    Returns
+    -------
+    set of str
+        The names which contain a badname
+    """
+    names = list(names)
+    lowered = [name.lower() for name in names]
+
+    # the offset of the end of each name in the joined text
+    ends = list(accumulate(len(name) + 1 for name in lowered))
+    bad = set()
+    for match in BAD_NAMES_REGEX.finditer('\n'.join(lowered)):
+        bad.add(names[bisect_right(ends, match.start())])
+    return bad
+
+
+def open_consensus_map(source, compiled=True):
+    """Open a consensus map for streaming, decompressing it if needed
+
+    gzip, bz2 and xz compression are detected from the leading bytes of the
+    data rather than the file name, so compressed data can be read from
+    stdin as well. The stream is never seeked.
+
+    Parameters
+    ----------
+    source : str or file-like
+        The path to the consensus map, "-" for stdin, or an open file. Files
+        opened in text mode, and CompiledTaxonomy, are returned as is
+    compiled : bool, optional
+        Accept a consensus map compiled by compile_taxonomy, which is
+        opened as a CompiledTaxonomy, memory mapped if it is a file
+
+    Returns
+    -------
+    file-like or CompiledTaxonomy
+        The consensus map as a text stream, or the compiled consensus map
+
+    Raises
+    ------
+    ValueError
+        If the consensus map is compiled and compiled is False
+    """
+    if isinstance(source, str):
+        source = sys.stdin.buffer if source == '-' else open(source, 'rb')
+    elif isinstance(source, (io.TextIOBase, CompiledTaxonomy)):
+        return source
+
+    if not hasattr(source, 'peek'):
+        source = io.BufferedReader(source)
+
+    magic = source.peek(8)[:8]
+    if magic == COMPILED_TAXONOMY_MAGIC:
+        if not compiled:
+            raise ValueError("%s is a compiled taxonomy, a consensus map is "
+                             "required" % getattr(source, 'name', 'The input'))
+        path = getattr(source, 'name', None)
+        if isinstance(path, str) and os.path.isfile(path):
+            source.close()
+            return CompiledTaxonomy(path)
+        return CompiledTaxonomy(source.read())
+
+    for prefix, opener in COMPRESSION_MAGIC:
+        if magic.startswith(prefix):
+            source = opener(source)
+            break
+    return io.TextIOWrapper(source, encoding='utf-8')
+
+
+def iter_consensus_map(lines, append_rank, check_bad=True,
+                       check_min_inform=True, assert_nranks=True,
+                       check_euk_unc=False, detect_rank_order=False,
+                       chunk_size=CONSENSUS_CHUNK_SIZE):
+    """Stream the cleaned records of a consensus map in chunks
+
+    The records are cleaned as described by load_consensus_map. Blank lines
+    are skipped.
+
+    Parameters
+    ----------
+    lines : iterable of str or CompiledTaxonomy
+        The tab delimited tipname and consensus string of each tip, see
+        open_consensus_map
+    append_rank, check_bad, check_min_inform, assert_nranks, check_euk_unc
+        See load_consensus_map
+    detect_rank_order : bool, optional
+        Set RANK_ORDER from the first record, see determine_rank_order
+    chunk_size : int, optional
+        The number of records per chunk
+
+    Returns
+    -------
+    generator of list of tuple
+        The (tipname, [tax, string]) records in the order of the lines
+    """
+    if isinstance(lines, CompiledTaxonomy):
+        lines.check(append_rank, check_bad, check_min_inform, assert_nranks,
+                    check_euk_unc, detect_rank_order)
+        yield from lines.chunks(chunk_size)
+        return
+
+    lines = iter(lines)
+    if detect_rank_order:
+        for line in lines:
+            if line.strip():
+                determine_rank_order(line.strip().split('\t')[1])
+                lines = chain([line], lines)
+                break
+
+    cleaner = _ConsensusCleaner(append_rank, check_bad, check_min_inform,
+                                assert_nranks, check_euk_unc)
+    chunk = []
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+
+        id_, consensus = line.split('\t')
+        chunk.append((id_.strip(), consensus))
+        if len(chunk) >= chunk_size:
+            yield cleaner.clean(chunk)
+            chunk = []
+
+    if chunk:
+        yield cleaner.clean(chunk)
+
+
+class _ConsensusCleaner(object):
+    """Clean consensus strings, once per distinct string and name
+
+    The cleaned names of each distinct consensus string, and of each
+    distinct name at each rank, are kept. A map of millions of tips holds
+    far fewer distinct names, so the cleaning scales with the latter, and
+    the tips share the cleaned, interned, names. The names not seen before
+    are checked for bad names together, see find_badnames.
+
+    Parameters
+    ----------
+    append_rank, check_bad, check_min_inform, assert_nranks, check_euk_unc
+        See load_consensus_map
+    """
+
+    def __init__(self, append_rank, check_bad, check_min_inform,
+                 assert_nranks, check_euk_unc):
+        self.append_rank = append_rank
+        self.check_bad = check_bad
+        self.check_min_inform = check_min_inform
+        self.assert_nranks = assert_nranks
+        self.check_euk_unc = check_euk_unc
+
+        self.n_ranks = len(RANK_ORDER)
+        if append_rank:
+            self.missing = ["%s__" % rank for rank in RANK_ORDER]
+        else:
+            self.missing = [None] * self.n_ranks
+
+        # {consensus string: [names]}
+        self.consensus = {}
+        # per rank, {name: (whether it is missing, the cleaned name)}
+        self.names = []
+
+    def clean(self, records):
+        """Clean the consensus strings of records
+
+        Parameters
+        ----------
+        records : list of tuple
+            The (tipname, consensus string) records
+
+        Returns
+        -------
+        list of tuple
+            The (tipname, [tax, string]) records. Records of the same
+            consensus string share the list of names, which is not modified
+            in place
+        """
+        consensus = self.consensus
+        new = [c for c in dict.fromkeys(c for _, c in records)
+               if c not in consensus]
+        if new:
+            self._add(new)
+        return [(id_, consensus[c]) for id_, c in records]
+
+    def _add(self, strings):
+        n_ranks = self.n_ranks
+        split = [[n.strip() for n in c.split(';')] for c in strings]
+
+        # the names not seen before at each rank
+        cache = self.names
+        unseen = []
+        for names in split:
+            while len(cache) < len(names):
+                cache.append({})
+            for idx, name in enumerate(names):
+                if name not in cache[idx]:
+                    cache[idx][name] = None
+                    unseen.append((idx, name))
+
+        # clean up missing names
+        missing = [idx < n_ranks and (name == '' or name == 'None' or
+                                      '__' in name and
+                                      name.split('__')[1] == '')
+                   for idx, name in unseen]
+
+        # clean up bad names
+        bad = set()
+        if self.check_bad:
+            bad = find_badnames({name for (_, name), m in zip(unseen, missing)
+                                 if not m})
+
+        # append rank if needed
+        for (idx, name), is_missing in zip(unseen, missing):
+            cleaned = None if is_missing or name in bad else intern(name)
+            if self.append_rank and idx < n_ranks:
+                if cleaned is None:
+                    cleaned = "%s__" % RANK_ORDER[idx]
+                else:
+                    cleaned = intern('__'.join([RANK_ORDER[idx], cleaned]))
+            cache[idx][name] = (is_missing, cleaned)
+
+        for c, names in zip(strings, split):
+            if self.check_euk_unc and 'Eukaryota' in names[0] or \
+                    'Unclassified' in names[0]:
+                self.consensus[c] = self.missing
+                continue
+
+            if self.assert_nranks:
+                if len(names) != n_ranks:
+                    raise ValueError
+
+            if self.check_min_inform and cache[1][names[1]][0]:
+                self.consensus[c] = self.missing
+            else:
+                self.consensus[c] = [cache[idx][name][1]
+                                     for idx, name in enumerate(names)]
 
 
 def load_consensus_map(lines, append_rank, check_bad=True,
                        check_min_inform=True, assert_nranks=True,
-                       verbose=False, check_euk_unc=False):
+                       verbose=False, check_euk_unc=False,
+                       detect_rank_order=False, keep=None):
     """Input is tab delimited mapping from tipname to a consensus string
 
     tipname is the tipnames in the loaded tree
@@ -125,61 +563,380 @@ def load_consensus_map(lines, append_rank, check_bad=True,
     check_euk_unc : check for eukarayota or unclassified, set to none if found
     and true
 
+    detect_rank_order : set RANK_ORDER from the first line, so that lines
+    need not be seekable
+
+    keep : if set, only the tipnames in keep are retained
+
     Output is a dictionary mapping tipname to consensus strings split into
-    a list.
+    a list. If lines is a CompiledTaxonomy, it is returned as is, having
+    been compiled with the default arguments.
     """
     if verbose:
         print("loading consensus map...")
 
+    if isinstance(lines, CompiledTaxonomy):
+        lines.check(append_rank, check_bad, check_min_inform, assert_nranks,
+                    check_euk_unc, detect_rank_order)
+        return lines
+
     mapping = {}
-    n_ranks = len(RANK_ORDER)
-    for line in lines:
-        id_, consensus = line.strip().split('\t')
-        id_ = id_.strip()
+    for chunk in iter_consensus_map(lines, append_rank, check_bad,
+                                    check_min_inform, assert_nranks,
+                                    check_euk_unc, detect_rank_order):
+        if keep is None:
+            mapping.update(chunk)
+        else:
+            mapping.update(record for record in chunk if record[0] in keep)
 
-        names = [n.strip() for n in consensus.split(';')]
+    return mapping
 
-        if check_euk_unc and 'Eukaryota' in names[0] or \
-                'Unclassified' in names[0]:
-            names = [None] * n_ranks
 
-        if assert_nranks:
-            if len(names) != n_ranks:
-                raise ValueError
+class CompiledTaxonomy(Mapping):
+    """A consensus map compiled by compile_taxonomy
 
-        # clean up missing names
-        for idx in range(n_ranks):
-            if names[idx] == '' or names[idx] == 'None':
-                names[idx] = None
-            if names[idx] is not None and \
-                    '__' in names[idx] and \
-                    names[idx].split('__')[1] == '':
-                names[idx] = None
-
-        if check_min_inform:
-            if names[1] is None:
-                names = [None] * n_ranks
+    The compiled map holds the cleaned names of the map as a string table,
+    the tips x ranks matrix of their ids and the tip ids sorted, as an
+    index to the rows of the matrix. It is read through a memory map, so
+    it opens without parsing and processes which open it share its pages.
 
-        # clean up bad names
-        if check_bad:
-            for idx, name in enumerate(names):
-                if name is not None and has_badname(name.lower()):
-                    names[idx] = None
+    As a Mapping, it is the {id_: [tax, string]} of load_consensus_map,
+    in the order of the map. Lookups are vectorized by encode and subset,
+    which should be preferred to looking up tips one at a time.
 
-        # append rank if needed
-        if append_rank:
-            for idx in range(n_ranks):
-                if names[idx] is not None:
-                    names[idx] = '__'.join([RANK_ORDER[idx], names[idx]])
-                else:
-                    names[idx] = "%s__" % RANK_ORDER[idx]
-        mapping[id_] = names
+    Parameters
+    ----------
+    source : str or bytes
+        The path to the compiled map, or its content
 
-    return mapping
+    Attributes
+    ----------
+    rank_order : list of str
+        The rank order of the map
+    names : list of str
+        The string table, the names of each rank in turn
+    ids : np.ndarray of int32
+        The tips x ranks matrix of the index of each name in names, -1 where
+        a name is missing, in the order of the map
+    tips : np.ndarray of bytes
+        The tip ids, UTF-8 encoded, sorted for lookups
+    rows : np.ndarray of int64
+        The row of ids of each of tips
+    """
+
+    def __init__(self, source):
+        header, arrays = _read_arrays(source, COMPILED_TAXONOMY_MAGIC,
+                                      'taxonomy')
+
+        self.rank_order = header['rank_order']
+        names = bytes(arrays['names']).decode('utf-8')
+        self.names = [intern(n) for n in names.split('\n')] if names else []
+        self.ids = arrays['ids']
+        self.tips = arrays['tips']
+        self.rows = arrays['rows']
+
+        # the tip ids in the order of the map, decoded when first iterated
+        self._tip_data = arrays['tip_ids']
+        self._tip_ids = None
+        # the string table, indexed by the ids of missing names as well
+        self._names = self.names + [None]
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __iter__(self):
+        return iter(self._tip_list())
+
+    def __getitem__(self, tip):
+        row = self.lookup([tip])[0]
+        if row < 0:
+            raise KeyError(tip)
+        return self._consensus(self.ids[row:row + 1])[0]
+
+    def __contains__(self, tip):
+        return self.lookup([tip])[0] >= 0
+
+    def keys(self):
+        return list(self)
+
+    def values(self):
+        return self._consensus(self.ids)
+
+    def items(self):
+        return list(zip(self._tip_list(), self.values()))
+
+    def check(self, append_rank, check_bad=True, check_min_inform=True,
+              assert_nranks=True, check_euk_unc=False,
+              detect_rank_order=False):
+        """Check the map was compiled with the arguments of load_consensus_map
+
+        Parameters
+        ----------
+        append_rank, check_bad, check_min_inform, assert_nranks, check_euk_unc
+            See load_consensus_map
+        detect_rank_order : bool, optional
+            Set RANK_ORDER to that of the map
+
+        Raises
+        ------
+        ValueError
+            If the map was compiled with different arguments
+        """
+        if append_rank or not check_bad or not check_min_inform or \
+                not assert_nranks or check_euk_unc:
+            raise ValueError("A compiled taxonomy is cleaned with the default "
+                             "arguments of load_consensus_map")
+        if detect_rank_order:
+            set_rank_order(self.rank_order)
+
+    def lookup(self, tips):
+        """The rows of ids of tips
+
+        Parameters
+        ----------
+        tips : list of str
+            The tip ids, or None
+
+        Returns
+        -------
+        np.ndarray of int64
+            The row of each tip, -1 if not in the map
+        """
+        rows = full(len(tips), -1, dtype=int64)
+        if not len(tips) or not len(self.tips):
+            return rows
+
+        known = array([tip is not None for tip in tips], dtype=bool)
+        query = array([tip.encode('utf-8') if tip is not None else b''
+                       for tip in tips])
+        found = searchsorted(self.tips, query)
+        found[found == len(self.tips)] = 0
+        hit = known & (self.tips[found] == query)
+        rows[hit] = self.rows[found[hit]]
+        return rows
+
+    def subset(self, tips):
+        """The {id_: [tax, string]} of tips in the map
+
+        Parameters
+        ----------
+        tips : list of str
+            The tip ids
+
+        Returns
+        -------
+        dict
+        """
+        rows = self.lookup(tips)
+        hit = flatnonzero(rows >= 0)
+        return dict(zip([tips[i] for i in hit.tolist()],
+                        self._consensus(self.ids[rows[hit]])))
+
+    def encode(self, tips, rank_names):
+        """Intern the names of tips following existing names
+
+        The same as encode_consensus, or decorate._encode_tips where names
+        exist, for the consensus of tips, without decoding it.
+
+        Parameters
+        ----------
+        tips : list of str
+            The tip ids
+        rank_names : list of list
+            The names for each rank indexed by id. Names not yet present are
+            appended in order of occurrence
+
+        Returns
+        -------
+        np.ndarray of int32
+            A tips x ranks matrix of name ids, -1 where a name is missing
+        """
+        n_ranks = len(rank_names)
+        rows = self.lookup(tips)
+        found = rows >= 0
+        name_ids = full((len(tips), n_ranks), -1, dtype=int32)
+        n_compiled = min(n_ranks, self.ids.shape[1])
+        name_ids[found, :n_compiled] = self.ids[rows[found], :n_compiled]
+
+        for rank in range(n_compiled):
+            string_ids, first, inverse = unique(name_ids[:, rank],
+                                                return_index=True,
+                                                return_inverse=True)
+            names = rank_names[rank]
+            lookup = {name: i for i, name in enumerate(names)}
+            for string_id in string_ids[argsort(first)].tolist():
+                name = self.names[string_id] if string_id >= 0 else None
+                if name is not None and name not in lookup:
+                    lookup[name] = len(names)
+                    names.append(name)
+            ranked = array([lookup[self.names[i]] if i >= 0 else -1
+                            for i in string_ids.tolist()], dtype=int32)
+            name_ids[:, rank] = ranked[inverse.ravel()]
+        return name_ids
+
+    def chunks(self, chunk_size=CONSENSUS_CHUNK_SIZE):
+        """The (id_, [tax, string]) records in chunks, in the order of the map
+
+        Parameters
+        ----------
+        chunk_size : int, optional
+            The number of records per chunk
+
+        Returns
+        -------
+        generator of list of tuple
+        """
+        tips = self._tip_list()
+        shared = {}
+        for start in range(0, len(self), chunk_size):
+            stop = start + chunk_size
+            yield list(zip(tips[start:stop],
+                           self._consensus(self.ids[start:stop], shared)))
+
+    def _tip_list(self):
+        """The tip ids in the order of the map"""
+        if self._tip_ids is None:
+            tip_ids = bytes(self._tip_data).decode('utf-8')
+            self._tip_ids = tip_ids.split('\n') if tip_ids else []
+        return self._tip_ids
+
+    def _consensus(self, ids, shared=None):
+        """Decode rows of ids, sharing the list of names of equal rows
+
+        shared holds the names of the rows decoded so far, by their bytes
+        """
+        if shared is None:
+            shared = {}
+        if not len(ids):
+            return []
+
+        names = self._names
+        rows = ids.astype('<i4', order='C')
+        result = []
+        for row in rows.view('V%d' % rows.strides[0]).ravel().tolist():
+            con = shared.get(row)
+            if con is None:
+                con = shared[row] = [names[i] for i in
+                                     frombuffer(row, dtype='<i4').tolist()]
+            result.append(con)
+        return result
+
+
+def compile_taxonomy(lines, path):
+    """Compile a consensus map to be opened as a CompiledTaxonomy
+
+    The map is cleaned as by load_consensus_map with its default arguments,
+    and its rank order is that of its first line. The file holds a header
+    describing the arrays that follow, each aligned to 64 bytes.
+
+    Parameters
+    ----------
+    lines : iterable of str
+        The consensus map, see open_consensus_map
+    path : str
+        The file to write
+    """
+    tipname_map = load_consensus_map(lines, False, detect_rank_order=True)
+    tips = list(tipname_map)
+    name_ids, rank_names = encode_consensus(tipname_map.values())
+
+    # one string table, the names of each rank in turn
+    rank_starts = [0]
+    for names in rank_names:
+        rank_starts.append(rank_starts[-1] + len(names))
+    ids = where(name_ids >= 0,
+                name_ids + array(rank_starts[:-1], dtype=int32), -1)
+    names = '\n'.join(chain.from_iterable(rank_names)).encode('utf-8')
+    tip_ids = '\n'.join(tips).encode('utf-8')
+
+    encoded = array([tip.encode('utf-8') for tip in tips] or [b''])
+    order = argsort(encoded[:len(tips)], kind='stable')
+
+    arrays = [('names', frombuffer(names, dtype=uint8)),
+              ('tip_ids', frombuffer(tip_ids, dtype=uint8)),
+              ('ids', ids.astype('<i4')),
+              ('tips', encoded[order]),
+              ('rows', order.astype('<i8'))]
+
+    _write_arrays(path, COMPILED_TAXONOMY_MAGIC, {'rank_order': RANK_ORDER},
+                  arrays)
+
+
+class DecoratedNode(TreeNode):
+    """A TreeNode with fixed slots for the decoration state
+
+    The stages of the decoration attach their state to every node of the
+    tree. Holding these in slots, rather than in the instance dict, reduces
+    the memory used per node and the cost of attribute access during
+    traversals. skbio.TreeNode does not define __slots__, so the instance
+    dict remains for the TreeNode fields and any other attributes.
+
+    An unset slot raises AttributeError, as an unset attribute would.
+    """
+    __slots__ = ('TipStart', 'TipStop', 'Consensus', 'Bootstrap', 'NumTips',
+                 'NumTipsRank', 'TaxaCount', 'ConsensusRelFreq',
+                 'ValidRelFreq', 'RankSafe', 'RankNames', 'RankNameScores',
+                 'Rank', 'BackFillNames')
+
+    @classmethod
+    def from_treenode(cls, tree):
+        """Construct a DecoratedNode tree from a TreeNode
+
+        Parameters
+        ----------
+        tree : TreeNode
+            The tree to convert. Other attributes of the nodes, such as
+            edge_num, are carried over
+
+        Returns
+        -------
+        DecoratedNode
+        """
+        if isinstance(tree, cls):
+            return tree
+
+        new_node = cls.__new__
+
+        def convert(node, parent):
+            # carry over the public attributes, which includes the TreeNode
+            # fields, but not caches or methods patched onto the instance
+            new = new_node(cls)
+            attrs = new.__dict__
+            for key, value in node.__dict__.items():
+                if not key.startswith('_') and not callable(value):
+                    attrs[key] = value
+            attrs['parent'] = parent
+            attrs['children'] = []
+            return new
+
+        result = convert(tree, None)
+        stack = [(tree, result)]
+        while stack:
+            old, new = stack.pop()
+            for child in old.children:
+                new_child = convert(child, new)
+                new.children.append(new_child)
+                stack.append((child, new_child))
+
+        return result
+
+    def _copy(self, deep, memo):
+        # TreeNode only copies the instance dict
+        result = super(DecoratedNode, self)._copy(deep, memo)
+        for old, new in zip(self.preorder(include_self=True),
+                            result.preorder(include_self=True)):
+            for attr in self.__slots__:
+                try:
+                    value = getattr(old, attr)
+                except AttributeError:
+                    continue
+                setattr(new, attr, deepcopy(value, memo) if deep else
+                        copy(value))
+        return result
 
 
 def load_tree(tree, tipname_map):
-    """Returns a PhyloNode tree decorated with helper attrs
+    """Returns a DecoratedNode tree decorated with helper attrs
 
     The following attributes and descriptions are decorated onto the tree:
 
@@ -195,29 +952,47 @@ def load_tree(tree, tipname_map):
         TipStop
             The right most tip
 
+    The root additionally holds ConsensusIds and ConsensusNames, the tip
+    consensus encoded as an integer matrix (see encode_consensus), in the
+    order of the tips. Downstream stages operate on this matrix.
+
     Parameters
     ----------
     tree : str or TreeNode
         A newick string or a TreeNode
-    tipname_map : dict
-        {id_: [tax, string]}
+    tipname_map : dict or iterable of list
+        {id_: [tax, string]}, or the chunks of (id_, [tax, string]) records
+        of iter_consensus_map, of which only the records of the tips of the
+        tree are retained
 
     Returns
     -------
-    TreeNode
+    DecoratedNode
+        The tree, converted to DecoratedNode if necessary
 
     """
     if not isinstance(tree, TreeNode):
-        tree = TreeNode.read(tree, convert_underscores=False)
+        tree = DecoratedNode.read(tree, convert_underscores=False)
+    else:
+        tree = DecoratedNode.from_treenode(tree)
+
+    tips = list(tree.tips())
+    for tip in tips:
+        if tip.name:
+            tip.name = tip.name.replace("'", "")
+
+    if not isinstance(tipname_map, dict):
+        names = {tip.name for tip in tips}
+        chunks = tipname_map
+        tipname_map = {}
+        for chunk in chunks:
+            tipname_map.update(r for r in chunk if r[0] in names)
 
     n_ranks = len(RANK_ORDER)
 
     missing_tax = [None] * n_ranks
 
-    for idx, tip in enumerate(tree.tips()):
-        if tip.name:
-            tip.name = tip.name.replace("'", "")
-
+    for idx, tip in enumerate(tips):
         tip.TipStart = idx
         tip.TipStop = idx
         tip.Consensus = tipname_map.get(tip.name, missing_tax)
@@ -239,9 +1014,76 @@ def load_tree(tree, tipname_map):
             except ValueError:
                 node.Bootstrap = None
 
+    tree.ConsensusIds, tree.ConsensusNames = \
+        encode_consensus(tip.Consensus for tip in tree.tips())
+
     return tree
 
 
+def encode_consensus(consensus, n_ranks=None):
+    """Intern consensus names into a tips x ranks integer matrix
+
+    Each distinct name at a rank is assigned an integer id, in order of first
+    occurrence, so that later stages compare and count integers rather than
+    hashing the same strings repeatedly.
+
+    Parameters
+    ----------
+    consensus : iterable of list
+        The consensus names per tip, None where a name is missing
+    n_ranks : int, optional
+        The number of ranks, defaults to len(RANK_ORDER)
+
+    Returns
+    -------
+    np.ndarray of int32
+        A tips x ranks matrix of name ids, -1 where a name is missing
+    list of list
+        The names for each rank indexed by id
+    """
+    if n_ranks is None:
+        n_ranks = len(RANK_ORDER)
+
+    lookups = [{} for _ in range(n_ranks)]
+    names = [[] for _ in range(n_ranks)]
+    missing = [-1] * n_ranks
+
+    flat = []
+    n_rows = 0
+    for con in consensus:
+        n_rows += 1
+        row = missing[:]
+        for rank, name in enumerate(con[:n_ranks]):
+            if name is None:
+                continue
+
+            lookup = lookups[rank]
+            name_id = lookup.get(name)
+            if name_id is None:
+                name_id = len(names[rank])
+                lookup[name] = name_id
+                names[rank].append(name)
+            row[rank] = name_id
+        flat.extend(row)
+
+    ids = array(flat, dtype=int32).reshape((n_rows, n_ranks))
+    return ids, names
+
+
+def _consensus_ids(tree):
+    """Get the encoded consensus of the tips of tree
+
+    The encoding cached by load_tree is used if available, otherwise it is
+    computed from the Consensus attribute of the tips. Rows are in the order
+    of tree.tips(), which is also the order tips are visited in a postorder
+    traversal.
+    """
+    ids = getattr(tree, 'ConsensusIds', None)
+    if ids is None:
+        return encode_consensus(tip.Consensus for tip in tree.tips())
+    return ids, tree.ConsensusNames
+
+
 def collect_names_at_ranks_counts(tree):
     """Returns total name counts for a given name at a given rank
 
@@ -257,17 +1099,98 @@ def collect_names_at_ranks_counts(tree):
         Returns a 2d dict, [RANK][name] -> count
 
     """
+    ids, names = _consensus_ids(tree)
     total_counts = {i: defaultdict(int) for i in range(len(RANK_ORDER))}
 
-    for consensus in (tip.Consensus for tip in tree.tips()):
-        for rank, name in enumerate(consensus):
-            if name is None:
-                continue
-            total_counts[rank][name] += 1
+    for rank, rank_names in enumerate(names):
+        column = ids[:, rank]
+        counts = bincount(column[column >= 0], minlength=len(rank_names))
+        for name, count in zip(rank_names, counts.tolist()):
+            total_counts[rank][name] = count
     return total_counts
 
 
-def decorate_name_relative_freqs(tree, total_counts, min_count):
+def _merge_name_counts(counts, other, min_count, observed):
+    """Merge the smaller of two {name: count} dicts into the larger
+
+    Names whose merged count reaches min_count are added to observed. The
+    returned dict may be either of the inputs, and both should be considered
+    consumed.
+    """
+    if len(counts) < len(other):
+        counts, other = other, counts
+
+    for name, count in other.items():
+        prev = counts.get(name, 0)
+        total = prev + count
+        counts[name] = total
+        if prev < min_count <= total:
+            observed.add(name)
+
+    return counts
+
+
+def _iter_subtree_name_counts(tree, ids, min_count=1):
+    """Yield subtree name id counts for every node in postorder
+
+    Counts are aggregated bottom-up: the counts of a node are built by merging
+    the counts of its children, always merging the smaller dict into the
+    larger one, so the total work is near-linear in the number of tips rather
+    than proportional to the sum of the subtree sizes.
+
+    Parameters
+    ----------
+    tree : TreeNode
+    ids : np.ndarray
+        The encoded consensus of the tips, see encode_consensus
+    min_count : int
+        Names observed at least this many times are tracked in the observed
+        sets
+
+    Yields
+    ------
+    tuple of (TreeNode, list of dict, list of set)
+        The node, the per rank {name id: count} of the tips that descend, and
+        the per rank set of name ids whose count is >= min_count. These objects
+        are reused when the parent is visited, so they must be consumed, or
+        copied, before advancing the generator.
+    """
+    n_ranks = ids.shape[1]
+    pending = {}
+    tip_rows = iter(ids.tolist())
+
+    for node in tree.postorder(include_self=True):
+        if node.is_tip():
+            counts = [{} for _ in range(n_ranks)]
+            observed = [set() for _ in range(n_ranks)]
+            for rank, name_id in enumerate(next(tip_rows)):
+                if name_id < 0:
+                    continue
+                counts[rank][name_id] = 1
+                if min_count <= 1:
+                    observed[rank].add(name_id)
+        else:
+            children = [pending.pop(id(c)) for c in node.children]
+            counts, observed = children[0]
+            for child_counts, child_observed in children[1:]:
+                for rank in range(n_ranks):
+                    if len(observed[rank]) < len(child_observed[rank]):
+                        observed[rank], child_observed[rank] = \
+                            child_observed[rank], observed[rank]
+                    observed[rank].update(child_observed[rank])
+                    counts[rank] = _merge_name_counts(counts[rank],
+                                                      child_counts[rank],
+                                                      min_count,
+                                                      observed[rank])
+
+        yield node, counts, observed
+
+        if node.parent is not None:
+            pending[id(node)] = (counts, observed)
+
+
+def decorate_name_relative_freqs(tree, total_counts, min_count,
+                                 candidates_only=False):
     """Decorates relative frequency information for names on the tree
 
     Adds on the attribute ConsensusRelFreq which is a 2d dict containing
@@ -288,41 +1211,52 @@ def decorate_name_relative_freqs(tree, total_counts, min_count):
     min_count : int
         is the minimum number of tips that must represent a name for that
         frequency to be retained
+    candidates_only : bool, optional
+        If True, only retain the name which could be picked at each rank,
+        which is the single name with a relative frequency >= 0.5. A rank
+        with no such name, or with several, is left empty. set_ranksafe,
+        pick_names and name_node_score_fold behave as they would with the
+        full frequencies, but the memory used is bounded by the number of
+        ranks rather than the number of names that descend.
 
     """
-    tips = list(tree.tips())
-    for tip in tips:
-        tip.ConsensusRelFreq = None
-
+    ids, names = _consensus_ids(tree)
     n_ranks = len(RANK_ORDER)
     n_ranks_it = range(n_ranks)
 
-    for n in tree.traverse(include_self=True):
+    # index the totals by name id
+    totals = [[total_counts[rank][name] for name in names[rank]]
+              for rank in n_ranks_it]
+
+    for n, counts, observed in _iter_subtree_name_counts(tree, ids,
+                                                         min_count):
         if n.is_tip():
             n.ConsensusRelFreq = None
             n.ValidRelFreq = None
             continue
 
-        counts = {i: defaultdict(int) for i in n_ranks_it}
-
-        # build of counts of the names at the tips per rank
-        cons_at_tips = (t.Consensus for t in tips[n.TipStart:n.TipStop + 1])
-        for con in cons_at_tips:
-            for cur_rank, cur_name in enumerate(con):
-                if cur_name is None:
-                    continue
-                counts[cur_rank][cur_name] += 1
-
         res_freq = {i: {} for i in n_ranks_it}
         res_valid = {i: {} for i in n_ranks_it}
 
-        # collect frequency information of the names per rank
-        for rank, names in counts.items():
-            for name, name_counts in counts[rank].items():
-                if name_counts < min_count:
+        # collect frequency information of the names per rank, only the
+        # names which pass min_count need to be examined
+        for rank in n_ranks_it:
+            rank_counts = counts[rank]
+            rank_totals = totals[rank]
+            rank_names = names[rank]
+            if candidates_only:
+                heavy = [name_id for name_id in observed[rank]
+                         if 2 * rank_counts[name_id] >= rank_totals[name_id]]
+                if len(heavy) != 1:
                     continue
+                rank_observed = heavy
+            else:
+                rank_observed = observed[rank]
 
-                relfreq = float(name_counts) / total_counts[rank][name]
+            for name_id in rank_observed:
+                name_counts = rank_counts[name_id]
+                name = rank_names[name_id]
+                relfreq = float(name_counts) / rank_totals[name_id]
                 validfreq = float(name_counts) / n.NumTips
                 res_freq[rank][name] = relfreq
                 res_valid[rank][name] = validfreq
@@ -345,22 +1279,129 @@ def decorate_name_counts(tree):
         The return data from collect_names_at_ranks_counts
     """
 
-    tips = list(tree.tips())
-    n_ranks = len(RANK_ORDER)
-    n_ranks_it = range(n_ranks)
+    ids, names = _consensus_ids(tree)
 
-    for n in tree.traverse(include_self=True):
-        counts = {i: defaultdict(int) for i in n_ranks_it}
+    for n, counts, _ in _iter_subtree_name_counts(tree, ids):
+        n.TaxaCount = {}
+        for rank, rank_counts in enumerate(counts):
+            rank_names = names[rank]
+            n.TaxaCount[rank] = defaultdict(int, (
+                (rank_names[name_id], count)
+                for name_id, count in rank_counts.items()))
 
-        # build of counts of the names at the tips per rank
-        cons_at_tips = (t.Consensus for t in tips[n.TipStart:n.TipStop + 1])
-        for con in cons_at_tips:
-            for cur_rank, cur_name in enumerate(con):
-                if cur_name is None:
-                    continue
-                counts[cur_rank][cur_name] += 1
 
-        n.TaxaCount = counts
+class TaxonRangeIndex(object):
+    """Count the tips of a taxon within a clade from tip order intervals
+
+    load_tree assigns each node a contiguous interval of tips, TipStart to
+    TipStop. For each rank, the tip positions of every name are held in a
+    single sorted array keyed by (name id, tip position), so the number of
+    tips of one name within a clade is answered with two binary searches.
+    The names which occur within a clade are read from the name ids of its
+    tips, at a cost in the size of the clade. Nothing is stored on the
+    nodes.
+    """
+    def __init__(self, ids, names):
+        """Initialize the index.
+
+        Parameters
+        ----------
+        ids : np.ndarray
+            The tips x ranks encoded consensus, in tip order
+        names : list of list
+            The names for each rank indexed by id, see encode_consensus
+        """
+        self.names = names
+        self.n_tips = ids.shape[0]
+        self._lookup = [{name: i for i, name in enumerate(rank_names)}
+                        for rank_names in names]
+        self._keys = []
+        self._columns = []
+
+        positions = arange(self.n_tips, dtype=int64)
+        for rank in range(ids.shape[1]):
+            column = ascontiguousarray(ids[:, rank])
+            present = column >= 0
+            keys = column[present].astype(int64) * self.n_tips + \
+                positions[present]
+            keys.sort()
+            self._keys.append(keys)
+            self._columns.append(column)
+
+    @classmethod
+    def from_tree(cls, tree):
+        """Construct the index for a tree from load_tree"""
+        return cls(*_consensus_ids(tree))
+
+    def count(self, node, rank, name):
+        """The number of tips of name at rank which descend from node
+
+        Parameters
+        ----------
+        node : TreeNode
+            A node with TipStart and TipStop set
+        rank : int
+            The rank of the name
+        name : str
+            The name to count
+
+        Returns
+        -------
+        int
+        """
+        name_id = self._lookup[rank].get(name)
+        if name_id is None:
+            return 0
+        keys = self._keys[rank]
+        offset = name_id * self.n_tips
+        start = keys.searchsorted(offset + node.TipStart, side='left')
+        stop = keys.searchsorted(offset + node.TipStop, side='right')
+        return int(stop - start)
+
+    def present(self, node, rank):
+        """The names at rank which occur within the clade of node, by id
+
+        Only the tips of the clade are read, so the cost is in the size of
+        the clade rather than in the number of names at the rank.
+
+        Returns
+        -------
+        np.ndarray of int
+            The ids of the names present, sorted, see TaxonRangeIndex.names
+        np.ndarray of int
+            The number of tips of each
+        """
+        column = self._columns[rank][node.TipStart:node.TipStop + 1]
+        return unique(column[column >= 0], return_counts=True)
+
+    def counts(self, node, rank):
+        """The number of tips of every name at rank which descend from node
+
+        The result holds every name at the rank, so present should be
+        preferred where only the names of the clade are of interest.
+
+        Returns
+        -------
+        np.ndarray of int
+            The counts, indexed by name id, see TaxonRangeIndex.names
+        """
+        result = zeros(len(self.names[rank]), dtype=int64)
+        name_ids, counts = self.present(node, rank)
+        result[name_ids] = counts
+        return result
+
+    def taxa(self, node, rank):
+        """The names at rank which occur within the clade of node
+
+        Returns
+        -------
+        dict
+            {name: count} for the names present
+        """
+        rank_names = self.names[rank]
+        name_ids, counts = self.present(node, rank)
+        return {rank_names[i]: c for i, c in zip(name_ids.tolist(),
+                                                  counts.tolist())}
 
 
 def set_ranksafe(tree):
@@ -400,12 +1441,12 @@ def decorate_ntips(tree):
     tree : TreeNode
 
     """
-    n_ranks = len(RANK_ORDER)
-    missing = [None] * n_ranks
+    ids, _ = _consensus_ids(tree)
+    informative = iter((ids >= 0).any(axis=1).tolist())
 
     for node in tree.postorder(include_self=True):
         if node.is_tip():
-            node.NumTips = node.Consensus != missing
+            node.NumTips = next(informative)
         else:
             node.NumTips = sum(c.NumTips for c in node.children)
 
@@ -422,17 +1463,17 @@ def decorate_ntips_rank(tree):
     tree : TreeNode
 
     """
-    n_ranks = len(RANK_ORDER)
+    ids, _ = _consensus_ids(tree)
+    informative = iter((ids >= 0).astype(int))
 
     for node in tree.postorder(include_self=True):
-        counts = defaultdict(int)
-        for r in range(n_ranks):
-            if node.is_tip():
-                counts[r] = node.Consensus[r] is not None
-            else:
-                counts[r] = sum(c.NumTipsRank[r] for c in node.children)
-
-        node.NumTipsRank = counts
+        if node.is_tip():
+            node.NumTipsRank = next(informative)
+        else:
+            counts = zeros(ids.shape[1], dtype=int)
+            for c in node.children:
+                counts += c.NumTipsRank
+            node.NumTipsRank = counts
 
 
 def pick_names(tree):
@@ -488,6 +1529,34 @@ def f2measure(precision, recall):
                                ((2 ** 2 * precision) + recall))
 
 
+def score_pairs(score_f, precisions, recalls):
+    """Score each pair of a precision and a recall
+
+    score_f is a function of a precision and a recall, and is called with
+    each pair in turn. fmeasure, fpoint5measure and f2measure, and any
+    function with a true "vectorized" attribute, are instead called once
+    with the arrays.
+
+    Parameters
+    ----------
+    score_f : function
+        Scores a name at a node given its precision and recall
+    precisions : np.ndarray of float
+    recalls : np.ndarray of float
+
+    Returns
+    -------
+    np.ndarray of float
+        The score of each pair
+    """
+    if score_f in (fmeasure, fpoint5measure, f2measure) or \
+            getattr(score_f, 'vectorized', False):
+        return asarray(score_f(precisions, recalls), dtype=float)
+    if not len(precisions):
+        return asarray(precisions, dtype=float)
+    return vectorize(score_f, otypes=[float])(precisions, recalls)
+
+
 def min_tips(nodes):
     """For a list of nodes, return the node with the fewest tips
 
@@ -502,78 +1571,150 @@ def min_tips(nodes):
     return nodes[argmin(scores)]
 
 
+def _subtree_sizes(tree):
+    """The number of tips that descend from each node, by id
+
+    The tips are counted in one postorder traversal rather than taken from
+    TipStart and TipStop, which are left stale if the tree is modified
+    following load_tree.
+    """
+    sizes = {}
+    for node in tree.postorder(include_self=True):
+        if node.children:
+            sizes[id(node)] = sum(sizes[id(c)] for c in node.children)
+        else:
+            sizes[id(node)] = 1
+    return sizes
+
+
 def name_node_score_fold(tree, score_f=fmeasure, tiebreak_f=min_tips,
                          verbose=False):
     """Compute name scores for internal nodes, pick the 'best'
 
-    For this method, we traverse the tree once building up a dict of scores
-    for names and nodes, we can then pick the 'best' node out of the dict
-    to avoid horrible lookups in the tree
+    For this method, we traverse the tree once collecting the nodes, names
+    and scores into flat arrays, we can then pick the 'best' node for each
+    name with a grouped argmax to avoid horrible lookups in the tree
+
+    Parameters
+    ----------
+    tree : TreeNode
+    score_f : function, optional
+        Scores a name at a node given its precision and recall, see
+        score_pairs
+    tiebreak_f : function, optional
+        Given the nodes in descending order of score, with None in place of
+        the nodes not tied for the best score, returns the node to keep. The
+        default, min_tips, keeps the tied node with the fewest tips and,
+        between those, the last in postorder. This is resolved directly from
+        the subtree sizes, counted once for the whole tree
+    verbose : bool, optional
+
+    Returns
+    -------
+    dict
+        {rank: [(name, score)]}, the best score of each name
     """
 
     if verbose:
         print("Starting name_node_score_fold...")
 
-    name_node_score = {i: {} for i in range(len(RANK_ORDER))}
     n_ranks = len(RANK_ORDER)
 
+    # flat arrays over the (node, name) pairs, nodes in postorder
+    nodes = []
+    pair_nodes = []
+    pair_ranks = []
+    pair_groups = []
+    precisions = []
+    recalls = []
+    groups = {}
+    group_keys = []
     for node in tree.non_tips(include_self=True):
         node.RankNameScores = [None] * n_ranks
+        node_idx = len(nodes)
+        nodes.append(node)
 
         for rank, name in enumerate(node.RankNames):
             if name is None:
                 continue
 
+            key = (rank, name)
+            group = groups.get(key)
+            if group is None:
+                group = groups[key] = len(group_keys)
+                group_keys.append(key)
+
+            pair_nodes.append(node_idx)
+            pair_ranks.append(rank)
+            pair_groups.append(group)
+
             # precision in this case is the percent of informative tips that
             # descend that are of the name relative to the number of
             # informative tips that descend
-            precision = node.ValidRelFreq[rank][name]
+            precisions.append(node.ValidRelFreq[rank][name])
 
             # recall in this case is the percent of informative tips that
             # descent that are of the name relative to the total number of
             # tips in the tree with name
-            recall = node.ConsensusRelFreq[rank][name]
-
-            # calculate score and save it for the corrisponding rank position
-            # so that these values can be examined later in other contexts
-            score = score_f(precision, recall)
-            node.RankNameScores[rank] = score
-
-            if name not in name_node_score[rank]:
-                name_node_score[rank][name] = []
-            name_node_score[rank][name].append((node, score))
-
-    # run through the built up dict and pick the best node for a name
-    used_scores = {}
-    for rank, names in name_node_score.items():
-        used_scores[rank] = []
-
-        for name, node_scores in names.items():
-            node_scores_sorted = sorted(node_scores, key=itemgetter(1))[::-1]
-            nodes, scores = unzip(node_scores_sorted)
-            scores = array(scores)
-
-            used_scores[rank].append((name, scores[0]))
-
-            # if there is a tie in scores...
-            if sum(scores == scores[0]) > 1:
-                # ugly hack to get around weird shape mismatch
-                indices = where(scores == scores[0], range(len(nodes)), None)
-                tie_nodes = []
-                for i in indices:
-                    if i is not None:
-                        tie_nodes.append(nodes[i])
-                    else:
-                        tie_nodes.append(None)
-                node_to_keep = tiebreak_f(tie_nodes)
-                for node, score in node_scores_sorted:
-                    if node == node_to_keep:
-                        continue
-                    else:
-                        node.RankNames[rank] = None
-            else:
-                for node, score in node_scores_sorted[1:]:
-                    node.RankNames[rank] = None
+            recalls.append(node.ConsensusRelFreq[rank][name])
+
+    used_scores = {rank: [] for rank in range(n_ranks)}
+    if not group_keys:
+        return used_scores
+
+    pair_nodes = array(pair_nodes, dtype=int64)
+    pair_groups = array(pair_groups, dtype=int64)
+    scores = score_pairs(score_f, array(precisions, dtype=float),
+                         array(recalls, dtype=float))
+
+    # save the score for the corrisponding rank position so that these values
+    # can be examined later in other contexts
+    for node_idx, rank, score in zip(pair_nodes.tolist(), pair_ranks,
+                                     scores.tolist()):
+        nodes[node_idx].RankNameScores[rank] = score
+
+    # order the pairs of each group by descending score. Within a score,
+    # the default tiebreak favors the fewest tips and then the last node in
+    # postorder
+    if tiebreak_f is min_tips:
+        sizes = _subtree_sizes(tree)
+        ntips = array([sizes[id(n)] for n in nodes], dtype=int64)[pair_nodes]
+    else:
+        ntips = zeros(len(pair_nodes), dtype=int64)
+    order = lexsort((-pair_nodes, ntips, -scores, pair_groups))
+    sorted_groups = pair_groups[order]
+    starts = flatnonzero(concatenate(([True], sorted_groups[1:] !=
+                                      sorted_groups[:-1])))
+    best_scores = scores[order[starts]]
+
+    keep = order[starts]
+    if tiebreak_f is not min_tips:
+        # ties, the groups whose best score is shared by multiple nodes
+        sorted_scores = scores[order]
+        ends = concatenate((starts[1:], [len(order)]))
+        for i, (start, end) in enumerate(zip(starts.tolist(),
+                                             ends.tolist())):
+            n_tied = int((sorted_scores[start:end] == best_scores[i]).sum())
+            if n_tied == 1:
+                continue
+            tie_nodes = [nodes[pair_nodes[j]] for j in order[start:end]]
+            tie_nodes = tie_nodes[:n_tied] + [None] * (end - start - n_tied)
+            node_to_keep = tiebreak_f(tie_nodes)
+            for j in order[start:end].tolist():
+                if nodes[pair_nodes[j]] is node_to_keep:
+                    keep[i] = j
+                    break
+
+    # run through the groups, only the best node keeps the name
+    kept = zeros(len(pair_nodes), dtype=bool)
+    kept[keep] = True
+    for node_idx, rank, is_kept in zip(pair_nodes.tolist(), pair_ranks,
+                                       kept.tolist()):
+        if not is_kept:
+            nodes[node_idx].RankNames[rank] = None
+
+    for (rank, name), score in zip(group_keys, best_scores.tolist()):
+        used_scores[rank].append((name, score))
 
     return used_scores
 
@@ -736,10 +1877,10 @@ def backfill_names_gap(tree, consensus_lookup, verbose=False):
         # this is indicative of a problem with the consensus strings
         if levels < 0:
             print(node.name, node.Rank, named_ancestor.Rank)
-            print('\t', node.RankSafe)
-            print('\t', node.RankNames)
-            print('\t', named_ancestor.RankSafe)
-            print('\t', named_ancestor.RankNames)
+            print('\t', getattr(node, 'RankSafe', None))
+            print('\t', getattr(node, 'RankNames', None))
+            print('\t', getattr(named_ancestor, 'RankSafe', None))
+            print('\t', getattr(named_ancestor, 'RankNames', None))
             node.BackFillNames = []
             continue
         elif levels == 1:
@@ -782,39 +1923,86 @@ def walk_consensus_tree(lookup, name, levels, reverse=True, verbose=False):
     return names
 
 
+def _secondary_lineages(secondary_taxonomy):
+    """The ranked lineage above each tip of a secondary taxonomy
+
+    Returns
+    -------
+    dict
+        {tip name: ((Rank, name), ...)}, the ranked ancestors of each tip
+        from the nearest upward. Tips with the same parent share the tuple
+    """
+    ranked = {}
+    lineages = {}
+    for node in secondary_taxonomy.preorder(include_self=True):
+        if node.is_root():
+            parent_lineage = ()
+        else:
+            parent_lineage = ranked[id(node.parent)]
+
+        rank = getattr(node, 'Rank', None)
+        if node.is_tip():
+            lineages[node.name] = parent_lineage
+        elif rank is None:
+            ranked[id(node)] = ()
+        else:
+            ranked[id(node)] = ((rank, node.name), ) + parent_lineage
+
+    return lineages
+
+
 def backfill_from_secondary(tree, secondary_taxonomy):
+    """Fill in the ranks below the decorated lineage of each tip
+
+    The most specified name of each tip, the deepest name over all of its
+    ancestors' BackFillNames, is tracked in a single preorder traversal.
+    The names at the deeper ranks are taken from the lineage of the tip in
+    the secondary taxonomy, and added to the BackFillNames of its parent.
+    Tips are visited in order, so a name added for one tip is seen by the
+    tips that follow it.
+    """
     # assumes backfill_names_gaps has already been run!
     assert hasattr(tree, 'BackFillNames')
 
-    in_taxonomy = {n.name for n in secondary_taxonomy.tips()}
-    for tip in tree.tips():
-        if tip.name not in in_taxonomy:
-            continue
+    lineages = _secondary_lineages(secondary_taxonomy)
 
-        # get present lineage
-        lineage = []
-        for a in tip.ancestors():
-            if a.BackFillNames:
-                lineage.extend(a.BackFillNames[::-1])
+    # each entry is a node, and the most specified name above its parent
+    stack = [(c, None) for c in tree.children[::-1]]
+    while stack:
+        node, inherited = stack.pop()
+        parent = node.parent
+        if parent.BackFillNames:
+            most_specified = parent.BackFillNames[-1]
+        else:
+            most_specified = inherited
 
-        most_specified = lineage[0]
-        if most_specified.startswith('s__'):
+        if not node.is_tip():
+            stack.extend([(c, most_specified) for c in node.children[::-1]])
             continue
 
-        most_specified_rank = RANK_ORDER.index(lineage[0][0])
+        lineage = lineages.get(node.name)
+        if lineage is None:
+            continue
+
+        if most_specified is None:
+            most_specified_rank = -1
+        elif most_specified.startswith('s__'):
+            continue
+        else:
+            most_specified_rank = RANK_ORDER.index(most_specified[0])
 
         # begin at species
-        node_in_taxonomy = secondary_taxonomy.find(tip.name).parent
         missing = []
-        while node_in_taxonomy.Rank > most_specified_rank:
-            missing.append(node_in_taxonomy.name)
-            node_in_taxonomy = node_in_taxonomy.parent
+        for rank, name in lineage:
+            if rank <= most_specified_rank:
+                break
+            missing.append(name)
 
         # the tip cannot have backfillnames, but its parent can
         # we extend in common order so, if the existing backfill
         # contained ['o1', 'f1'], we could extend ['g1', 's1] without
         # issue
-        tip.parent.BackFillNames.extend(missing[::-1])
+        parent.BackFillNames.extend(missing[::-1])
 
 
 # gtdb uses A-Z, t2t can use numbers or letters
@@ -917,7 +2105,7 @@ def correct_species_binomial(t):
         # find the genus label from the nearest ancestor of a node
         for a in n.ancestors():
             if a.name is not None and 'g__' in a.name:
-                names = a.name.split('; ')
+                names = label_names(a.name)
                 for name in names:
                     if name.startswith('g__'):
                         return name
@@ -926,7 +2114,7 @@ def correct_species_binomial(t):
 
     for node in t.postorder(include_self=False):
         if node.name is not None and 's__' in node.name:
-            names = node.name.split('; ')
+            names = list(label_names(node.name))
 
             # this would be super weird
             if not names[-1].startswith('s__'):
@@ -940,40 +2128,154 @@ def correct_species_binomial(t):
 
             corrected = normalize_species_binomial(genus_name, species_name)
             names[-1] = corrected
-            node.name = '; '.join(names)
+            node.name = TaxonLabel(names)
 
     return t
 
 
+# the frontier names of a node with no named descendants
+_NO_FRONTIER = ((), sys.maxsize)
+
+
+def _frontier_names(names):
+    """The frontier names of a single node with the given BackFillNames"""
+    return tuple(frozenset((n, )) for n in names), len(names)
+
+
+def _pop_frontier_names(names, popped):
+    """The frontier names once popped names are taken from each member"""
+    if not popped or not names[0]:
+        return names
+    return names[0][popped:], names[1] - popped
+
+
+def _merge_frontier_names(a, b):
+    """Merge the frontier names of two sets of nodes
+
+    Frontier names are a tuple of the distinct names found at each index of
+    the BackFillNames of the nodes, and the fewest BackFillNames of any of
+    the nodes. Only the indices below the fewest names are kept, and more
+    than three distinct names are never needed to tell that a name is not
+    unique.
+    """
+    if not a[0]:
+        return b
+    if not b[0]:
+        return a
+
+    fewest = min(a[1], b[1])
+    merged = []
+    for x, y in zip(a[0][:fewest], b[0][:fewest]):
+        if x is y or x == y:
+            merged.append(x)
+        else:
+            z = x | y
+            if len(z) > 3:
+                z = frozenset(list(z)[:3])
+            merged.append(z)
+    return tuple(merged), fewest
+
+
+def _current_frontier_names(node, popped, cache):
+    """The frontier names of node once popped names are taken from each
+
+    cache holds, for every unvisited non-tip node, its frontier names and
+    the number of names that had been popped from each member of its
+    frontier when they were computed. Cached frontier names remain valid
+    while no member has had all of its names popped, otherwise they are
+    recomputed from the children.
+    """
+    names, base = cache[id(node)]
+    if popped - base < names[1]:
+        return _pop_frontier_names(names, popped - base)
+
+    stack = [[node, popped, iter(node.children), _NO_FRONTIER]]
+    while True:
+        frame = stack[-1]
+        for c in frame[2]:
+            if c.is_tip():
+                continue
+
+            n_names = len(c.BackFillNames)
+            if n_names > frame[1]:
+                child = _frontier_names(c.BackFillNames[frame[1]:])
+            else:
+                child_popped = frame[1] - n_names
+                names, base = cache[id(c)]
+                if child_popped - base >= names[1]:
+                    stack.append([c, child_popped, iter(c.children),
+                                  _NO_FRONTIER])
+                    break
+                child = _pop_frontier_names(names, child_popped - base)
+            frame[3] = _merge_frontier_names(frame[3], child)
+        else:
+            stack.pop()
+            cache[id(frame[0])] = (frame[3], frame[1])
+            if not stack:
+                return frame[3]
+            stack[-1][3] = _merge_frontier_names(stack[-1][3], frame[3])
+
+
 def commonname_promotion(tree):
-    """Promote names if possible from BackFillNames"""
-    for node in tree.preorder(include_self=True):
-        queue = [c for c in node.children[:] if not c.is_tip()]
-        backfill_nodes = []
-        push_name = True
-
-        # collect nearest descendants backfilled names
-        while queue:
-            curr = queue.pop()
-            if len(curr.BackFillNames) == 0:
-                queue.extend([c for c in curr.children[:] if not c.is_tip()])
+    """Promote names if possible from BackFillNames
+
+    Rather than collecting the nearest named descendants, the frontier, of
+    every node, the distinct names at each index of their BackFillNames are
+    merged in a single postorder traversal. Every member of the frontier of
+    a node has the same number of names popped by a promotion, which is
+    passed down in preorder and applied when the member is visited. Only a
+    member left without names changes the frontier, in which case the
+    frontier names are recomputed below the node visited.
+    """
+    # frontier names of each non-tip node, and the names popped since
+    cache = {}
+    for node in tree.postorder(include_self=True):
+        if node.is_tip():
+            continue
+
+        names = _NO_FRONTIER
+        for c in node.children:
+            if c.is_tip():
+                continue
+            if c.BackFillNames:
+                names = _merge_frontier_names(
+                    names, _frontier_names(c.BackFillNames))
             else:
-                backfill_nodes.append(curr)
+                names = _merge_frontier_names(names, cache[id(c)][0])
+        cache[id(node)] = (names, 0)
+
+    # names popped from each node by the promotions of its ancestors
+    popped = {id(tree): 0}
+    for node in tree.preorder(include_self=True):
+        if node.is_tip():
+            continue
+
+        # a node loses its own names first, and the rest are popped from
+        # its frontier as it had none left
+        pops = popped.pop(id(node))
+        own = min(pops, len(node.BackFillNames))
+        del node.BackFillNames[:own]
+        pops -= own
+
+        frontier, fewest = _current_frontier_names(node, pops, cache)
+        del cache[id(node)]
 
         # see if there is 100% overlap in a name at a given rank, if so
         # we can and should put it on the deeper node
-        while push_name:
-            cur_name = [n.BackFillNames[0] for n in backfill_nodes]
-            cur_name_unique = polyphyletic_unique(cur_name)
-            if len(cur_name_unique) == 1:
-                node.BackFillNames.append(list(cur_name_unique)[0])
-
-                for n in backfill_nodes:
-                    n.BackFillNames.pop(0)
-                    if len(n.BackFillNames) <= 1:
-                        push_name = False
-            else:
-                push_name = False
+        promoted = 0
+        while promoted < len(frontier):
+            cur_name_unique = polyphyletic_unique(frontier[promoted])
+            if len(cur_name_unique) != 1:
+                break
+
+            node.BackFillNames.append(list(cur_name_unique)[0])
+            promoted += 1
+            if fewest - promoted <= 1:
+                break
+
+        for c in node.children:
+            if not c.is_tip():
+                popped[id(c)] = pops + promoted
 
     # set the .name attribute on the tree based on .BackFillNames
     for node in tree.preorder(include_self=True):
@@ -985,51 +2287,157 @@ def commonname_promotion(tree):
             for name in node.BackFillNames:
                 unique.append(TaxaName.getTaxaName(name))
             node.BackFillNames = unique
-        if len(node.BackFillNames) > 1:
-            node.name = '; '.join(node.BackFillNames)
-        elif len(node.BackFillNames) == 1:
-            node.name = TaxaName.getTaxaName(node.BackFillNames[0])
+        if node.BackFillNames:
+            node.name = TaxonLabel(node.BackFillNames)
         else:
             node.name = None
 
 
-def _named_siblings(node):
-    """Traverse the clade that node spans and return first named nodes
+class DistanceIndex(object):
+    """Patristic distances between the nodes of a tree in constant time
 
-    Identify all nearest named descendents of node
+    The distance of every node from the root is held in preorder, and the
+    lowest common ancestor of two nodes is the parent of the shallowest node
+    strictly after the first of them in preorder, up to and including the
+    second. That node is found with a sparse table of range minimums over
+    the node depths, so the distance between two nodes is three lookups. A
+    missing branch length is taken as zero.
     """
-    # assumes .id is set
-    # get first named ancestor
-    ancestor = None
-    for a in node.ancestors():
-        if a.name is not None and '__' in a.name:
-            ancestor = a
-            break
-
-        # worst case we use root
-        if a.parent is None:
-            ancestor = a
-            break
+    def __init__(self, tree):
+        """Initialize the index.
+
+        Parameters
+        ----------
+        tree : TreeNode
+            The tree, which must not be modified while the index is in use
+        """
+        nodes = list(tree.preorder(include_self=True))
+        self._index = {id(n): i for i, n in enumerate(nodes)}
+
+        n_nodes = len(nodes)
+        parents = zeros(n_nodes, dtype=int64)
+        depths = zeros(n_nodes, dtype=int64)
+        lengths = zeros(n_nodes, dtype=float)
+        for i, node in enumerate(nodes[1:], 1):
+            parent = self._index[id(node.parent)]
+            parents[i] = parent
+            depths[i] = depths[parent] + 1
+            lengths[i] = lengths[parent] + (node.length or 0.0)
+
+        self._parents = parents
+        self._depths = depths
+        self._root_distances = lengths
+
+        # table[k][i] is the shallowest node in preorder i to i + 2 ** k - 1
+        # where that range is within the tree
+        table = [arange(n_nodes, dtype=int64)]
+        span = 1
+        while span * 2 <= n_nodes:
+            prev = table[-1]
+            left = prev[:-span]
+            right = prev[span:]
+            table.append(where(depths[right] < depths[left], right, left))
+            span *= 2
+        self._table = table
+
+    def _lca(self, i, j):
+        """The lowest common ancestor of arrays of node positions"""
+        lo = minimum(i, j)
+        hi = maximum(i, j)
+        lca = lo.copy()
+
+        # when the nodes differ, the lowest common ancestor is the parent of
+        # the shallowest node in (lo, hi]
+        differ = flatnonzero(lo != hi)
+        lo = lo[differ] + 1
+        hi = hi[differ]
+        levels = frexp(hi - lo + 1)[1] - 1
+        for level in unique(levels).tolist():
+            mask = levels == level
+            table = self._table[level]
+            left = table[lo[mask]]
+            right = table[hi[mask] - (1 << level) + 1]
+            shallowest = where(self._depths[right] < self._depths[left],
+                               right, left)
+            lca[differ[mask]] = self._parents[shallowest]
+        return lca
+
+    def distances(self, node, others):
+        """The patristic distances from a node to each of the other nodes
+
+        Parameters
+        ----------
+        node : TreeNode
+            A node of the indexed tree
+        others : list of TreeNode
+            Nodes of the indexed tree
+
+        Returns
+        -------
+        np.ndarray of float
+            The distances, in the order of others
+        """
+        i = self._index[id(node)]
+        js = array([self._index[id(o)] for o in others], dtype=int64)
+        lca = self._lca(full(len(js), i, dtype=int64), js)
+        dists = self._root_distances
+        return dists[i] + dists[js] - 2 * dists[lca]
+
+
+def _named_node(node):
+    """Whether a node carries a taxonomic name"""
+    return node.name is not None and '__' in node.name
+
+
+def _named_groups(tree):
+    """Group named nodes by their first named ancestor
 
-    # find named descendents
-    marked_nodes = set()
-    named_sib = []
-    for desc in ancestor.preorder(include_self=False):
-        if desc is node:
-            marked_nodes.add(desc.id)
-            marked_nodes.update({c.id for c in desc.children})
+    Returns
+    -------
+    dict
+        {id(node): [named nodes]}, for every named node other than the root,
+        the named nodes in preorder that share its first named ancestor (or
+        the root, if there is no named ancestor), including itself
+    """
+    below = {}
+    groups = {}
+    for node in tree.preorder(include_self=True):
+        if node.parent is None:
+            below[id(node)] = []
             continue
 
-        if desc.id in marked_nodes:
-            marked_nodes.update({c.id for c in desc.children})
-            continue
+        group = below[id(node.parent)]
+        if _named_node(node):
+            group.append(node)
+            groups[id(node)] = group
+            below[id(node)] = []
+        else:
+            below[id(node)] = group
+    return groups
 
-        if desc.name is not None and '__' in desc.name:
-            named_sib.append(desc)
-            marked_nodes.add(desc.id)
-            marked_nodes.update({c.id for c in desc.children})
 
-    return named_sib
+def _named_siblings(node, groups=None):
+    """Return the first named nodes in the clade that node spans
+
+    Identify all nearest named descendents of the first named ancestor of
+    node, or of the root if there is none, other than node itself.
+
+    Parameters
+    ----------
+    node : TreeNode
+        A named node
+    groups : dict, optional
+        The result of _named_groups for the tree of node. If not provided, it
+        is computed
+
+    Returns
+    -------
+    list of TreeNode
+        The named siblings in preorder
+    """
+    if groups is None:
+        groups = _named_groups(node.root())
+    return [n for n in groups.get(id(node), []) if n is not node]
 
 
 def recover_from_polyphyletic_sibling(t, verbose=False):
@@ -1038,15 +2446,12 @@ def recover_from_polyphyletic_sibling(t, verbose=False):
     We only recover if there is a single polyphyletic name, we cannot
     recover if there are multiple
     """
-    def named_node(n):
-        return n.name is not None and '__' in n.name
-
     # get all tree names
     t.assign_ids()
     t_names = {}
     for n in t.traverse(include_self=True):
-        if named_node(n):
-            t_names[n.id] = n.name.split('; ')
+        if _named_node(n):
+            t_names[n.id] = list(label_names(n.name))
 
     # map poly to non-poly name
     non_poly_names = {}
@@ -1059,9 +2464,11 @@ def recover_from_polyphyletic_sibling(t, verbose=False):
                 non_poly_names[name] = base
                 has_poly_name.add(base)
 
+    groups = None
+    distances = None
     for node in t.traverse(include_self=True):
         # if we have a valid named node
-        if named_node(node):
+        if _named_node(node):
             # get our already split names
             names = t_names[node.id]
 
@@ -1071,14 +2478,21 @@ def recover_from_polyphyletic_sibling(t, verbose=False):
             # with it
             for i, name in enumerate(names[:]):
                 if name in has_poly_name:
+                    if groups is None:
+                        groups = _named_groups(t)
+                        distances = DistanceIndex(t)
+
                     sib_matches = []  # the actual matched names
-                    for sibling in _named_siblings(node):
-                        for sibname in sibling.name.split('; '):
+                    siblings = []
+                    for sibling in _named_siblings(node, groups):
+                        for sibname in label_names(sibling.name):
                             if sibname in non_poly_names and name in sibname:
-                                dist = node.distance(sibling)
-                                sib_matches.append((dist, sibname))
+                                siblings.append(sibling)
+                                sib_matches.append(sibname)
 
                     if len(sib_matches) > 0:
+                        dists = distances.distances(node, siblings).tolist()
+                        sib_matches = list(zip(dists, sib_matches))
                         best_dist, best_name = sorted(sib_matches)[0]
                         if verbose:
                             print("mapping (node id: %d; %f) %s -> %s" % (node.id,  # noqa
@@ -1091,7 +2505,7 @@ def recover_from_polyphyletic_sibling(t, verbose=False):
     # update names on the tree
     for n in t.traverse(include_self=True):
         if n.id in t_names:
-            n.name = '; '.join(t_names[n.id])
+            n.name = TaxonLabel(t_names[n.id])
 
     return t
 
@@ -1123,7 +2537,7 @@ def make_names_unique(tree, suffix_glue_char='_',
         if node.name is None:
             continue
         else:
-            for idx, name in enumerate(node.name.split('; ')):
+            for idx, name in enumerate(label_names(node.name)):
                 if name not in name_lookup:
                     name_lookup[name] = []
                 name_lookup[name].append(node.id)
@@ -1132,67 +2546,128 @@ def make_names_unique(tree, suffix_glue_char='_',
     for node in tree.non_tips(include_self=True):
         if node.name is not None:
             new_name = []
-            for name in node.name.split('; '):
+            for name in label_names(node.name):
                 if name in make_unique:
                     name = f'{name}_{node.id}'
                 new_name.append(name)
-            node.name = '; '.join(new_name)
+            node.name = TaxonLabel(new_name)
 
 
-def pull_consensus_strings(tree, verbose=False, append_prefix=True, as_tree=False):
-    """Pulls consensus strings off of tree
+def iter_consensus_strings(tree, append_prefix=True, as_tree=False,
+                           as_pairs=False):
+    """Yields the consensus string of each tip, in tip order
 
-    assumes .name is set
-    """
-    if verbose:
-        print("Pulling consensus strings...")
+    The lineages are propagated from the root in a single preorder
+    traversal, where the name of a node at a rank holds unless an ancestor
+    has a name at that rank. The consensus string is formed once for each
+    node with tips as children, and is shared by those tips.
 
-    constrings = []
+    Parameters
+    ----------
+    tree : TreeNode
+    append_prefix : bool, optional
+        Whether a missing name is given as its rank prefix, e.g. "g__"
+    as_tree : bool, optional
+        Yield (tip name, consensus list) rather than a line of text
+    as_pairs : bool, optional
+        Yield (tip name, consensus string) rather than a line of text. The
+        consensus string is shared by sibling tips
+
+    Returns
+    -------
+    generator
+        The "tip name\tconsensus string" lines, or the (tip name, consensus
+        list) pairs if as_tree, or (tip name, consensus string) if as_pairs
+    """
     rank_order_rev = {r: i for i, r in enumerate(RANK_ORDER)}
-    # start at the tip and travel up
-    for tip in tree.tips():
-        if append_prefix:
-            consensus_string = ['%s__' % r for r in RANK_ORDER]
-        else:
-            consensus_string = ['' for r in RANK_ORDER]
+    if append_prefix:
+        missing = ['%s__' % r for r in RANK_ORDER]
+    else:
+        missing = ['' for r in RANK_ORDER]
 
-        tipid = tip.name
-        n = tip.parent
+    if tree.is_tip():
+        return
 
-        # walk up the tree filling in the consensus string
-        while n.parent:
-            if n.name:
-                if ';' in n.name:
-                    names = [r.strip() for r in n.name.split(';')]
-                    for name in names:
-                        rank_idx = rank_order_rev[name[0]]
-                        consensus_string[rank_idx] = name
-                else:
-                    rank_idx = rank_order_rev[n.name[0]]
-                    consensus_string[rank_idx] = n.name
-            n = n.parent
+    stack = [(tree, [None] * len(RANK_ORDER))]
+    while stack:
+        node, lineage = stack.pop()
+        if node.is_tip():
+            # the consensus string was formed by the parent
+            if as_tree:
+                yield (node.name, lineage[:])
+            elif as_pairs:
+                yield (node.name, lineage)
+            else:
+                yield '\t'.join([node.name, lineage])
+            continue
 
-        # if there is a name at the root we need to make sure we grab it
-        if n.name:
-            if ';' in n.name:
-                names = [r.strip() for r in n.name.split(';')]
-                for name in names:
-                    rank_idx = rank_order_rev[name[0]]
-                    consensus_string[rank_idx] = name
+        name = node.name
+        if name:
+            if isinstance(name, TaxonLabel):
+                # a bootstrap held by the label is not a taxon name
+                node_names = name.names
+            elif ';' in name:
+                node_names = [r.strip() for r in name.split(';')]
             else:
-                rank_idx = rank_order_rev[n.name[0]]
-                consensus_string[rank_idx] = n.name
+                node_names = [name]
+
+            # the names of ancestors take precedence
+            lineage = lineage[:]
+            assigned = {}
+            for node_name in node_names:
+                assigned[rank_order_rev[node_name[0]]] = node_name
+            for rank_idx, node_name in assigned.items():
+                if lineage[rank_idx] is None:
+                    lineage[rank_idx] = node_name
+
+        consensus_string = None
+        for child in node.children[::-1]:
+            if not child.is_tip():
+                stack.append((child, lineage))
+                continue
 
-        # join strings with tip id
-        if as_tree:
-            constrings.append((tipid, consensus_string))
-        else:
-            constrings.append('\t'.join([tipid, '; '.join(consensus_string)]))
+            if consensus_string is None:
+                consensus_string = [m if n is None else n
+                                    for n, m in zip(lineage, missing)]
+                if not as_tree:
+                    consensus_string = '; '.join(consensus_string)
+            stack.append((child, consensus_string))
 
+
+def pull_consensus_strings(tree, verbose=False, append_prefix=True, as_tree=False):
+    """Pulls consensus strings off of tree
+
+    assumes .name is set
+    """
+    if verbose:
+        print("Pulling consensus strings...")
+
+    constrings = iter_consensus_strings(tree, append_prefix=append_prefix,
+                                        as_tree=as_tree)
     if as_tree:
         return TreeNode.from_taxonomy(constrings)
     else:
-        return constrings
+        return list(constrings)
+
+
+def write_consensus_strings(constrings, fp):
+    """Write consensus strings as they are produced, one per line
+
+    Parameters
+    ----------
+    constrings : iterable of str
+        The consensus strings, e.g. from iter_consensus_strings
+    fp : file-like
+        The file to write to. As with joining the strings, there is no
+        newline after the last one
+    """
+    lines = iter(constrings)
+    for line in lines:
+        fp.write(line)
+        break
+    for line in lines:
+        fp.write('\n')
+        fp.write(line)
 
 
 def save_bootstraps(tree, verbose=False):
@@ -1202,12 +2677,9 @@ def save_bootstraps(tree, verbose=False):
     for n in tree.non_tips(include_self=True):
         if n.Bootstrap is not None:
             if n.name is None:
-                n.name = str(n.Bootstrap)
+                n.name = TaxonLabel((), n.Bootstrap)
             else:
-                if ';' in n.name:
-                    n.name = ':'.join([str(n.Bootstrap), "%s" % n.name])
-                else:
-                    n.name = ':'.join([str(n.Bootstrap), n.name])
+                n.name = TaxonLabel(label_names(n.name), n.Bootstrap)
 
 
 def getpath(foo):
@@ -1243,7 +2715,9 @@ def validate_all_paths(tree):
         path = []
         n = n.parent
         while n.parent:
-            if n.name is not None:
+            if isinstance(n.name, TaxonLabel):
+                path.extend(n.name.names[::-1])
+            elif n.name is not None:
                 if ':' in n.name:
                     names = n.name.split(':', 1)
                     if not is_float(names[1]):
@@ -1252,7 +2726,9 @@ def validate_all_paths(tree):
                     if not is_float(n.name):
                         path.append(n.name)
             n = n.parent
-        if n.name is not None:
+        if isinstance(n.name, TaxonLabel):
+            path.extend(n.name.names[::-1])
+        elif n.name is not None:
             path.append(n.name)
 
         clean_path = []
@@ -0,0 +1,1069 @@
+#!/usr/bin/env python
+
+"""The stages of t2t decorate as a pipeline
+
+DecoratePipeline runs the decoration as a sequence of named stages, and
+records the wall time, CPU time and, optionally, the memory use and the size
+of the tree following each stage.
+
+The state following the scoring stages and backfill_names_gap can be saved
+as a checkpoint, from which later runs can resume to only redo the post
+processing stages.
+
+The state of the scoring stages themselves can be saved as well, from which
+later runs can update the taxonomy of the tips, or place new tips on the
+tree, and only score again the names affected.
+
+DecorateBatch decorates one tree with several consensus maps, loading the
+tree and indexing its topology only once.
+"""
+
+import copy
+import json
+import time
+import tracemalloc
+from contextlib import contextmanager
+from io import StringIO
+from multiprocessing import Pool
+
+import bp
+import numpy as np
+import skbio
+
+import t2t.nlevel as nl
+import t2t.decorate as dec
+import t2t.util as ut
+
+__author__ = "Daniel McDonald"
+__copyright__ = "Copyright 2011, The tax2tree project"
+__credits__ = ["Daniel McDonald"]
+__license__ = "BSD"
+__version__ = "1.0"
+__maintainer__ = "Daniel McDonald"
+__email__ = "mcdonadt@colorado.edu"
+__status__ = "Development"
+
+
+class DecoratePipeline(object):
+    """Decorate a taxonomy onto a tree as a sequence of named stages
+
+    Parameters
+    ----------
+    consensus_map : file-like or str
+        The consensus map, tab delimited id and taxonomy string, optionally
+        compressed, see t2t.nlevel.open_consensus_map. May be None if
+        resuming
+    tree : file-like, optional
+        The newick tree to decorate. Mutually exclusive with placement
+    placement : str, optional
+        The path to jplace data to source the tree from. Mutually exclusive
+        with tree
+    min_count : int, optional
+        The minimum number of times a name needs to be represented
+    add_nameholder : bool, optional
+        Add nameholder nodes to the tree, always done for placements
+    secondary_taxonomy : file-like or str, optional
+        A consensus map for backfilling with a secondary taxonomic system,
+        optionally compressed
+    recover_polyphyletic : bool, optional
+        Attempt to map ambiguous to unambiguous polyphyletic names
+    correct_binomials : bool, optional
+        Attempt to correct species binomials
+    no_suffix : bool, optional
+        Do not append suffixes to polyphyletic groups
+    suffix_char : str, optional
+        The character to glue polyphyletic group suffixes with
+    save_bootstraps : bool, optional
+        Retain bootstrap values on the decorated tree
+    profile : bool, optional
+        Trace the memory used by each stage and count the nodes and names of
+        the tree following each stage. This adds to the runtime. Memory
+        tracing spans the stages, from the first through write
+    checkpoint : str, optional
+        Write a checkpoint to this path following backfill_names_gap
+    resume : str, optional
+        Resume from the checkpoint at this path rather than loading and
+        scoring the tree. Mutually exclusive with tree and placement
+    jobs : int, optional
+        The number of processes to score ranks and large clades with
+    save_state : str, optional
+        Write the state of the scoring stages to this path, for use with
+        update_state
+    update_state : str, optional
+        Update the state at this path to the taxonomy of the consensus map,
+        and place the tips of insertions on its tree, rescoring only the
+        names affected rather than loading and scoring the tree. Mutually
+        exclusive with tree, placement and resume
+    insertions : file-like, optional
+        The tips to place with update_state, tab delimited new tip id,
+        existing tip id to place it next to and, optionally, its length
+    topology : t2t.decorate.Topology, optional
+        The indexed topology of a tree which has already been loaded, to
+        decorate rather than loading a tree. Mutually exclusive with tree,
+        placement, resume and update_state
+
+    Attributes
+    ----------
+    stats : list of dict
+        The measurements of each stage that has run, see report
+    """
+
+    def __init__(self, consensus_map, tree=None, placement=None, min_count=2,
+                 add_nameholder=False, secondary_taxonomy=None,
+                 recover_polyphyletic=False, correct_binomials=False,
+                 no_suffix=False, suffix_char='_', save_bootstraps=False,
+                 profile=False, checkpoint=None, resume=None, jobs=1,
+                 save_state=None, update_state=None, insertions=None,
+                 topology=None):
+        if topology is not None:
+            if tree is not None or placement is not None or \
+                    resume is not None or update_state is not None:
+                raise ValueError("Cannot specify a topology with --tree, "
+                                 "--placement, --resume or --update-state")
+            if consensus_map is None:
+                raise ValueError("Must specify --consensus-map")
+        elif update_state is not None:
+            if tree is not None or placement is not None or \
+                    resume is not None:
+                raise ValueError("Cannot specify --update-state with --tree, "
+                                 "--placement or --resume")
+            if consensus_map is None:
+                raise ValueError("Must specify --consensus-map")
+        elif insertions is not None:
+            raise ValueError("Cannot specify --insertions without "
+                             "--update-state")
+        elif resume is not None:
+            if tree is not None or placement is not None:
+                raise ValueError("Cannot specify --resume with --tree or "
+                                 "--placement")
+        else:
+            if tree is not None and placement is not None:
+                raise ValueError("Cannot specify --tree and --placement")
+            if tree is None and placement is None:
+                raise ValueError("Must specify --tree or --placement")
+            if consensus_map is None:
+                raise ValueError("Must specify --consensus-map")
+        if resume is not None and save_state is not None:
+            raise ValueError("Cannot specify --save-state with --resume")
+
+        self.consensus_map = consensus_map
+        self.tree_file = tree
+        self.placement_file = placement
+        self.min_count = min_count
+        self.add_nameholder = add_nameholder
+        self.secondary_taxonomy_file = secondary_taxonomy
+        self.recover_polyphyletic = recover_polyphyletic
+        self.correct_binomials = correct_binomials
+        self.no_suffix = no_suffix
+        self.suffix_char = suffix_char
+        self.save_bootstraps = save_bootstraps
+        self.profile = profile
+        self.checkpoint = checkpoint
+        self.resume = resume
+        self.jobs = jobs
+        self.save_state = save_state
+        self.update_state = update_state
+        self.insertions = insertions
+        self.topology = topology
+
+        self.stats = []
+        self._tracing = False
+        # the topology of the tree, indexed once for the consensus map and
+        # decorate
+        self._indexed = topology
+
+        self.tree = None if topology is None else topology.tree
+        self.placement = None
+        self.secondary_taxonomy = None
+        self.tipname_map = None
+        self.lineages = None
+        self.ranks = None
+        self.bootstraps = None
+        self.scores = None
+        self.contree = None
+        self.contree_lookup = None
+        self.constrings = None
+        self.state = None
+        self.changed_clades = None
+
+    def stages(self):
+        """The names of the stages to run, in order
+
+        Returns
+        -------
+        list of str
+        """
+        stages = []
+        if self.secondary_taxonomy_file is not None:
+            stages.append('load_secondary_taxonomy')
+        if self.resume is not None:
+            stages.extend(['resume', 'make_consensus_tree'])
+        else:
+            if self.update_state is not None:
+                stages.extend(['load_consensus_map', 'load_state',
+                               'relabel_tips'])
+                if self.insertions is not None:
+                    stages.append('insert_tips')
+            elif self.topology is not None:
+                stages.extend(['load_consensus_map', 'decorate'])
+            else:
+                stages.append('load_tree')
+                if self.placement_file is not None or self.add_nameholder:
+                    stages.append('add_nameholders')
+                stages.extend(['load_consensus_map', 'decorate'])
+            if self.save_state is not None:
+                stages.append('save_state')
+            stages.extend(['to_treenode', 'make_consensus_tree',
+                           'backfill_names_gap'])
+            if self.checkpoint is not None:
+                stages.append('checkpoint')
+        if self.secondary_taxonomy_file is not None:
+            stages.append('backfill_from_secondary')
+        stages.append('commonname_promotion')
+        if self.recover_polyphyletic:
+            stages.append('recover_from_polyphyletic_sibling')
+        stages.append('correct_decorated')
+        if not self.no_suffix:
+            stages.append('make_names_unique')
+        if self.correct_binomials:
+            stages.append('correct_species_binomial')
+        stages.append('pull_consensus_strings')
+        if self.save_bootstraps:
+            stages.append('save_bootstraps')
+        return stages
+
+    def run(self):
+        """Run all stages of the pipeline"""
+        for name in self.stages():
+            self._run_stage(name, getattr(self, '_' + name))
+
+    def write(self, output):
+        """Write the decorated tree, consensus strings and fmeasures
+
+        The writing is recorded as the stage "write". If profiling, memory
+        tracing started by the pipeline stops following this stage.
+
+        Parameters
+        ----------
+        output : str
+            The output basename
+        """
+        self._run_stage('write', lambda: self._write(output))
+        self._stop_tracing()
+
+    def report(self):
+        """Summarize the measurements of the stages that have run
+
+        Returns
+        -------
+        dict
+            "stages" holds, per stage, the "name", "wall_time" and
+            "cpu_time" in seconds and, if profiling, the traced "memory"
+            following the stage and the "peak_memory" during it in bytes,
+            and the number of "nodes" and "named_nodes" of the tree.
+            "wall_time" and "cpu_time" are the totals over the stages, and
+            "peak_memory" the maximum
+        """
+        result = {'stages': self.stats,
+                  'wall_time': sum(s['wall_time'] for s in self.stats),
+                  'cpu_time': sum(s['cpu_time'] for s in self.stats)}
+        if self.profile:
+            result['peak_memory'] = max([s.get('peak_memory', 0)
+                                         for s in self.stats] or [0])
+        return result
+
+    def write_report(self, fp):
+        """Write the report as JSON
+
+        Parameters
+        ----------
+        fp : file-like
+        """
+        json.dump(self.report(), fp, indent=2)
+        fp.write('\n')
+
+    def _run_stage(self, name, stage):
+        if self.profile:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._tracing = True
+            tracemalloc.reset_peak()
+
+        wall = time.time()
+        cpu = time.process_time()
+        try:
+            stage()
+        except Exception:
+            self._stop_tracing()
+            raise
+        finally:
+            stat = {'name': name,
+                    'wall_time': time.time() - wall,
+                    'cpu_time': time.process_time() - cpu}
+
+            if self.profile and tracemalloc.is_tracing():
+                stat['memory'], stat['peak_memory'] = \
+                    tracemalloc.get_traced_memory()
+                stat['nodes'], stat['named_nodes'] = self._tree_size()
+
+            self.stats.append(stat)
+
+    def _stop_tracing(self):
+        if self._tracing:
+            tracemalloc.stop()
+            self._tracing = False
+
+    def _tree_size(self):
+        """The number of nodes and named internal nodes of the tree
+
+        An internal node labelled only with a bootstrap is not named, so the
+        counts of the stages before and after load_tree compare.
+        """
+        tree = self.tree
+        if tree is None:
+            return None, None
+
+        if isinstance(tree, bp.BP):
+            opens = np.flatnonzero(tree.B)
+            internal = opens[tree.B[opens + 1] == 1]
+            named = sum(_is_named(tree.name(i)) for i in internal.tolist())
+            return len(opens), named
+
+        nodes = 0
+        named = 0
+        for node in tree.preorder(include_self=True):
+            nodes += 1
+            if node.children and _is_named(node.name):
+                named += 1
+        return nodes, named
+
+    def _load_secondary_taxonomy(self):
+        with _opened(self.secondary_taxonomy_file) as source:
+            secondary = nl.load_consensus_map(nl.open_consensus_map(source),
+                                              False)
+        secondary = skbio.TreeNode.from_taxonomy(list(secondary.items()))
+        for n in secondary.non_tips(include_self=False):
+            n.Rank = nl.RANK_ORDER.index(n.name[0])
+        self.secondary_taxonomy = secondary
+
+    def _load_tree(self):
+        if self.placement_file is not None:
+            with open(self.placement_file) as fp:
+                self.placement = json.loads(fp.read())
+            self.tree = ut.parse_tree(self.placement['tree'])
+        else:
+            self.tree = ut.read_tree(self.tree_file)
+
+    def _add_nameholders(self):
+        self.tree = dec.add_nameholders(self.tree)
+
+    def _load_consensus_map(self):
+        # the desired ranks are those of the first line of the consensus map,
+        # which is streamed so that it may be compressed or read from stdin.
+        # Only the records of the tips of the tree are retained, with the
+        # distinct lineages of the map from which the consensus tree is
+        # built. Inserting tips needs records of tips not yet on the tree,
+        # and a compiled map is memory mapped, so those are kept whole
+        with _opened(self.consensus_map) as source:
+            lines = nl.open_consensus_map(source)
+            if self.update_state is not None or \
+                    isinstance(lines, nl.CompiledTaxonomy):
+                self.tipname_map = nl.load_consensus_map(
+                    lines, False, detect_rank_order=True)
+                return
+
+            if self._indexed is None:
+                self._indexed = dec.Topology(self.tree)
+            tips = set(self._indexed.tip_names)
+
+            tipname_map = {}
+            lineages = {}
+            for chunk in nl.iter_consensus_map(lines, False,
+                                               detect_rank_order=True):
+                for id_, consensus in chunk:
+                    if id_ in tips:
+                        tipname_map[id_] = consensus
+                    lineages.setdefault(tuple(consensus), consensus)
+        self.tipname_map = tipname_map
+        self.lineages = list(lineages.values())
+
+    def _decorate(self):
+        # the scoring stages run on the balanced parentheses tree, a TreeNode
+        # is only constructed for the post processing stages
+        if self.save_state is None:
+            self.tree, self.ranks, self.bootstraps, self.scores = \
+                dec.decorate(self.tree, self.tipname_map, self.min_count,
+                             jobs=self.jobs, topology=self._indexed)
+        else:
+            (self.tree, self.ranks, self.bootstraps, self.scores,
+             self.state) = dec.decorate(self.tree, self.tipname_map,
+                                        self.min_count, jobs=self.jobs,
+                                        return_state=True,
+                                        topology=self._indexed)
+            self.state.nameholders = self.placement_file is not None or \
+                self.add_nameholder
+
+    def _load_state(self):
+        self.state, rank_order = read_state(self.update_state)
+        if rank_order != nl.RANK_ORDER:
+            raise ValueError("The ranks of the consensus map differ from "
+                             "those of the state")
+        if self.state.min_count != self.min_count:
+            raise ValueError("The state was scored with --min-count %d" %
+                             self.state.min_count)
+
+    def _relabel_tips(self):
+        (self.tree, self.ranks, self.bootstraps, self.scores), changed = \
+            self.state.relabel(self.tipname_map)
+
+        # the clades are identified by their first and last tips
+        tree = self.tree
+        self.changed_clades = []
+        for node, before, after in changed:
+            first = last = tree.preorderselect(node)
+            while not tree.isleaf(first):
+                first = tree.fchild(first)
+            while not tree.isleaf(last):
+                last = tree.lchild(last)
+            self.changed_clades.append((tree.name(first), tree.name(last),
+                                        before, after))
+
+    def _insert_tips(self):
+        insertions = []
+        for line in self.insertions:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            insertions.append(line.split('\t'))
+
+        self.tree, self.ranks, self.bootstraps, self.scores = \
+            self.state.insert(insertions, self.tipname_map)
+
+    def _save_state(self):
+        write_state(self.save_state, self.state)
+        self.state = None
+
+    def _to_treenode(self):
+        self.tree = dec.to_treenode(self.tree, self.ranks, self.bootstraps)
+        self.ranks = None
+        self.bootstraps = None
+
+    def _checkpoint(self):
+        write_checkpoint(self.checkpoint, self.tree, self.lineages,
+                         self.scores, self.placement)
+
+    def _resume(self):
+        (self.tree, self.lineages, self.scores, self.placement,
+         rank_order) = read_checkpoint(self.resume)
+        nl.set_rank_order(rank_order)
+
+    def _make_consensus_tree(self):
+        if self.lineages is None:
+            self.lineages = _distinct_lineages(self.tipname_map.values())
+        self.contree, self.contree_lookup = \
+            nl.make_consensus_tree(self.lineages)
+
+    def _backfill_names_gap(self):
+        nl.backfill_names_gap(self.tree, self.contree_lookup)
+
+    def _backfill_from_secondary(self):
+        nl.backfill_from_secondary(self.tree, self.secondary_taxonomy)
+
+    def _commonname_promotion(self):
+        nl.commonname_promotion(self.tree)
+
+    def _recover_from_polyphyletic_sibling(self):
+        self.tree = nl.recover_from_polyphyletic_sibling(self.tree,
+                                                         verbose=True)
+
+    def _correct_decorated(self):
+        nl.correct_decorated(self.tree, self.contree, verbose=True)
+
+    def _make_names_unique(self):
+        nl.make_names_unique(self.tree, suffix_glue_char=self.suffix_char)
+
+    def _correct_species_binomial(self):
+        self.tree = nl.correct_species_binomial(self.tree)
+
+    def _pull_consensus_strings(self):
+        # the lineages are propagated here, ahead of save_bootstraps, and
+        # each tip only holds the consensus string it shares with its
+        # siblings. The lines are joined as write streams them out
+        self.constrings = list(nl.iter_consensus_strings(self.tree,
+                                                         as_pairs=True))
+
+    def _save_bootstraps(self):
+        nl.save_bootstraps(self.tree)
+
+    def _write(self, output):
+        f = open(output + '-consensus-strings', 'w')
+        nl.write_consensus_strings(('\t'.join(p) for p in self.constrings),
+                                   f)
+        f.close()
+
+        ut.write_newick(self.tree, output)
+
+        f = open(output + '-fmeasures', 'w')
+        f.write('#taxon\tscore\n')
+        for rank in self.scores:
+            for name, score in sorted(self.scores[rank])[::-1]:
+                f.write("%s\t%f\n" % (name, score))
+        f.close()
+
+        if self.changed_clades is not None:
+            f = open(output + '-changed-clades', 'w')
+            f.write('#first tip\tlast tip\tbefore\tafter\n')
+            for clade in self.changed_clades:
+                f.write('\t'.join('' if x is None else x
+                                   for x in clade) + '\n')
+            f.close()
+
+        # replace the backbone tree with our decorated one
+        if self.placement is not None:
+            tree = self.tree
+            ut._edge_label(tree)
+            tree = bp.from_skbio_treenode(tree)
+            buf = StringIO()
+            bp.write_newick(tree, buf, include_edge=True)
+            buf.seek(0)
+            self.placement['tree'] = buf.read()
+            with open(output + '.jplace', 'w') as fp:
+                fp.write(json.dumps(self.placement))
+
+
+class DecorateBatch(object):
+    """Decorate one tree with each of several consensus maps
+
+    The tree is loaded, and its topology indexed, once. The stages which
+    depend on the taxonomy then run for each consensus map as its own
+    DecoratePipeline, writing its own set of outputs.
+
+    Parameters
+    ----------
+    consensus_maps : list of file-like or str
+        The consensus maps, tab delimited id and taxonomy string, optionally
+        compressed, see t2t.nlevel.open_consensus_map
+    tree : file-like, optional
+        The newick tree to decorate. Mutually exclusive with placement
+    placement : str, optional
+        The path to jplace data to source the tree from. Mutually exclusive
+        with tree
+    add_nameholder : bool, optional
+        Add nameholder nodes to the tree, always done for placements
+    secondary_taxonomy : file-like or str, optional
+        A consensus map for backfilling with a secondary taxonomic system,
+        optionally compressed, shared by all consensus maps
+    jobs : int, optional
+        The number of consensus maps to decorate at once, each in its own
+        process. With a single consensus map, the number of processes to
+        score it with
+    kwargs : dict
+        The remaining options of DecoratePipeline, applied to each consensus
+        map. checkpoint, resume, save_state, update_state and insertions are
+        not supported
+
+    Attributes
+    ----------
+    stats : list of dict
+        The measurements of the stages shared by the consensus maps
+    reports : list of dict
+        The report of the pipeline of each consensus map, see
+        DecoratePipeline.report
+    """
+
+    def __init__(self, consensus_maps, tree=None, placement=None,
+                 add_nameholder=False, secondary_taxonomy=None, jobs=1,
+                 **kwargs):
+        if tree is not None and placement is not None:
+            raise ValueError("Cannot specify --tree and --placement")
+        if tree is None and placement is None:
+            raise ValueError("Must specify --tree or --placement")
+        if not consensus_maps:
+            raise ValueError("Must specify --consensus-map")
+        for option in ('checkpoint', 'resume', 'save_state', 'update_state',
+                       'insertions'):
+            if kwargs.get(option) is not None:
+                raise ValueError("Cannot specify --%s with several "
+                                 "consensus maps" % option.replace('_', '-'))
+
+        self.consensus_maps = list(consensus_maps)
+        self.tree_file = tree
+        self.placement_file = placement
+        self.add_nameholder = add_nameholder
+        self.secondary_taxonomy_file = secondary_taxonomy
+        self.jobs = jobs
+        self.options = kwargs
+
+        self.stats = []
+        self.reports = []
+
+        self.tree = None
+        self.topology = None
+        self.placement = None
+        self.secondary = None
+
+    def run(self, outputs):
+        """Decorate with each consensus map and write its outputs
+
+        Parameters
+        ----------
+        outputs : list of str
+            The output basename of each consensus map
+        """
+        if len(outputs) != len(self.consensus_maps):
+            raise ValueError("Expected an output for each consensus map")
+
+        self._run_stage('load_tree', self._load_tree)
+        self._run_stage('index_topology', self._index_topology)
+        if self.secondary_taxonomy_file is not None:
+            # read once, and given to each consensus map anew
+            with _opened(self.secondary_taxonomy_file) as source:
+                secondary = nl.open_consensus_map(source)
+                if not isinstance(secondary, nl.CompiledTaxonomy):
+                    secondary = secondary.read()
+            self.secondary = secondary
+
+        global _BATCH
+        n_maps = len(self.consensus_maps)
+        if self.jobs > 1 and n_maps > 1:
+            _BATCH = (self, outputs)
+            try:
+                pool = Pool(min(self.jobs, n_maps))
+                try:
+                    self.reports = pool.map(_decorate_map, range(n_maps))
+                finally:
+                    pool.close()
+                    pool.join()
+            finally:
+                _BATCH = None
+        else:
+            self.reports = [self._decorate_map(i, outputs[i], self.jobs)
+                            for i in range(n_maps)]
+
+    def report(self):
+        """Summarize the measurements of the shared stages and of each map
+
+        Returns
+        -------
+        dict
+            "stages" holds the measurements of the shared stages, and "maps"
+            the report of each consensus map. "wall_time" and "cpu_time" are
+            the totals over both, and so exceed the elapsed time if the
+            consensus maps were decorated at once
+        """
+        stats = self.stats + [r for report in self.reports
+                              for r in report['stages']]
+        return {'stages': self.stats,
+                'maps': self.reports,
+                'wall_time': sum(s['wall_time'] for s in stats),
+                'cpu_time': sum(s['cpu_time'] for s in stats)}
+
+    def write_report(self, fp):
+        """Write the report as JSON
+
+        Parameters
+        ----------
+        fp : file-like
+        """
+        json.dump(self.report(), fp, indent=2)
+        fp.write('\n')
+
+    def _run_stage(self, name, stage):
+        wall = time.time()
+        cpu = time.process_time()
+        stage()
+        self.stats.append({'name': name,
+                           'wall_time': time.time() - wall,
+                           'cpu_time': time.process_time() - cpu})
+
+    def _load_tree(self):
+        if self.placement_file is not None:
+            with open(self.placement_file) as fp:
+                self.placement = json.loads(fp.read())
+            tree = ut.parse_tree(self.placement['tree'])
+        else:
+            tree = ut.read_tree(self.tree_file)
+
+        if self.placement_file is not None or self.add_nameholder:
+            tree = dec.add_nameholders(tree)
+        self.tree = tree
+
+    def _index_topology(self):
+        self.topology = dec.Topology(self.tree)
+
+    def _decorate_map(self, index, output, jobs):
+        secondary = self.secondary
+        if isinstance(secondary, str):
+            secondary = StringIO(secondary)
+
+        pipeline = DecoratePipeline(self.consensus_maps[index],
+                                    secondary_taxonomy=secondary, jobs=jobs,
+                                    topology=self.topology, **self.options)
+        pipeline.placement = copy.deepcopy(self.placement)
+        pipeline.run()
+        pipeline.write(output)
+        return pipeline.report()
+
+
+def _is_named(name):
+    """Whether a node name holds a taxon rather than only a bootstrap
+
+    As in t2t.nlevel.load_tree, a name which is a float is a bootstrap.
+    """
+    if name is None:
+        return False
+    try:
+        float(name)
+    except ValueError:
+        return True
+    return False
+
+
+@contextmanager
+def _opened(source):
+    """Open source in binary mode if it is a path, and close it on exit
+
+    Open files, and "-" for stdin, are given as is and left open.
+    """
+    if isinstance(source, str) and source != '-':
+        with open(source, 'rb') as fp:
+            yield fp
+    else:
+        yield source
+
+
+# the batch being decorated, inherited by the processes of DecorateBatch
+_BATCH = None
+
+
+def _decorate_map(index):
+    batch, outputs = _BATCH
+    return batch._decorate_map(index, outputs[index], 1)
+
+
+CHECKPOINT_VERSION = 2
+
+
+def _pack_strings(strings):
+    """Pack a list of str, or None, as arrays
+
+    Returns
+    -------
+    np.ndarray of uint8
+        The UTF-8 encoded strings, concatenated
+    np.ndarray of int64
+        The end offset of each string
+    np.ndarray of bool
+        Whether each string is None
+    """
+    is_none = np.array([x is None for x in strings], dtype=bool)
+    encoded = [b'' if x is None else x.encode('utf-8') for x in strings]
+    ends = np.cumsum([len(x) for x in encoded], dtype=np.int64)
+    data = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+    return data, ends, is_none
+
+
+def _unpack_strings(data, ends, is_none):
+    """The inverse of _pack_strings"""
+    blob = data.tobytes()
+    result = []
+    start = 0
+    for end, missing in zip(ends.tolist(), is_none.tolist()):
+        result.append(None if missing else blob[start:end].decode('utf-8'))
+        start = end
+    return result
+
+
+def _distinct_lineages(consensus):
+    """The distinct lineages of consensus, in order of first occurrence"""
+    distinct = {}
+    for lineage in consensus:
+        distinct.setdefault(tuple(lineage), lineage)
+    return list(distinct.values())
+
+
+def write_checkpoint(path, tree, lineages, scores, placement=None):
+    """Save the state of a decoration for later post processing
+
+    The tree is stored in preorder as the number of children, name, length,
+    edge number, Rank, Bootstrap and BackFillNames of each node. The
+    distinct lineages of the consensus map are stored encoded (see
+    t2t.nlevel.encode_consensus), so the consensus tree can be rebuilt on
+    resume.
+
+    Parameters
+    ----------
+    path : str
+        The path to write to, an npz file
+    tree : t2t.nlevel.DecoratedNode
+        A tree which has gone through backfill_names_gap
+    lineages : list of list
+        The distinct [tax, string] of the consensus map, in order of first
+        occurrence
+    scores : dict
+        {rank: [(name, score)]}, as returned by decorate
+    placement : dict, optional
+        The jplace data the tree was sourced from
+    """
+    n_children = []
+    names = []
+    lengths = []
+    edges = []
+    ranks = []
+    bootstraps = []
+    n_backfill = []
+    backfill = []
+    for node in tree.preorder(include_self=True):
+        n_children.append(len(node.children))
+        names.append(node.name)
+        lengths.append(np.nan if node.length is None else node.length)
+        edge = getattr(node, 'edge_num', None)
+        edges.append(-1 if edge is None else edge)
+
+        if node.children:
+            ranks.append(-1 if node.Rank is None else node.Rank)
+            bootstraps.append(np.nan if node.Bootstrap is None
+                              else node.Bootstrap)
+            n_backfill.append(len(node.BackFillNames))
+            backfill.extend(node.BackFillNames)
+        else:
+            ranks.append(-1)
+            bootstraps.append(np.nan)
+            n_backfill.append(0)
+
+    consensus_ids, consensus_names = \
+        nl.encode_consensus(lineages, len(nl.RANK_ORDER))
+    consensus_names_rank = np.repeat(np.arange(len(consensus_names)),
+                                     [len(n) for n in consensus_names])
+
+    score_ranks = []
+    score_names = []
+    score_values = []
+    for rank, rank_scores in scores.items():
+        for name, score in rank_scores:
+            score_ranks.append(rank)
+            score_names.append(name)
+            score_values.append(score)
+
+    arrays = {'version': np.array([CHECKPOINT_VERSION]),
+              'n_children': np.array(n_children, dtype=np.int32),
+              'lengths': np.array(lengths, dtype=np.double),
+              'edges': np.array(edges, dtype=np.int64),
+              'ranks': np.array(ranks, dtype=np.int32),
+              'bootstraps': np.array(bootstraps, dtype=np.double),
+              'n_backfill': np.array(n_backfill, dtype=np.int32),
+              'consensus_ids': consensus_ids,
+              'consensus_names_rank': consensus_names_rank,
+              'score_ranks': np.array(score_ranks, dtype=np.int32),
+              'score_values': np.array(score_values, dtype=np.double)}
+
+    strings = {'names': names,
+               'backfill': backfill,
+               'consensus_names': [n for rank in consensus_names
+                                   for n in rank],
+               'score_names': score_names,
+               'rank_order': nl.RANK_ORDER,
+               'placement': [None if placement is None
+                             else json.dumps(placement)]}
+    for key, values in strings.items():
+        data, ends, is_none = _pack_strings(values)
+        arrays[key + '_data'] = data
+        arrays[key + '_ends'] = ends
+        arrays[key + '_none'] = is_none
+
+    with open(path, 'wb') as fp:
+        np.savez_compressed(fp, **arrays)
+
+
+def read_checkpoint(path):
+    """Load a checkpoint written by write_checkpoint
+
+    Parameters
+    ----------
+    path : str
+        The path to the checkpoint
+
+    Returns
+    -------
+    t2t.nlevel.DecoratedNode
+        The tree
+    list of list
+        The distinct lineages of the consensus map
+    dict
+        The scores, {rank: [(name, score)]}
+    dict or None
+        The jplace data the tree was sourced from
+    list of str
+        The rank order
+
+    Raises
+    ------
+    ValueError
+        If the checkpoint is from an incompatible version
+    """
+    with np.load(path, allow_pickle=False) as data:
+        arrays = dict(data.items())
+
+    if arrays['version'].tolist() != [CHECKPOINT_VERSION]:
+        raise ValueError("Unsupported checkpoint version: %s" %
+                         arrays['version'].tolist())
+
+    def strings(key):
+        return _unpack_strings(arrays[key + '_data'], arrays[key + '_ends'],
+                               arrays[key + '_none'])
+
+    rank_order = strings('rank_order')
+    n_ranks = len(rank_order)
+
+    # rebuild the tree from the preorder
+    names = strings('names')
+    backfill = iter(strings('backfill'))
+    lengths = arrays['lengths'].tolist()
+    edges = arrays['edges'].tolist()
+    ranks = arrays['ranks'].tolist()
+    bootstraps = arrays['bootstraps'].tolist()
+    n_backfill = arrays['n_backfill'].tolist()
+
+    root = None
+    stack = []
+    for idx, n_children in enumerate(arrays['n_children'].tolist()):
+        length = lengths[idx]
+        node = nl.DecoratedNode(name=names[idx],
+                                length=None if np.isnan(length) else length)
+        if edges[idx] >= 0:
+            node.edge_num = edges[idx]
+
+        if n_children:
+            node.Rank = None if ranks[idx] < 0 else ranks[idx]
+            node.Bootstrap = None if np.isnan(bootstraps[idx]) \
+                else bootstraps[idx]
+            node.BackFillNames = [next(backfill)
+                                  for _ in range(n_backfill[idx])]
+
+        if stack:
+            parent = stack[-1]
+            parent[1] -= 1
+            if parent[1] == 0:
+                stack.pop()
+            node.parent = parent[0]
+            parent[0].children.append(node)
+        else:
+            root = node
+
+        if n_children:
+            stack.append([node, n_children])
+
+    # rebuild the lineages of the consensus map
+    consensus_names = [[] for _ in range(n_ranks)]
+    for rank, name in zip(arrays['consensus_names_rank'].tolist(),
+                          strings('consensus_names')):
+        consensus_names[rank].append(name)
+
+    lineages = []
+    for row in arrays['consensus_ids'].tolist():
+        lineages.append([None if name_id < 0 else consensus_names[r][name_id]
+                         for r, name_id in enumerate(row)])
+
+    scores = {rank: [] for rank in range(n_ranks)}
+    for rank, name, score in zip(arrays['score_ranks'].tolist(),
+                                 strings('score_names'),
+                                 arrays['score_values'].tolist()):
+        scores[rank].append((name, score))
+
+    placement = strings('placement')[0]
+    if placement is not None:
+        placement = json.loads(placement)
+
+    return root, lineages, scores, placement, rank_order
+
+
+STATE_VERSION = 1
+
+
+def write_state(path, state):
+    """Save the state of the scoring stages for later incremental updates
+
+    Parameters
+    ----------
+    path : str
+        The path to write to, an npz file
+    state : t2t.decorate.DecorationState
+        The state, as returned by decorate
+    """
+    rank_names_rank = np.repeat(np.arange(len(state.rank_names)),
+                                [len(n) for n in state.rank_names])
+
+    arrays = {'version': np.array([STATE_VERSION]),
+              'B': state.B,
+              'lengths': state.lengths,
+              'edges': state.edges,
+              'bootstrap': state.bootstrap,
+              'ids': state.ids,
+              'rank_names_rank': rank_names_rank,
+              'n_heavy': state.n_heavy,
+              'heavy_sums': state.heavy_sums,
+              'best': state.best,
+              'best_scores': np.concatenate(state.best_scores),
+              'min_count': np.array([state.min_count]),
+              'nameholders': np.array([state.nameholders])}
+
+    strings = {'names': state.names,
+               'rank_names': [n for rank in state.rank_names for n in rank],
+               'rank_order': nl.RANK_ORDER}
+    for key, values in strings.items():
+        data, ends, is_none = _pack_strings(values)
+        arrays[key + '_data'] = data
+        arrays[key + '_ends'] = ends
+        arrays[key + '_none'] = is_none
+
+    with open(path, 'wb') as fp:
+        np.savez_compressed(fp, **arrays)
+
+
+def read_state(path):
+    """Load a state written by write_state
+
+    Parameters
+    ----------
+    path : str
+        The path to the state
+
+    Returns
+    -------
+    t2t.decorate.DecorationState
+        The state
+    list of str
+        The rank order
+
+    Raises
+    ------
+    ValueError
+        If the state is from an incompatible version
+    """
+    with np.load(path, allow_pickle=False) as data:
+        arrays = dict(data.items())
+
+    if arrays['version'].tolist() != [STATE_VERSION]:
+        raise ValueError("Unsupported state version: %s" %
+                         arrays['version'].tolist())
+
+    def strings(key):
+        return _unpack_strings(arrays[key + '_data'], arrays[key + '_ends'],
+                               arrays[key + '_none'])
+
+    rank_order = strings('rank_order')
+    rank_names = [[] for _ in range(len(rank_order))]
+    for rank, name in zip(arrays['rank_names_rank'].tolist(),
+                          strings('rank_names')):
+        rank_names[rank].append(name)
+    ends = np.cumsum([len(n) for n in rank_names])
+    best_scores = np.split(arrays['best_scores'], ends[:-1])
+
+    state = dec.DecorationState(arrays['B'], strings('names'),
+                                arrays['lengths'], arrays['edges'],
+                                arrays['bootstrap'], arrays['ids'],
+                                rank_names, arrays['n_heavy'],
+                                arrays['heavy_sums'], arrays['best'],
+                                best_scores, int(arrays['min_count'][0]),
+                                bool(arrays['nameholders'][0]))
+    return state, rank_order
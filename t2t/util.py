@@ -1,4 +1,12 @@
 #!/usr/bin/env python
+import hashlib
+import json
+import os
+import re
+import tempfile
+
+import bp
+import numpy as np
 import skbio
 
 __author__ = "Daniel McDonald"
@@ -11,6 +19,15 @@ __email__ = "mcdonadt@colorado.edu"
 __status__ = "Development"
 
 
+COMPILED_TREE_MAGIC = b'T2TTRE\x00\x01'
+
+# the characters which require a newick label to be quoted
+NEWICK_OPERATORS = re.compile(r"[,:_;()\[\]]")
+
+# the number of pieces of newick buffered by write_newick between writes
+NEWICK_CHUNK_SIZE = 65536
+
+
 # this unrooted_copy is an EXACT copy of the code from scikit-bio
 # (BSD license) with the exception that we carry edge_num if set
 # we are setup to monkey patch as we cannot easily control who
@@ -173,3 +190,304 @@ def unzip(items):
         return [list(i) for i in zip(*items)]
     else:
         return []
+
+
+def _aligned(offset):
+    """Round offset up to the alignment of the arrays of compiled files"""
+    return -(-offset // 64) * 64
+
+
+def _write_arrays(path, magic, header, arrays):
+    """Write arrays to a file which can be opened by _read_arrays
+
+    The file holds magic, the size of a JSON header, the header describing
+    the arrays that follow, and the arrays, each aligned to 64 bytes.
+
+    Parameters
+    ----------
+    path : str
+        The file to write
+    magic : bytes
+        The 8 bytes identifying the format of the file
+    header : dict
+        Further fields of the header, which must be JSON serializable
+    arrays : list of (str, np.ndarray)
+        The arrays to write, by name
+    """
+    layout = dict(header, arrays={})
+    offset = 0
+    for key, values in arrays:
+        layout['arrays'][key] = (values.dtype.str, values.shape, offset,
+                                 values.nbytes)
+        offset = _aligned(offset + values.nbytes)
+    encoded = json.dumps(layout).encode('utf-8')
+
+    with open(path, 'wb') as fp:
+        fp.write(magic)
+        fp.write(np.array([len(encoded)], dtype='<u8').tobytes())
+        fp.write(encoded)
+        start = _aligned(16 + len(encoded))
+        for key, values in arrays:
+            fp.seek(start + layout['arrays'][key][2])
+            fp.write(values.tobytes())
+        fp.truncate(start + offset)
+
+
+def _read_arrays(source, magic, kind, writable=False):
+    """Open a file written by _write_arrays
+
+    Parameters
+    ----------
+    source : str or bytes
+        The path to the file, which is memory mapped, or its content
+    magic : bytes
+        The expected magic of the file
+    kind : str
+        What the file holds, for the error raised if it is of another format
+    writable : bool, optional
+        Whether the arrays are to be writable. A memory mapped file is then
+        mapped copy-on-write, so it is left unchanged
+
+    Raises
+    ------
+    ValueError
+        If source does not start with magic
+
+    Returns
+    -------
+    dict
+        The header
+    dict of np.ndarray
+        The arrays, by name
+    """
+    if isinstance(source, str):
+        data = np.memmap(source, dtype=np.uint8,
+                         mode='c' if writable else 'r')
+    elif writable:
+        data = np.frombuffer(bytearray(source), dtype=np.uint8)
+    else:
+        data = np.frombuffer(source, dtype=np.uint8)
+
+    if bytes(data[:8]) != magic:
+        raise ValueError("Not a compiled %s" % kind)
+    header_size = int(data[8:16].view('<u8')[0])
+    header = json.loads(bytes(data[16:16 + header_size]).decode('utf-8'))
+
+    start = _aligned(16 + header_size)
+    arrays = {}
+    for key, (dtype, shape, offset, size) in header.pop('arrays').items():
+        offset += start
+        arrays[key] = data[offset:offset + size].view(dtype).reshape(shape)
+    return header, arrays
+
+
+def compile_tree(tree, path):
+    """Compile a tree to be opened by load_compiled_tree
+
+    The file holds the balanced parentheses of the tree, and the name,
+    length and edge number of each of its parentheses.
+
+    Parameters
+    ----------
+    tree : bp.BP
+        The tree to compile
+    path : str
+        The file to write
+
+    Raises
+    ------
+    ValueError
+        If a name of the tree holds a NUL character
+    """
+    size = len(tree.B)
+    names = [tree.name(i) for i in range(size)]
+    is_none = np.array([name is None for name in names], dtype=bool)
+    names = '\x00'.join(['' if name is None else name for name in names])
+    if names.count('\x00') != max(size - 1, 0):
+        raise ValueError("Tree names cannot hold a NUL character")
+
+    arrays = [('B', np.asarray(tree.B, dtype=np.uint8)),
+              ('names', np.frombuffer(names.encode('utf-8'), dtype=np.uint8)),
+              ('is_none', is_none),
+              ('lengths', np.array([tree.length(i) for i in range(size)],
+                                   dtype='<f8')),
+              ('edges', np.array([tree.edge(i) for i in range(size)],
+                                 dtype='<i4'))]
+    _write_arrays(path, COMPILED_TREE_MAGIC, {}, arrays)
+
+
+def load_compiled_tree(source):
+    """Open a tree compiled by compile_tree
+
+    The parentheses, lengths and edge numbers are used in place from a
+    memory map of the file, without parsing, and only the names are
+    decoded.
+
+    Parameters
+    ----------
+    source : str or bytes
+        The path to the compiled tree, or its content
+
+    Returns
+    -------
+    bp.BP
+    """
+    # bp.BP requires writable buffers
+    _, arrays = _read_arrays(source, COMPILED_TREE_MAGIC, 'tree',
+                              writable=True)
+
+    names = bytes(arrays['names']).decode('utf-8').split('\x00')
+    names = np.array(names, dtype=object)
+    names[arrays['is_none']] = None
+
+    return bp.BP(arrays['B'], names=names, lengths=arrays['lengths'],
+                 edges=arrays['edges'])
+
+
+def parse_tree(newick, cache_dir=None):
+    """Parse a newick tree, through a cache of compiled trees
+
+    The compiled trees are named by the SHA-256 of the newick, so a tree
+    is parsed and compiled on its first use only.
+
+    Parameters
+    ----------
+    newick : str
+        The newick tree
+    cache_dir : str, optional
+        The cache directory, by default the T2T_TREE_CACHE environment
+        variable. If neither is set, the tree is only parsed
+
+    Returns
+    -------
+    bp.BP
+    """
+    if cache_dir is None:
+        cache_dir = os.environ.get('T2T_TREE_CACHE')
+    if not cache_dir:
+        return bp.parse_newick(newick)
+
+    digest = hashlib.sha256(newick.encode('utf-8')).hexdigest()
+    path = os.path.join(cache_dir, digest + '.t2ttre')
+    if os.path.exists(path):
+        return load_compiled_tree(path)
+
+    tree = bp.parse_newick(newick)
+    os.makedirs(cache_dir, exist_ok=True)
+
+    # compile beside the cache entry, and then move it in place, so
+    # concurrent runs never observe a partial file
+    fd, tmp = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    os.close(fd)
+    try:
+        compile_tree(tree, tmp)
+        os.replace(tmp, path)
+    except ValueError:
+        # a tree which cannot be compiled is used uncached
+        os.remove(tmp)
+    return tree
+
+
+def read_tree(source, cache_dir=None):
+    """Read a newick or compiled tree
+
+    Parameters
+    ----------
+    source : str or file-like
+        The path to the tree, or the file of it. A compiled tree read from
+        a file on disk is memory mapped
+    cache_dir : str, optional
+        The cache directory of newick trees, see parse_tree
+
+    Returns
+    -------
+    bp.BP
+    """
+    if isinstance(source, str):
+        with open(source, 'rb') as fp:
+            return read_tree(fp, cache_dir)
+
+    head = source.read(len(COMPILED_TREE_MAGIC))
+    if head == COMPILED_TREE_MAGIC:
+        path = getattr(source, 'name', None)
+        if isinstance(path, str) and os.path.isfile(path):
+            return load_compiled_tree(path)
+        return load_compiled_tree(head + source.read())
+
+    data = head + source.read()
+    if isinstance(data, bytes):
+        data = data.decode('utf-8')
+    return parse_tree(data, cache_dir)
+
+
+def _newick_label(node):
+    """The newick label of a node, as written by skbio"""
+    support = getattr(node, 'support', None)
+    name = node.name
+    if support is not None:
+        label = str(support) + ':' + name if name else str(support)
+    elif name:
+        label = name
+    else:
+        label = ''
+
+    if label:
+        escaped = label.replace("'", "''")
+        if NEWICK_OPERATORS.search(label):
+            label = "'" + escaped + "'"
+        else:
+            label = escaped.replace(' ', '_')
+    if node.length is not None:
+        label += ':%s' % node.length
+    return label
+
+
+def write_newick(tree, output, chunk_size=NEWICK_CHUNK_SIZE):
+    """Write a TreeNode as newick, as TreeNode.write does
+
+    Decorated names, such as '; ' joined taxon names and the bootstrap
+    prefixes of t2t.nlevel.save_bootstraps, are quoted as by skbio. The
+    tree is walked once without recursion, and the newick is written in
+    chunks, rather than piece by piece.
+
+    Parameters
+    ----------
+    tree : skbio.TreeNode
+        The tree to write
+    output : str or file-like
+        The path to write to, or a text file
+    chunk_size : int, optional
+        The number of pieces of newick to buffer between writes
+    """
+    if isinstance(output, str):
+        with open(output, 'w') as fp:
+            return write_newick(tree, fp, chunk_size)
+
+    buf = []
+    append = buf.append
+    # the stack holds nodes yet to be written, and the text to be written
+    # once the children of a node are
+    stack = [tree]
+    pop = stack.pop
+    push = stack.append
+    while stack:
+        node = pop()
+        if isinstance(node, str):
+            append(node)
+        elif node.children:
+            append('(')
+            push(')' + _newick_label(node))
+            children = node.children
+            push(children[-1])
+            for child in children[-2::-1]:
+                push(',')
+                push(child)
+        else:
+            append(_newick_label(node))
+
+        if len(buf) >= chunk_size:
+            output.write(''.join(buf))
+            buf.clear()
+
+    append(';\n')
+    output.write(''.join(buf))
@@ -3,6 +3,7 @@
 from collections import defaultdict
 from operator import add
 from functools import reduce
+from itertools import chain
 
 from t2t.nlevel import (determine_rank_order,
                         make_consensus_tree,
@@ -115,19 +116,31 @@ def hierarchy_errors(tax_lines):
 
 
 def flat_errors(tax_lines):
-    """Flat file errors"""
+    """Flat file errors
+
+    tax_lines may be any iterable of lines, such as a stream from
+    open_consensus_map, and is read once
+    """
     inc_prefix = 'Incorrect prefixes'
     inc_nlevel = 'Incorrect number of levels'
     inc_gap = 'Gaps in taxonomy'
 
-    seed_con = tax_lines[0].strip().split('\t')[1]
+    tax_lines = iter(tax_lines)
+    for line in tax_lines:
+        if line.strip():
+            break
+    else:
+        return {}
+    seed_con = line.strip().split('\t')[1]
     rank_order = determine_rank_order(seed_con)
 
     nlevels = len(rank_order)
     errors = defaultdict(list)
     errors_seen = defaultdict(set)
 
-    for line in tax_lines:
+    for line in chain([line], tax_lines):
+        if not line.strip():
+            continue
         id_, parsed = check_parse(line)
 
         if not check_prefixes(parsed, rank_order):
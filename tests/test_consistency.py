@@ -101,5 +101,57 @@ class ConsistencyTests(TestCase):
         self.assertAlmostEqual(consistency_index[2]['s__Bacteroides pectinophilus'], 1.0)
         self.assertAlmostEqual(consistency_index[2]['s__Bacteroides acidifaciens'], 1.0)
 
+    def test_consistency_indexed(self):
+        """Test consistency from a TaxonRangeIndex matches TaxaCount"""
+
+        seed_con = 'f__Lachnospiraceae; g__Bacteroides; s__'
+        nl.determine_rank_order(seed_con)
+        tipname_map = {'a': ['f__Lachnospiraceae', 'g__Bacteroides', 's__Bacteroides pectinophilus'],
+                       'b': ['f__Lachnospiraceae', 'g__Lachnospira', None],
+                       'c': ['f__Lachnospiraceae', 'g__Bacteroides', 's__Bacteroides pectinophilus'],
+                       'd': ['f__Lachnospiraceae', 'g__Bacteroides', 's__Bacteroides acidifaciens'],
+                       'f': ['f__Lachnospiraceae', 'g__Lachnospira', None]}
+
+        tree = nl.load_tree(StringIO(u'((a,b),(c,(d,e)),f);'), tipname_map)
+
+        counts = nl.collect_names_at_ranks_counts(tree)
+        nl.decorate_ntips_rank(tree)
+        nl.decorate_name_counts(tree)
+        index = nl.TaxonRangeIndex.from_tree(tree)
+
+        c = Consistency(counts, len(nl.RANK_ORDER))
+        for rooted in (True, False):
+            exp = c.calculate(tree, rooted=rooted)
+            obs = c.calculate(tree, rooted=rooted, index=index)
+            self.assertEqual(obs, exp)
+
+    def test_consistency_indexed_absent(self):
+        """Test indexed consistency of taxa absent from most clades"""
+
+        seed_con = 'f__A; g__B; s__'
+        nl.determine_rank_order(seed_con)
+        tipname_map = {'a': ['f__A', 'g__B', 's__B x'],
+                       'b': ['f__A', 'g__C', None],
+                       'c': ['f__A', 'g__B', 's__B y'],
+                       'd': ['f__A', 'g__C', 's__C z'],
+                       'e': ['f__A', None, None],
+                       'g': ['f__A', 'g__D', 's__D w'],
+                       'h': ['f__A', 'g__B', 's__B x'],
+                       'i': ['f__A', 'g__D', None]}
+
+        tree = nl.load_tree(StringIO(u'(((a,b),(c,(d,e))),((g,h,i),f));'),
+                            tipname_map)
+
+        counts = nl.collect_names_at_ranks_counts(tree)
+        nl.decorate_ntips_rank(tree)
+        nl.decorate_name_counts(tree)
+        index = nl.TaxonRangeIndex.from_tree(tree)
+
+        c = Consistency(counts, len(nl.RANK_ORDER))
+        for rooted in (True, False):
+            exp = c.calculate(tree, rooted=rooted)
+            obs = c.calculate(tree, rooted=rooted, index=index)
+            self.assertEqual(obs, exp)
+
 if __name__ == '__main__':
     main()
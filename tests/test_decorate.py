@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+
+from unittest import TestCase, main
+
+import bp
+import numpy as np
+
+from t2t.decorate import (add_nameholders, decorate, to_treenode,
+                          _partition, _structure)
+from t2t.nlevel import (load_tree, collect_names_at_ranks_counts,
+                        decorate_ntips, decorate_name_relative_freqs,
+                        set_ranksafe, pick_names, name_node_score_fold,
+                        set_preliminary_name_and_rank, set_rank_order,
+                        RANK_ORDER, DecoratedNode)
+
+
+class DecorateTests(TestCase):
+    def setUp(self):
+        self.rank_order = RANK_ORDER[:]
+        set_rank_order(['d', 'p', 'c', 'o', 'f', 'g', 's'])
+
+        self.newick = "((a,b)c,(d,(e,f)95)h,(i,j)k)l;"
+        self.tipname_map = {'a': ['1', '2', '3', '4', '5', '6', '8'],
+                            'b': ['1', '2', '3', '4', '5', '6', '8'],
+                            'd': ['1', '2', '3', 'f', 'e', 'c', '9'],
+                            'e': ['1', '2', '3', 'f', 'e', 'c', '9'],
+                            'i': ['1', '2', '3', 'g', 'a', 'h', '11'],
+                            'j': ['1', '2', '3', 'g', 'a', 'h', '12']}
+
+    def tearDown(self):
+        set_rank_order(self.rank_order)
+
+    def test_add_nameholders(self):
+        t = bp.parse_newick("((a:1{0},b:2{1}):1{2},c:1{3},((d:1{4}):1{5}):1{6}):0{7};")  # noqa
+        obs = add_nameholders(t)
+        names = [obs.name(i) for i in range(len(obs.B)) if obs.B[i]]
+        lengths = [obs.length(i) for i in range(len(obs.B)) if obs.B[i]]
+        edges = [obs.edge(i) for i in range(len(obs.B)) if obs.B[i]]
+
+        # (((a),(b)),(((d))),(c))
+        self.assertEqual(obs.B.tolist(),
+                         [1, 1, 1, 1, 0, 0, 1, 1, 0, 0, 0, 1, 1, 1, 1, 0, 0,
+                          0, 0, 1, 1, 0, 0, 0])
+        self.assertEqual(names, [None, None, None, 'a', None, 'b', None, None,
+                                 None, 'd', None, 'c'])
+        self.assertEqual(lengths, [0.0, 1.0, 0.0, 1.0, 0.0, 2.0, 1.0, 1.0,
+                                   0.0, 1.0, 0.0, 1.0])
+        self.assertEqual(edges, [7, 2, 8, 0, 9, 1, 6, 5, 10, 4, 11, 3])
+
+    def test_decorate(self):
+        t = bp.parse_newick(self.newick)
+        t, ranks, bootstraps, scores = decorate(t, self.tipname_map, 1)
+
+        exp = load_tree(bp.to_skbio_treenode(bp.parse_newick(self.newick)),
+                        self.tipname_map)
+        counts = collect_names_at_ranks_counts(exp)
+        decorate_ntips(exp)
+        decorate_name_relative_freqs(exp, counts, 1)
+        set_ranksafe(exp)
+        pick_names(exp)
+        exp_scores = name_node_score_fold(exp)
+        set_preliminary_name_and_rank(exp)
+
+        obs_names = [t.name(i) for i in range(len(t.B)) if t.B[i]]
+        exp_names = [n.name for n in exp.preorder(include_self=True)]
+        self.assertEqual(obs_names, exp_names)
+        self.assertEqual(obs_names, ['3', '8', 'a', 'b', '9', 'd', None,
+                                     'e', 'f', 'h', 'i', 'j'])
+        self.assertEqual(ranks.tolist(),
+                         [2, 6, -1, -1, 6, -1, -1, -1, -1, 5, -1, -1])
+        self.assertEqual(np.isnan(bootstraps).tolist(),
+                         [True] * 6 + [False] + [True] * 5)
+        self.assertEqual(bootstraps[6], 95.0)
+        self.assertEqual({k: sorted(v) for k, v in scores.items()},
+                         {k: sorted(v) for k, v in exp_scores.items()})
+
+    def test_decorate_scalar_score(self):
+        def scalar_fmeasure(precision, recall):
+            if precision + recall == 0:
+                return 0.0
+            return 2.0 * precision * recall / (precision + recall)
+
+        exp = decorate(bp.parse_newick(self.newick), self.tipname_map, 1)
+        obs = decorate(bp.parse_newick(self.newick), self.tipname_map, 1,
+                       score_f=scalar_fmeasure)
+        self.assertEqual([obs[0].name(i) for i in range(len(obs[0].B))],
+                         [exp[0].name(i) for i in range(len(exp[0].B))])
+        self.assertEqual(obs[1].tolist(), exp[1].tolist())
+        self.assertEqual({k: sorted(v) for k, v in obs[3].items()},
+                         {k: sorted(v) for k, v in exp[3].items()})
+
+    def test_decorate_jobs(self):
+        exp_tree, exp_ranks, exp_bootstraps, exp_scores = \
+            decorate(bp.parse_newick(self.newick), self.tipname_map, 1)
+        # by rank alone, and with the clades c, (e,f)95 and k
+        for clade_tips in (None, 2):
+            obs_tree, obs_ranks, obs_bootstraps, obs_scores = \
+                decorate(bp.parse_newick(self.newick), self.tipname_map, 1,
+                         jobs=2, clade_tips=clade_tips)
+
+            self.assertEqual([obs_tree.name(i)
+                              for i in range(len(obs_tree.B))],
+                             [exp_tree.name(i)
+                              for i in range(len(exp_tree.B))])
+            self.assertEqual(obs_ranks.tolist(), exp_ranks.tolist())
+            np.testing.assert_equal(obs_bootstraps, exp_bootstraps)
+            self.assertEqual(obs_scores, exp_scores)
+
+    def test_decorate_state_insert(self):
+        tipname_map = dict(self.tipname_map)
+        tipname_map['x'] = ['1', '2', '3', 'g', 'a', 'h', '12']
+        tipname_map['y'] = ['1', '2', '3', 'f', 'e', 'c', '9']
+        t = bp.parse_newick(self.newick)
+        state = decorate(t, tipname_map, 1, return_state=True)[4]
+
+        with self.assertRaises(ValueError):
+            state.insert([('x', 'missing')], tipname_map)
+        with self.assertRaises(ValueError):
+            state.insert([('a', 'b')], tipname_map)
+
+        # x splits the edge above j, and y that above e, then f
+        obs = state.insert([('x', 'j', 2.0), ('y', 'e'), ('z', 'f')],
+                           tipname_map)
+        exp = decorate(bp.parse_newick(
+            "((a,b)c,(d,((e,y),(f,z))95)h,(i,(j,x:2))k)l;"),
+            tipname_map, 1)
+
+        obs_tree, exp_tree = obs[0], exp[0]
+        self.assertEqual([obs_tree.name(i) for i in range(len(obs_tree.B))],
+                         [exp_tree.name(i) for i in range(len(exp_tree.B))])
+        self.assertEqual([obs_tree.length(i)
+                          for i in range(len(obs_tree.B))],
+                         [exp_tree.length(i)
+                          for i in range(len(exp_tree.B))])
+        self.assertEqual(obs[1].tolist(), exp[1].tolist())
+        np.testing.assert_equal(obs[2], exp[2])
+        self.assertEqual({k: sorted(v) for k, v in obs[3].items()},
+                         {k: sorted(v) for k, v in exp[3].items()})
+        self.assertEqual([obs_tree.edge(i) for i in range(len(obs_tree.B))
+                          if obs_tree.B[i]],
+                         [0] * 7 + [1, 0, 2, 3, 0, 4, 0, 0, 5, 0, 6])
+
+    def test_decorate_state_insert_nameholders(self):
+        tipname_map = dict(self.tipname_map)
+        tipname_map['x'] = ['1', '2', '3', 'f', 'e', 'c', '9']
+        t = add_nameholders(bp.parse_newick(self.newick))
+        state = decorate(t, tipname_map, 1, return_state=True)[4]
+        state.nameholders = True
+
+        obs = state.insert([('x', 'd')], tipname_map)[0]
+        exp = decorate(add_nameholders(bp.parse_newick(
+            "((a,b)c,((e,f)95,(d,x))h,(i,j)k)l;")), tipname_map, 1)[0]
+        self.assertEqual(obs.B.tolist(), exp.B.tolist())
+        self.assertEqual([obs.name(i) for i in range(len(obs.B))],
+                         [exp.name(i) for i in range(len(exp.B))])
+
+    def test_decorate_state_relabel(self):
+        t = bp.parse_newick(self.newick)
+        state = decorate(t, self.tipname_map, 1, return_state=True)[4]
+
+        tipname_map = dict(self.tipname_map)
+        tipname_map['b'] = ['1', '2', '3', 'f', 'e', 'c', '9']
+        tipname_map['f'] = ['1', '2', '3', 'f', 'e', 'c', '10']
+        del tipname_map['i']
+        obs, changed = state.relabel(tipname_map)
+        exp = decorate(bp.parse_newick(self.newick), tipname_map, 1)
+
+        self.assertEqual([obs[0].name(i) for i in range(len(obs[0].B))],
+                         [exp[0].name(i) for i in range(len(exp[0].B))])
+        self.assertEqual(obs[1].tolist(), exp[1].tolist())
+        self.assertEqual({k: sorted(v) for k, v in obs[3].items()},
+                         {k: sorted(v) for k, v in exp[3].items()})
+        self.assertEqual(changed, [(4, '9', 'c'), (6, None, '10'),
+                                   (9, 'h', '12')])
+
+    def test_structure(self):
+        t = bp.parse_newick(self.newick)
+        is_tip, parents, first_tips, all_tips, postorder, close = \
+            _structure(t.B)
+        opens = np.flatnonzero(t.B)
+        self.assertEqual(is_tip.tolist(), (t.B[opens + 1] == 0).tolist())
+        self.assertEqual(parents.tolist(),
+                         [-1, 0, 1, 1, 0, 4, 4, 6, 6, 0, 9, 9])
+        self.assertEqual(first_tips.tolist(),
+                         [0, 0, 0, 1, 2, 2, 3, 3, 4, 5, 5, 6])
+        self.assertEqual(all_tips.tolist(),
+                         [7, 2, 1, 1, 3, 1, 2, 1, 1, 2, 1, 1])
+        self.assertEqual(postorder.tolist(),
+                         [11, 2, 0, 1, 7, 3, 6, 4, 5, 10, 8, 9])
+        self.assertEqual(close.tolist(),
+                         [t.close(i) for i in opens.tolist()])
+
+    def test_partition(self):
+        t = bp.parse_newick(self.newick)
+        opens = np.flatnonzero(t.B)
+        is_tip = t.B[opens + 1] == 0
+        # preorder: l c a b h d 95 e f k i j
+        all_tips = np.array([6, 2, 1, 1, 3, 1, 2, 1, 1, 2, 1, 1])
+        parents = np.array([-1, 0, 1, 1, 0, 4, 4, 6, 6, 0, 9, 9])
+
+        self.assertEqual(_partition(all_tips, parents, is_tip, 2).tolist(),
+                         [1, 6, 9])
+        self.assertEqual(_partition(all_tips, parents, is_tip, 3).tolist(),
+                         [1, 4, 9])
+        self.assertEqual(_partition(all_tips, parents, is_tip, 6).tolist(),
+                         [0])
+        self.assertEqual(_partition(all_tips, parents, is_tip, 1).tolist(),
+                         [])
+
+    def test_to_treenode(self):
+        t = bp.parse_newick(self.newick)
+        obs = to_treenode(*decorate(t, self.tipname_map, 1)[:3])
+        exp = bp.to_skbio_treenode(t)
+        self.assertIsInstance(obs, DecoratedNode)
+        self.assertEqual(str(obs), str(exp))
+        self.assertEqual([n.edge_num for n in obs.preorder()],
+                         [n.edge_num for n in exp.preorder()])
+        self.assertEqual([n.name for n in obs.non_tips(include_self=True)],
+                         ['8', None, '9', 'h', '3'])
+        self.assertEqual([n.Rank for n in obs.non_tips(include_self=True)],
+                         [6, None, 6, 5, 2])
+        self.assertEqual([n.Bootstrap for n in
+                          obs.non_tips(include_self=True)],
+                         [None, 95.0, None, None, None])
+
+
+if __name__ == '__main__':
+    main()
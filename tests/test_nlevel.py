@@ -20,11 +20,13 @@ from unittest import TestCase, main
 from t2t.nlevel import (load_consensus_map, collect_names_at_ranks_counts,
                         load_tree, decorate_name_relative_freqs, decorate_name_counts,
                         set_ranksafe,
-                        pick_names, has_badname, get_nearest_named_ancestor,
+                        pick_names, has_badname, find_badnames,
+                        get_nearest_named_ancestor,
                         walk_consensus_tree, make_consensus_tree,
                         backfill_names_gap, commonname_promotion,
                         decorate_ntips, decorate_ntips_rank,
-                        name_node_score_fold, backfill_from_secondary,
+                        name_node_score_fold, score_pairs, fmeasure,
+                        backfill_from_secondary,
                         validate_all_paths, score_tree,
                         promote_to_multifurcation,
                         recover_from_polyphyletic_sibling,
@@ -35,10 +37,30 @@ from t2t.nlevel import (load_consensus_map, collect_names_at_ranks_counts,
                         POLY_RE, GENERAL_POLY_RE, SPECIES_POLY_RE,
                         EXTRACT_POLY_GENUS,
                         make_names_unique,
-                        lineage_cache, correct_decorated)
-
+                        lineage_cache, correct_decorated, LineageIndex,
+                        encode_consensus, TaxonRangeIndex,
+                        DecoratedNode, DistanceIndex, _named_groups,
+                        pull_consensus_strings, iter_consensus_strings,
+                        write_consensus_strings, TaxonLabel, label_names,
+                        save_bootstraps, _secondary_lineages,
+                        open_consensus_map, iter_consensus_map, RANK_ORDER,
+                        set_rank_order, compile_taxonomy, CompiledTaxonomy)
+
+from copy import deepcopy
+from io import BytesIO
 from skbio import TreeNode
+import bz2
+import gzip
+import lzma
+import math
+import os
+import shutil
 import sys
+import tempfile
+
+import numpy as np
+
+import t2t.nlevel as nl
 
 if sys.version_info[0] == 2:
     from StringIO import StringIO
@@ -117,6 +139,71 @@ class NLevelTests(TestCase):
         self.assertEqual(list([n.name for n in obs.traverse()]),
                          list([n.name for n in exp.traverse()]))
 
+    def test_lineage_index(self):
+        t = TreeNode.read(["(((((a,b)'s__foo a',(c,d)'s__bar b')g__baz),(x)'g__y; s__x c')f__top);"],  # noqa
+                          convert_underscores=False)
+        truth = TreeNode.read(["((((a,b)'s__foo a',(c,d)'s__bar_A b')g__baz_A,(x)'s__x c')f__top);"],  # noqa
+                              convert_underscores=False)
+        index = LineageIndex()
+        obs = index.add(t)
+        exp = index.add(truth)
+
+        foo = obs[id(t.find('s__foo a'))]
+        self.assertEqual(index.lineage(foo), ['f__top', 'g__baz', 's__foo a'])
+        self.assertEqual(index.name(foo), 's__foo a')
+        self.assertEqual(index.length(foo), 3)
+        self.assertEqual(index.lineage(obs[id(t.find('g__y; s__x c'))]),
+                         ['f__top', 'g__y', 's__x c'])
+        self.assertEqual(index.lineage(obs[id(t)]), [])
+
+        # each name is held once
+        self.assertEqual(sorted(index.names),
+                         ['f__top', 'g__baz', 'g__baz_A', 'g__y', 's__bar b',
+                          's__bar_A b', 's__foo a', 's__x c'])
+
+        # polyphyletic tags are ignored, and only the overlap is compared
+        self.assertFalse(index.conflict(foo, exp[id(truth.find('s__foo a'))]))
+        self.assertFalse(index.conflict(obs[id(t.find('s__bar b'))],
+                                        exp[id(truth.find('s__bar_A b'))]))
+        self.assertFalse(index.conflict(foo, exp[id(truth.find('f__top'))]))
+        self.assertTrue(index.conflict(obs[id(t.find('g__y; s__x c'))],
+                                       exp[id(truth.find('s__x c'))]))
+
+    def test_taxon_label(self):
+        label = TaxonLabel(['g__x', 's__x y'])
+        self.assertEqual(label, 'g__x; s__x y')
+        self.assertEqual(label.names, ('g__x', 's__x y'))
+        self.assertIsNone(label.bootstrap)
+        self.assertEqual(label_names(label), ('g__x', 's__x y'))
+        self.assertEqual(label_names('g__x; s__x y'), ['g__x', 's__x y'])
+
+        label = TaxonLabel(['g__x'], 95.0)
+        self.assertEqual(label, '95.0:g__x')
+        self.assertEqual(label.names, ('g__x', ))
+        self.assertEqual(TaxonLabel([], 95.0), '95.0')
+
+        # copies retain the names
+        obs = deepcopy(label)
+        self.assertEqual(obs, label)
+        self.assertEqual(obs.names, ('g__x', ))
+        self.assertEqual(obs.bootstrap, 95.0)
+
+        t = TreeNode.read(["((a,b)c,(d,e)f)g;"])
+        t.children[0].name = TaxonLabel(['g__x', "s__x y"])
+        self.assertEqual(str(t), "((a,b)'g__x; s__x y',(d,e)f)g;\n")
+
+    def test_save_bootstraps(self):
+        t = TreeNode.read(["((a,b)c,(d,e),(f,g)'g__x; s__y')h;"])
+        for n in t.non_tips(include_self=True):
+            n.Bootstrap = None
+        t.children[0].Bootstrap = 10.0
+        t.children[1].Bootstrap = 20.0
+        t.children[2].Bootstrap = 30.0
+        save_bootstraps(t)
+        self.assertEqual(str(t),
+                         "((a,b)'10.0:c',(d,e)20.0,(f,g)'30.0:g__x; s__y')h;\n")
+        self.assertEqual(t.children[2].name.names, ('g__x', 's__y'))
+
     def test_lineage_cache(self):
         t = TreeNode.read(["(((((a,b)s__foo,(c,d)s__bar)g__baz),(x)'g__y; s__x')f__top);"],  # noqa
                           convert_underscores=False)
@@ -162,6 +249,27 @@ class NLevelTests(TestCase):
         data = "asdasdsad dsasda dasd as"
         self.assertFalse(has_badname(data))
 
+    def test_find_badnames(self):
+        """finds the names containing a bad name in one pass"""
+        names = ["f__Uncultured bar", "g__foo", "s__foo cluster",
+                 "s__\u0130 isolate", "s__environmental sample x", "g__bar"]
+        self.assertEqual(find_badnames(names),
+                         {"f__Uncultured bar", "s__foo cluster",
+                          "s__\u0130 isolate", "s__environmental sample x"})
+        self.assertEqual(find_badnames([]), set())
+
+    def test_load_consensus_map_shared_names(self):
+        """cleans each distinct name once, sharing the results"""
+        data = ["foo\ta; b; c; d; e; f; g",
+                "bar\ta; b ; c; d; e; f; g",
+                "baz\ta; b; c; d; e; f; x uncultured",
+                "qux\ta; b; c; d; e; f; g"]
+        obs = load_consensus_map(data, True)
+        self.assertEqual(obs['bar'], obs['foo'])
+        self.assertIs(obs['qux'], obs['foo'])
+        self.assertIs(obs['baz'][1], obs['foo'][1])
+        self.assertEqual(obs['baz'][6], 's__')
+
     def test_load_consensus_map(self):
         """correctly returns a consensus map"""
         data = ["foo\ta; b; c; d; e; f; g",
@@ -179,6 +287,121 @@ class NLevelTests(TestCase):
         self.assertEqual(obs_noappend, exp_noappend)
         self.assertEqual(obs_append, exp_append)
 
+    def test_load_consensus_map_keep(self):
+        """retains only the requested tips"""
+        data = ["foo\ta; b; c; d; e; f; g",
+                "bar\th; i; j; k; l; m; n"]
+        obs = load_consensus_map(data, False, keep={'bar', 'baz'})
+        self.assertEqual(obs, {'bar': ['h', 'i', 'j', 'k', 'l', 'm', 'n']})
+
+    def test_iter_consensus_map(self):
+        """streams cleaned records in chunks"""
+        rank_order = RANK_ORDER[:]
+        data = iter(["\n",
+                     "foo\tk__a; p__b; c__c\n",
+                     "bar\tk__a; p__; c__\n",
+                     "\n",
+                     "baz\tk__a; p__d; c__uncultured\n"])
+        try:
+            obs = list(iter_consensus_map(data, False, chunk_size=2,
+                                          detect_rank_order=True))
+            self.assertEqual(nl.RANK_ORDER, ['k', 'p', 'c'])
+        finally:
+            set_rank_order(rank_order)
+
+        self.assertEqual(obs, [[('foo', ['k__a', 'p__b', 'c__c']),
+                                ('bar', [None, None, None])],
+                               [('baz', ['k__a', 'p__d', None])]])
+
+    def test_open_consensus_map(self):
+        """reads plain and compressed consensus maps"""
+        data = u"foo\ta; b; c; d; e; f; g\nbar\th; i; j; k; l; m; n\n"
+        exp = load_consensus_map(data.splitlines(), False)
+
+        text = StringIO(data)
+        self.assertIs(open_consensus_map(text), text)
+
+        raw = data.encode('utf-8')
+        for compressed in (raw, gzip.compress(raw), bz2.compress(raw),
+                           lzma.compress(raw)):
+            obs = load_consensus_map(open_consensus_map(BytesIO(compressed)),
+                                     False)
+            self.assertEqual(obs, exp)
+
+    def test_compile_taxonomy(self):
+        """compiles a consensus map that loads as the text map"""
+        data = ["foo\td__a; p__b; c__c; o__d; f__e; g__f; s__g\n",
+                "bar\td__h; p__i; c__j; o__k; f__l; g__m; s__n\n",
+                "\n",
+                "baz\td__h; p__; c__; o__; f__; g__; s__\n",
+                "qux\td__a; p__b; c__c; o__d; f__e; g__uncultured; s__g\n",
+                "quux\td__a; p__b; c__c; o__d; f__e; g__f; s__g\n"]
+        exp = load_consensus_map(data, False)
+
+        tmp = tempfile.mkdtemp()
+        rank_order = nl.RANK_ORDER[:]
+        try:
+            path = os.path.join(tmp, 'map.t2t')
+            compile_taxonomy(data, path)
+            obs = open_consensus_map(path)
+            self.assertIsInstance(obs, CompiledTaxonomy)
+            self.assertEqual(obs.rank_order, rank_order)
+            self.assertIs(load_consensus_map(obs, False), obs)
+            with self.assertRaises(ValueError):
+                load_consensus_map(obs, True)
+            with self.assertRaises(ValueError):
+                open_consensus_map(path, compiled=False)
+
+            self.assertEqual(len(obs), 5)
+            self.assertEqual(list(obs), ['foo', 'bar', 'baz', 'qux', 'quux'])
+            self.assertEqual(obs.items(), list(exp.items()))
+            self.assertEqual(obs['qux'], exp['qux'])
+            self.assertNotIn('nope', obs)
+            self.assertEqual(obs.get('nope'), None)
+            self.assertEqual(obs.subset(['qux', 'nope', 'foo']),
+                             {'qux': exp['qux'], 'foo': exp['foo']})
+            self.assertEqual(obs.lookup(['baz', None, 'fo']).tolist(),
+                             [2, -1, -1])
+            self.assertEqual(list(iter_consensus_map(obs, False,
+                                                     chunk_size=3)),
+                             [list(exp.items())[:3],
+                              list(exp.items())[3:]])
+
+            tips = ['qux', 'nope', 'bar', None, 'foo', 'baz']
+            exp_ids, exp_names = encode_consensus(
+                [exp.get(tip, [None] * 7) for tip in tips])
+            names = [[] for _ in range(7)]
+            self.assertEqual(obs.encode(tips, names).tolist(),
+                             exp_ids.tolist())
+            self.assertEqual(names, exp_names)
+
+            with open(path, 'rb') as fp:
+                self.assertEqual(CompiledTaxonomy(fp.read()).items(),
+                                 obs.items())
+        finally:
+            set_rank_order(rank_order)
+            shutil.rmtree(tmp)
+
+    def test_encode_consensus(self):
+        """correctly intern names into an id matrix"""
+        cons = [['a', 'b', 'c'],
+                ['a', None, 'd'],
+                [None, None, None],
+                ['e', 'b', 'c']]
+        ids, names = encode_consensus(cons, 3)
+        self.assertEqual(ids.tolist(), [[0, 0, 0],
+                                        [0, -1, 1],
+                                        [-1, -1, -1],
+                                        [1, 0, 0]])
+        self.assertEqual(names, [['a', 'e'], ['b'], ['c', 'd']])
+
+        data = StringIO(u"((a,b)c,(d,e)f)g;")
+        tree = load_tree(data, {'a': ['1', '2', '3', '4', '5', '6', '7'],
+                                'e': ['1', '2', '3', '4', '5', '6', '8']})
+        self.assertEqual(tree.ConsensusIds.tolist(),
+                         [[0] * 7, [-1] * 7, [-1] * 7, [0] * 6 + [1]])
+        self.assertEqual(tree.ConsensusNames[6], ['7', '8'])
+
     def test_collect_names_at_ranks_counts(self):
         """correctly returns total counts for names at ranks"""
         data = StringIO(u"((a,b)c,(d,(e,f)g)h,(i,j)k)l;")
@@ -232,6 +455,46 @@ class NLevelTests(TestCase):
 
         self.assertEqual(obs, exp)
 
+    def test_load_tree_chunks(self):
+        """loads the taxonomy of the tips from consensus map chunks"""
+        tipname_map = {'a': ['1', '2', '3', '4', '5', '6', '7'],
+                       'e': ['1', '2', '3', '4', '5', '6', '10'],
+                       'x': ['1', '2', '3', '4', '5', '6', '11']}
+        exp = load_tree(StringIO(u"((a,b)c,(d,(e,f)g)h);"), tipname_map)
+        obs = load_tree(StringIO(u"((a,b)c,(d,(e,f)g)h);"),
+                        iter([list(tipname_map.items())[:2],
+                              list(tipname_map.items())[2:]]))
+        self.assertEqual([n.Consensus for n in obs.tips()],
+                         [n.Consensus for n in exp.tips()])
+        self.assertEqual(obs.ConsensusIds.tolist(),
+                         exp.ConsensusIds.tolist())
+        self.assertEqual(obs.ConsensusNames, exp.ConsensusNames)
+
+    def test_load_tree_decorated_node(self):
+        """load_tree produces DecoratedNode trees"""
+        tipname_map = {'a': ['1', '2', '3', '4', '5', '6', '7']}
+        tree = TreeNode.read([u"((a,b)95,c);"])
+        for node in tree.traverse(include_self=True):
+            node.edge_num = 1
+
+        obs = load_tree(tree, tipname_map)
+        self.assertIsNot(obs, tree)
+        self.assertEqual(str(obs), "((a,b),c);\n")
+        for node in obs.traverse(include_self=True):
+            self.assertIsInstance(node, DecoratedNode)
+            self.assertEqual(node.edge_num, 1)
+            self.assertNotIn('TipStart', node.__dict__)
+        self.assertEqual(obs.children[0].Bootstrap, 95.0)
+        self.assertEqual(obs.children[0].children[0].Consensus,
+                         tipname_map['a'])
+
+        obs.RankNames = ['1'] + [None] * 6
+        copied = obs.copy()
+        self.assertEqual(copied.RankNames, obs.RankNames)
+        self.assertIsNot(copied.RankNames, obs.RankNames)
+        self.assertEqual(copied.children[0].Bootstrap, 95.0)
+        self.assertFalse(hasattr(copied.children[1], 'RankNames'))
+
     def test_decorate_name_relative_freqs(self):
         """correctly decorate relative frequency information on a tree"""
         data = StringIO(u"((a,b)c,(d,(e,f)g)h,(i,j)k)l;")
@@ -264,6 +527,80 @@ class NLevelTests(TestCase):
 
         self.assertEqual(tree.ConsensusRelFreq, exp_root)
 
+    def test_decorate_name_relative_freqs_min_count(self):
+        """names below min_count are not retained"""
+        data = StringIO(u"((a,b)c,(d,(e,f)g)h,(i,j)k)l;")
+        tipname_map = {'a': ['1', '2', '3', '4', '5', '6', '7'],
+                       'b': ['1', '2', '3', '4', '5', '6', '8'],
+                       'd': ['1', '2', '3', '4', '5', '6', '8'],
+                       'e': ['1', '2', '3', '4', 'a', '6', '7'],
+                       'i': ['1', '2', '3', '4', 'a', None, '7'],
+                       'j': ['1', '2', '3', '4', 'a', None, '8']}
+
+        tree = load_tree(data, tipname_map)
+        total_counts = collect_names_at_ranks_counts(tree)
+        decorate_ntips(tree)
+        decorate_name_relative_freqs(tree, total_counts, 2)
+
+        exp_h = {0: {'1': 1.0 / 3}, 1: {'2': 1.0 / 3}, 2: {'3': 1.0 / 3},
+                 3: {'4': 1.0 / 3}, 4: {}, 5: {'6': 0.5}, 6: {}}
+        exp_h_valid = {0: {'1': 1.0}, 1: {'2': 1.0}, 2: {'3': 1.0},
+                       3: {'4': 1.0}, 4: {}, 5: {'6': 1.0}, 6: {}}
+        exp_root = {0: {'1': 1.0},
+                    1: {'2': 1.0},
+                    2: {'3': 1.0},
+                    3: {'4': 1.0},
+                    4: {'5': 1.0, 'a': 1.0},
+                    5: {'6': 1.0},
+                    6: {'7': 1.0, '8': 1.0}}
+
+        self.assertEqual(tree.children[1].ConsensusRelFreq, exp_h)
+        self.assertEqual(tree.children[1].ValidRelFreq, exp_h_valid)
+        self.assertEqual(tree.ConsensusRelFreq, exp_root)
+        self.assertEqual(tree.children[0].children[0].ConsensusRelFreq, None)
+
+    def test_decorate_name_relative_freqs_candidates_only(self):
+        """only the names which could be picked are retained"""
+        data = StringIO(u"((a,b)c,(d,(e,f)g)h,(i,j)k)l;")
+        tipname_map = {'a': ['1', '2', '3', '4', '5', '6', '7'],
+                       'b': ['1', '2', '3', 'b', '5', '6', '8'],
+                       'd': ['1', '2', '3', '4', '5', '6', '7'],
+                       'e': ['1', '2', '3', 'b', 'a', 'foo', '7'],
+                       'i': ['1', '2', '3', '4', 'a', 'foo', '8'],
+                       'j': ['1', '2', '3', 'b', 'a', 'foo', '8']}
+
+        full = load_tree(StringIO(data.getvalue()), tipname_map)
+        total_counts = collect_names_at_ranks_counts(full)
+        decorate_ntips(full)
+        decorate_name_relative_freqs(full, total_counts, 1)
+
+        lean = load_tree(data, tipname_map)
+        decorate_ntips(lean)
+        decorate_name_relative_freqs(lean, total_counts, 1,
+                                     candidates_only=True)
+
+        exp_root = {0: {'1': 1.0}, 1: {'2': 1.0}, 2: {'3': 1.0},
+                    3: {}, 4: {}, 5: {}, 6: {}}
+        exp_h = {0: {}, 1: {}, 2: {}, 3: {}, 4: {}, 5: {}, 6: {'7': 2.0 / 3}}
+        exp_h_valid = {0: {}, 1: {}, 2: {}, 3: {}, 4: {}, 5: {},
+                       6: {'7': 1.0}}
+        self.assertEqual(lean.ConsensusRelFreq, exp_root)
+        self.assertEqual(lean.children[1].ConsensusRelFreq, exp_h)
+        self.assertEqual(lean.children[1].ValidRelFreq, exp_h_valid)
+        self.assertEqual(lean.children[0].children[0].ConsensusRelFreq, None)
+
+        for t in (full, lean):
+            set_ranksafe(t)
+            pick_names(t)
+        exp_scores = name_node_score_fold(full)
+        obs_scores = name_node_score_fold(lean)
+        self.assertEqual(obs_scores, exp_scores)
+        for f, l in zip(full.non_tips(include_self=True),
+                        lean.non_tips(include_self=True)):
+            self.assertEqual(l.RankSafe, f.RankSafe)
+            self.assertEqual(l.RankNames, f.RankNames)
+            self.assertEqual(l.RankNameScores, f.RankNameScores)
+
     def test_decorate_name_counts(self):
         """correctly decorate relative frequency information on a tree"""
         data = StringIO(u"((a,b)c,(d,(e,f)g)h,(i,j)k)l;")
@@ -288,6 +625,39 @@ class NLevelTests(TestCase):
 
         self.assertEqual(tree.TaxaCount, exp_root)
 
+    def test_taxon_range_index(self):
+        """correctly count names within clades from the index"""
+        data = StringIO(u"((a,b)c,(d,(e,f)g)h,(i,j)k)l;")
+        tipname_map = {'a': ['1', '2', '3', '4', '5', '6', '7'],
+                       'b': ['1', '2', '3', '4', '5', '6', '8'],
+                       'd': ['1', '2', '3', '4', '5', '6', '8'],
+                       'e': ['1', '2', '3', '4', 'a', '6', '7'],
+                       'i': ['1', '2', '3', '4', 'a', None, '7'],
+                       'j': ['1', '2', '3', '4', 'a', None, '8']}
+
+        tree = load_tree(data, tipname_map)
+        decorate_name_counts(tree)
+        index = TaxonRangeIndex.from_tree(tree)
+
+        for node in tree.traverse(include_self=True):
+            for rank in range(7):
+                self.assertEqual(index.taxa(node, rank),
+                                 dict(node.TaxaCount[rank]))
+                for name, count in node.TaxaCount[rank].items():
+                    self.assertEqual(index.count(node, rank, name), count)
+
+        h = tree.children[1]
+        self.assertEqual(index.count(h, 6, '7'), 1)
+        self.assertEqual(index.count(h, 6, '8'), 1)
+        self.assertEqual(index.count(h, 6, 'missing'), 0)
+        self.assertEqual(index.counts(h, 4).tolist(), [1, 1])
+        self.assertEqual(index.names[4], ['5', 'a'])
+        name_ids, counts = index.present(h, 6)
+        self.assertEqual([index.names[6][i] for i in name_ids], ['7', '8'])
+        self.assertEqual(counts.tolist(), [1, 1])
+        name_ids, counts = index.present(tree.children[2], 5)
+        self.assertEqual(name_ids.tolist(), [])
+
     def test_set_ranksafe(self):
         """correctly set ranksafe on tree"""
         data = StringIO(u"((a,b)c,(d,(e,f)g)h,(i,j)k)l;")
@@ -350,6 +720,112 @@ class NLevelTests(TestCase):
         self.assertEqual(tree.children[2].RankNames, expc2)
         self.assertEqual(tree.children[1].children[1].RankNames, expc1c1)
 
+    def test_name_node_score_fold_ties(self):
+        """ties favor the fewest tips, then the last node in postorder"""
+        lineage = ['1', '2', '3', '4', '5', '6']
+        tipname_map = {'a': lineage + ['X'], 'b': lineage + ['X'],
+                       'd': lineage + ['Y'], 'e': lineage + ['Y'],
+                       'g': lineage + ['Z'], 'i': lineage + ['Z']}
+
+        def fold(newick, **kwargs):
+            tree = load_tree(StringIO(newick), tipname_map)
+            counts = collect_names_at_ranks_counts(tree)
+            decorate_ntips(tree)
+            decorate_name_relative_freqs(tree, counts, 1)
+            set_ranksafe(tree)
+            pick_names(tree)
+            scores = name_node_score_fold(tree, **kwargs)
+            return {n.name: n.RankNames[6]
+                    for n in tree.non_tips(include_self=True)}, scores
+
+        # X scores 1.0 on both c and x, u is not informative
+        obs, scores = fold("(((a,b)c,u)x,(d,e)h)l;")
+        self.assertEqual(obs, {'c': 'X', 'x': None, 'h': 'Y', 'l': None})
+        self.assertEqual(sorted(scores[6]), [('X', 1.0), ('Y', 1.0)])
+
+        # Z scores equally on k and m, and both have two tips
+        obs, _ = fold("((g,u)k,(i,v)m,(d,e)h,(a,b)c)l;")
+        self.assertEqual(obs, {'k': None, 'm': 'Z', 'h': 'Y', 'c': 'X',
+                               'l': None})
+
+        # a custom tiebreak sees the tied nodes in reverse postorder
+        obs, _ = fold("((g,u)k,(i,v)m,(d,e)h,(a,b)c)l;",
+                      tiebreak_f=lambda nodes: [n for n in nodes
+                                                if n is not None][-1])
+        self.assertEqual(obs, {'k': 'Z', 'm': None, 'h': 'Y', 'c': 'X',
+                               'l': None})
+
+        # a score function of scalars is called per pair
+        def scalar_score(precision, recall):
+            if precision + recall == 0:
+                return 0.0
+            return max(2.0 * precision * recall / (precision + recall), 0.0)
+
+        obs, scalar_scores = fold("(((a,b)c,u)x,(d,e)h)l;",
+                                  score_f=scalar_score)
+        self.assertEqual(obs, {'c': 'X', 'x': None, 'h': 'Y', 'l': None})
+        self.assertEqual(sorted(scalar_scores[6]), [('X', 1.0), ('Y', 1.0)])
+
+        # subtree sizes are counted, as TipStart and TipStop may be stale
+        tree = load_tree(StringIO("((g,u)k,(i,v)m,(d,e)h,(a,b)c)l;"),
+                         tipname_map)
+        counts = collect_names_at_ranks_counts(tree)
+        decorate_ntips(tree)
+        decorate_name_relative_freqs(tree, counts, 1)
+        set_ranksafe(tree)
+        pick_names(tree)
+        k = tree.find('k')
+        k.TipStop = k.TipStart
+        name_node_score_fold(tree)
+        self.assertEqual(k.RankNames[6], None)
+        self.assertEqual(tree.find('m').RankNames[6], 'Z')
+
+    def test_score_pairs(self):
+        """score functions are called per pair unless vectorized"""
+        precisions = np.array([1.0, 0.5, 0.25, 0.0])
+        recalls = np.array([1.0, 0.25, 1.0, 0.5])
+
+        exp = [fmeasure(p, r) for p, r in zip(precisions.tolist(),
+                                              recalls.tolist())]
+        self.assertEqual(score_pairs(fmeasure, precisions, recalls).tolist(),
+                         exp)
+
+        calls = []
+
+        def branchy(p, r):
+            calls.append((p, r))
+            return p if p > r else math.sqrt(r)
+
+        obs = score_pairs(branchy, precisions, recalls)
+        self.assertEqual(obs.tolist(), [1.0, 0.5, 1.0, math.sqrt(0.5)])
+        self.assertEqual(calls[-4:], list(zip(precisions.tolist(),
+                                              recalls.tolist())))
+
+        # a function of scalars which accepts arrays is still called per
+        # pair, as is one which raises on arrays
+        obs = score_pairs(lambda p, r: np.zeros_like(p) + max(p, r),
+                          precisions, recalls)
+        self.assertEqual(obs.tolist(), [1.0, 0.5, 1.0, 0.5])
+        obs = score_pairs(lambda p, r: float(p.hex() < r.hex()),
+                          precisions, recalls)
+        self.assertEqual(obs.shape, (4, ))
+
+        # a vectorized function is called once with the arrays
+        def vectorized(p, r):
+            calls.append((p, r))
+            return p * r
+        vectorized.vectorized = True
+
+        del calls[:]
+        obs = score_pairs(vectorized, precisions, recalls)
+        self.assertEqual(obs.tolist(), (precisions * recalls).tolist())
+        self.assertEqual(len(calls), 1)
+
+        self.assertEqual(score_pairs(fmeasure, precisions[:0],
+                                     recalls[:0]).tolist(), [])
+        self.assertEqual(score_pairs(branchy, precisions[:0],
+                                     recalls[:0]).tolist(), [])
+
     def test_validate_all_paths(self):
         """complains correctly about badpaths"""
         data = StringIO(u"(((((1,2)s__,(3,4)s__)g__)p__),((5,6)f__)f__,((7,8)c__)o__);")
@@ -616,6 +1092,20 @@ class NLevelTests(TestCase):
         obs = _named_siblings(t.find('g__B'))
         self.assertEqual(obs, exp)
 
+        groups = _named_groups(t)
+        self.assertEqual(_named_siblings(t.find('g__B'), groups), exp)
+        self.assertEqual(_named_siblings(t.find('s__A'), groups),
+                         [t.find('s__B')])
+        self.assertEqual(_named_siblings(t, groups), [])
+
+    def test_distance_index(self):
+        t = TreeNode.read(['(((a:1,b:2)c:3,d:4)e:1,(f:5,(g:1)h)i:2)root;'])
+        index = DistanceIndex(t)
+        nodes = list(t.traverse(include_self=True))
+        for node in nodes:
+            exp = [node.distance(o, missing_as_zero=True) for o in nodes]
+            self.assertEqual(index.distances(node, nodes).tolist(), exp)
+
     def test_recover_from_polyphyletic_sibling(self):
         # map species and genus including on nested name
         # do not map a substring (g__baz -> g__bazx)
@@ -668,6 +1158,48 @@ class NLevelTests(TestCase):
         n = tree.find('l4').parent
         self.assertEqual(n.BackFillNames, ['g2', 's3'])
 
+    def test_secondary_lineages(self):
+        secondary_taxonomy = TreeNode.read(["((((l1,l2)s1,(l3)s2)g1,((l4)s3)g2)f1)o1;"])  # noqa
+        rank_lookup = {'s': 6, 'g': 5, 'f': 4, 'o': 3}
+        for n in secondary_taxonomy.non_tips():
+            n.Rank = rank_lookup[n.name[0]]
+
+        obs = _secondary_lineages(secondary_taxonomy)
+        self.assertEqual(sorted(obs), ['l1', 'l2', 'l3', 'l4'])
+        self.assertEqual(obs['l1'], ((6, 's1'), (5, 'g1'), (4, 'f1')))
+        self.assertIs(obs['l1'], obs['l2'])
+        self.assertEqual(obs['l4'], ((6, 's3'), (5, 'g2'), (4, 'f1')))
+
+    def test_pull_consensus_strings(self):
+        t = TreeNode.read(["(((a,b)'g__x; s__y',c)'f__z; g__w',(d)p__q)'d__r';"],  # noqa
+                          convert_underscores=False)
+        # the names of ancestors take precedence
+        exp = ['a\td__r; p__; c__; o__; f__z; g__w; s__y',
+               'b\td__r; p__; c__; o__; f__z; g__w; s__y',
+               'c\td__r; p__; c__; o__; f__z; g__w; s__',
+               'd\td__r; p__q; c__; o__; f__; g__; s__']
+        self.assertEqual(pull_consensus_strings(t), exp)
+        self.assertEqual(list(iter_consensus_strings(t)), exp)
+        self.assertEqual(pull_consensus_strings(t, append_prefix=False)[3],
+                         'd\td__r; p__q; ; ; ; ; ')
+        self.assertEqual(list(iter_consensus_strings(t, as_tree=True))[3],
+                         ('d', ['d__r', 'p__q', 'c__', 'o__', 'f__', 'g__',
+                                's__']))
+
+        # the bootstrap of a label is not a taxon name
+        for n in t.non_tips(include_self=True):
+            n.name = TaxonLabel(label_names(n.name), 99.0)
+        self.assertEqual(list(iter_consensus_strings(t)), exp)
+
+    def test_write_consensus_strings(self):
+        f = StringIO()
+        write_consensus_strings(iter(['a\tx', 'b\ty']), f)
+        self.assertEqual(f.getvalue(), 'a\tx\nb\ty')
+
+        f = StringIO()
+        write_consensus_strings(iter([]), f)
+        self.assertEqual(f.getvalue(), '')
+
     def test_commonname_promotion(self):
         """correctly promote names if possible"""
         consensus_tree = TreeNode.read(StringIO(u"(((s1,s2)g1,(s3,s4)g2,(s5,s6)g3)f1)o1;"))
@@ -692,6 +1224,43 @@ class NLevelTests(TestCase):
 
         self.assertEqual(str(t).rstrip(), exp)
 
+    def test_commonname_promotion_emptied(self):
+        """descend through nodes whose names were all promoted"""
+        t = TreeNode.read(StringIO(u"((((1,2)y,(3,4)z)x)a)r;"))
+        backfill = {'r': [], 'a': [], 'x': ['g1'], 'y': ['s1'], 'z': ['s1']}
+        for n in t.non_tips(include_self=True):
+            n.BackFillNames = backfill[n.name]
+        commonname_promotion(t)
+
+        # g1 moves from x to r, and s1 then moves from y and z to a
+        self.assertEqual(str(t).rstrip(), "((((1,2),(3,4)))s1)g1;")
+
+    def test_commonname_promotion_deep(self):
+        """promote names across a deep unnamed spine"""
+        # a ladder of unnamed nodes, each with a named cherry
+        t = TreeNode()
+        spine = [t]
+        cherries = []
+        for i in range(2000):
+            cherry = TreeNode(children=[TreeNode(), TreeNode()])
+            cherry.BackFillNames = ['f__A', 'g__B', 's__C']
+            cherries.append(cherry)
+            node = TreeNode()
+            spine[-1].extend([cherry, node])
+            spine.append(node)
+        spine[-1].extend([TreeNode(), TreeNode()])
+        for n in spine:
+            n.BackFillNames = []
+        commonname_promotion(t)
+
+        # the root takes all but the last name of every cherry, and the
+        # next node takes the last from the cherries below it
+        self.assertEqual(spine[0].name, 'f__A; g__B')
+        self.assertEqual(spine[1].name, 's__C')
+        self.assertEqual(cherries[0].name, 's__C')
+        self.assertEqual([n.name for n in spine[2:]], [None] * 1999)
+        self.assertEqual([n.name for n in cherries[1:]], [None] * 1999)
+
     def test_promote_to_multifurcation(self):
         tree = TreeNode.read(["""(((a,b)s__1,(c,d)s__2)g__1,
                                   ((e,f)s__3,(g,h)));"""],
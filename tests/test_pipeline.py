@@ -0,0 +1,470 @@
+#!/usr/bin/env python
+
+import gc
+import gzip
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import warnings
+from io import StringIO
+from unittest import TestCase, main
+
+import bp
+import numpy as np
+
+from t2t.pipeline import (DecoratePipeline, DecorateBatch, read_checkpoint,
+                          write_state, read_state)
+from t2t.nlevel import (RANK_ORDER, set_rank_order, compile_taxonomy,
+                        CompiledTaxonomy)
+from t2t.util import compile_tree
+
+__author__ = "Daniel McDonald"
+__copyright__ = "Copyright 2011, The tax2tree project"
+__credits__ = ["Daniel McDonald"]
+__license__ = "BSD"
+__version__ = "1.0"
+__maintainer__ = "Daniel McDonald"
+__email__ = "mcdonadt@colorado.edu"
+__status__ = "Development"
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+SCRIPT = os.path.join(ROOT, 'scripts', 't2t')
+
+
+class PipelineOutputTests(TestCase):
+    """Compare the outputs pipelines write"""
+
+    def _decorate(self, output, consensus_map, **kwargs):
+        """Run a DecoratePipeline and write its outputs to output"""
+        pipeline = DecoratePipeline(consensus_map, **kwargs)
+        pipeline.run()
+        pipeline.write(output)
+        return pipeline
+
+    def assertSameOutputs(self, exp_prefix, obs_prefix):
+        """Assert the decorated tree, consensus strings and fmeasures match"""
+        for suffix in ('', '-consensus-strings', '-fmeasures'):
+            with open(exp_prefix + suffix) as exp, \
+                    open(obs_prefix + suffix) as obs:
+                self.assertEqual(obs.read(), exp.read())
+
+
+class DecoratePipelineTests(PipelineOutputTests):
+    def setUp(self):
+        self.rank_order = RANK_ORDER[:]
+        self.output_dir = tempfile.mkdtemp()
+        self.output = os.path.join(self.output_dir, 'out')
+        self.consensus_map = StringIO(
+            u"a\td__A; p__B; c__C; o__D; f__E; g__F; s__F x\n"
+            u"b\td__A; p__B; c__C; o__D; f__E; g__F; s__F x\n"
+            u"c\td__A; p__B; c__C; o__D; f__E; g__F; s__F y\n"
+            u"d\td__A; p__B; c__C; o__D; f__G; g__H; s__H z\n"
+            u"e\td__A; p__B; c__C; o__D; f__G; g__H; s__H z\n")
+        self.tree = StringIO(u"(((a,b),c)95,(d,e),f);")
+
+    def tearDown(self):
+        set_rank_order(self.rank_order)
+        shutil.rmtree(self.output_dir)
+
+    def test_init_tree_or_placement(self):
+        with self.assertRaises(ValueError):
+            DecoratePipeline(self.consensus_map)
+        with self.assertRaises(ValueError):
+            DecoratePipeline(self.consensus_map, tree=self.tree,
+                             placement='foo.jplace')
+
+    def test_stages(self):
+        obs = DecoratePipeline(self.consensus_map, tree=self.tree).stages()
+        self.assertEqual(obs, ['load_tree', 'load_consensus_map', 'decorate',
+                               'to_treenode', 'make_consensus_tree',
+                               'backfill_names_gap', 'commonname_promotion',
+                               'correct_decorated', 'make_names_unique',
+                               'pull_consensus_strings'])
+
+        obs = DecoratePipeline(self.consensus_map, tree=self.tree,
+                               add_nameholder=True, no_suffix=True,
+                               recover_polyphyletic=True,
+                               correct_binomials=True,
+                               save_bootstraps=True).stages()
+        self.assertEqual(obs, ['load_tree', 'add_nameholders',
+                               'load_consensus_map', 'decorate',
+                               'to_treenode', 'make_consensus_tree',
+                               'backfill_names_gap', 'commonname_promotion',
+                               'recover_from_polyphyletic_sibling',
+                               'correct_decorated',
+                               'correct_species_binomial',
+                               'pull_consensus_strings', 'save_bootstraps'])
+
+    def test_run(self):
+        pipeline = DecoratePipeline(self.consensus_map, tree=self.tree)
+        pipeline.run()
+        pipeline.write(self.output)
+
+        with open(self.output) as fp:
+            self.assertEqual(fp.read(),
+                             "(((a:0.0,b:0.0):0.0,c:0.0):0.0,(d:0.0,e:0.0):0.0,"
+                             "f:0.0)'o__D';\n")
+        with open(self.output + '-consensus-strings') as fp:
+            self.assertEqual(fp.read().splitlines()[0],
+                             'a\td__; p__; c__; o__D; f__; g__; s__')
+        with open(self.output + '-fmeasures') as fp:
+            self.assertEqual(fp.readline(), '#taxon\tscore\n')
+            self.assertEqual(len(fp.readlines()), 10)
+
+        report = pipeline.report()
+        self.assertEqual([s['name'] for s in report['stages']],
+                         pipeline.stages() + ['write'])
+        self.assertEqual(sorted(report['stages'][0]),
+                         ['cpu_time', 'name', 'wall_time'])
+        self.assertNotIn('peak_memory', report)
+
+    def test_run_save_bootstraps(self):
+        consensus_map = StringIO(
+            u"a\td__A; p__B; c__C; o__D; f__E; g__F; s__F x\n"
+            u"b\td__A; p__B; c__C; o__D; f__E; g__F; s__F x\n"
+            u"c\td__A; p__B; c__C; o__D; f__E; g__F; s__F y\n"
+            u"d\td__A; p__B; c__C; o__D; f__E; g__F; s__F y\n"
+            u"e\td__A; p__B; c__C; o__I; f__G; g__H; s__H z\n"
+            u"f\td__A; p__B; c__C; o__I; f__G; g__H; s__H z\n")
+        tree = StringIO(u"(((a,b)90,(c,d)85)95,(e,f)80)99;")
+        pipeline = DecoratePipeline(consensus_map, tree=tree,
+                                    save_bootstraps=True, profile=True)
+        pipeline.run()
+        pipeline.write(self.output)
+
+        # the bootstraps saved as names are not counted as names
+        named = [s['named_nodes'] for s in pipeline.report()['stages']]
+        self.assertEqual(named[0], 0)
+        self.assertEqual(named[-2], 1)
+
+        # the bootstrap of the root is not part of its consensus strings
+        with open(self.output) as fp:
+            self.assertEqual(fp.read(),
+                             "(((a:0.0,b:0.0)90.0:0.0,(c:0.0,d:0.0)85.0:0.0)"
+                             "95.0:0.0,(e:0.0,f:0.0)80.0:0.0)'99.0:c__C';\n")
+        with open(self.output + '-consensus-strings') as fp:
+            self.assertEqual(fp.read().splitlines(),
+                             ['%s\td__; p__; c__C; o__; f__; g__; s__' % tip
+                              for tip in 'abcdef'])
+
+    def test_run_compressed(self):
+        self._decorate(self.output, self.consensus_map, tree=self.tree)
+
+        path = os.path.join(self.output_dir, 'map.tsv.gz')
+        with gzip.open(path, 'wt') as fp:
+            fp.write(self.consensus_map.getvalue())
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always', ResourceWarning)
+            self._decorate(self.output + '-gz', path,
+                           tree=StringIO(self.tree.getvalue()))
+            gc.collect()
+
+        # the map the pipeline opened is closed
+        self.assertEqual([w for w in caught
+                          if issubclass(w.category, ResourceWarning)], [])
+
+        self.assertSameOutputs(self.output, self.output + '-gz')
+
+    def test_run_compiled(self):
+        self._decorate(self.output, self.consensus_map, tree=self.tree)
+
+        path = os.path.join(self.output_dir, 'map.t2t')
+        compile_taxonomy(StringIO(self.consensus_map.getvalue()), path)
+        pipeline = self._decorate(self.output + '-compiled', path,
+                                  tree=StringIO(self.tree.getvalue()))
+        self.assertIsInstance(pipeline.tipname_map, CompiledTaxonomy)
+
+        self.assertSameOutputs(self.output, self.output + '-compiled')
+
+    def test_run_compiled_tree(self):
+        self._decorate(self.output, self.consensus_map, tree=self.tree)
+
+        path = os.path.join(self.output_dir, 'tree.t2ttre')
+        compile_tree(bp.parse_newick(self.tree.getvalue()), path)
+        with open(path, 'rb') as tree:
+            self._decorate(self.output + '-compiled',
+                           StringIO(self.consensus_map.getvalue()), tree=tree)
+
+        self.assertSameOutputs(self.output, self.output + '-compiled')
+
+    def test_load_consensus_map_retains_lineages(self):
+        # the consensus tree is built from all of the map, tips of the tree
+        # or not, though only the records of the tips are retained
+        consensus_map = StringIO(self.consensus_map.getvalue() +
+                                 u"x\td__A; p__B; c__C; o__D; f__E; g__F; "
+                                 u"s__F w\n")
+        pipeline = DecoratePipeline(consensus_map, tree=self.tree)
+        pipeline.run()
+        self.assertEqual(sorted(pipeline.tipname_map), list('abcde'))
+        self.assertEqual(len(pipeline.lineages), 4)
+        self.assertIn('s__F w', pipeline.contree_lookup)
+
+    def test_run_profile(self):
+        pipeline = DecoratePipeline(self.consensus_map, tree=self.tree,
+                                    profile=True)
+        pipeline.run()
+        pipeline.write(self.output)
+
+        buf = StringIO()
+        pipeline.write_report(buf)
+        report = json.loads(buf.getvalue())
+
+        stages = {s['name']: s for s in report['stages']}
+        self.assertEqual(sorted(stages['load_tree']),
+                         ['cpu_time', 'memory', 'name', 'named_nodes',
+                          'nodes', 'peak_memory', 'wall_time'])
+        self.assertEqual(stages['load_tree']['nodes'], 10)
+        # the bootstrap of the load_tree stage is not a name
+        self.assertEqual(stages['load_tree']['named_nodes'], 0)
+        self.assertEqual(stages['decorate']['named_nodes'], 4)
+        self.assertEqual(stages['correct_decorated']['named_nodes'], 1)
+        self.assertEqual(report['peak_memory'],
+                         max(s['peak_memory'] for s in report['stages']))
+        self.assertAlmostEqual(report['wall_time'],
+                               sum(s['wall_time'] for s in report['stages']))
+        for stage in report['stages']:
+            self.assertGreaterEqual(stage['peak_memory'], stage['memory'])
+
+    def test_init_resume(self):
+        with self.assertRaises(ValueError):
+            DecoratePipeline(None, tree=self.tree)
+        with self.assertRaises(ValueError):
+            DecoratePipeline(None, tree=self.tree, resume='foo.npz')
+
+        obs = DecoratePipeline(None, resume='foo.npz',
+                               save_bootstraps=True).stages()
+        self.assertEqual(obs, ['resume', 'make_consensus_tree',
+                               'commonname_promotion', 'correct_decorated',
+                               'make_names_unique', 'pull_consensus_strings',
+                               'save_bootstraps'])
+
+    def test_checkpoint_resume(self):
+        checkpoint = os.path.join(self.output_dir, 'checkpoint.npz')
+        pipeline = DecoratePipeline(self.consensus_map, tree=self.tree,
+                                    checkpoint=checkpoint)
+        self.assertIn('checkpoint', pipeline.stages())
+        pipeline.run()
+
+        tree, lineages, scores, placement, rank_order = \
+            read_checkpoint(checkpoint)
+        self.assertEqual(lineages, pipeline.lineages)
+        self.assertEqual(scores, pipeline.scores)
+        self.assertEqual(placement, None)
+        self.assertEqual(rank_order, ['d', 'p', 'c', 'o', 'f', 'g', 's'])
+        self.assertEqual(str(tree),
+                         "(((a:0.0,b:0.0)'s__F x':0.0,c:0.0)'g__F':0.0,"
+                         "(d:0.0,e:0.0)'s__H z':0.0,f:0.0)'o__D';\n")
+        self.assertEqual([n.Bootstrap for n in
+                          tree.non_tips(include_self=True)],
+                         [None, 95.0, None, None])
+        self.assertEqual([n.Rank for n in tree.non_tips(include_self=True)],
+                         [6, 5, 6, 3])
+        self.assertEqual([n.BackFillNames for n in
+                          tree.non_tips(include_self=True)],
+                         [['s__F x'], ['f__E', 'g__F'],
+                          ['f__G', 'g__H', 's__H z'], ['o__D']])
+
+        for opts in ({}, {'save_bootstraps': True, 'no_suffix': True}):
+            self._decorate(self.output,
+                           StringIO(self.consensus_map.getvalue()),
+                           tree=StringIO(self.tree.getvalue()), **opts)
+            self._decorate(self.output + '-resumed', None, resume=checkpoint,
+                           **opts)
+
+            self.assertSameOutputs(self.output, self.output + '-resumed')
+
+    def test_init_update_state(self):
+        with self.assertRaises(ValueError):
+            DecoratePipeline(None, update_state='foo.npz')
+        with self.assertRaises(ValueError):
+            DecoratePipeline(self.consensus_map, tree=self.tree,
+                             update_state='foo.npz', insertions=StringIO())
+        with self.assertRaises(ValueError):
+            DecoratePipeline(self.consensus_map, tree=self.tree,
+                             insertions=StringIO())
+        with self.assertRaises(ValueError):
+            DecoratePipeline(None, resume='foo.npz', save_state='foo.npz')
+
+        obs = DecoratePipeline(self.consensus_map, update_state='foo.npz',
+                               insertions=StringIO(),
+                               save_state='bar.npz').stages()
+        self.assertEqual(obs, ['load_consensus_map', 'load_state',
+                               'relabel_tips', 'insert_tips', 'save_state',
+                               'to_treenode',
+                               'make_consensus_tree', 'backfill_names_gap',
+                               'commonname_promotion', 'correct_decorated',
+                               'make_names_unique', 'pull_consensus_strings'])
+
+        obs = DecoratePipeline(self.consensus_map,
+                               update_state='foo.npz').stages()
+        self.assertEqual(obs[:4], ['load_consensus_map', 'load_state',
+                                   'relabel_tips', 'to_treenode'])
+
+    def test_save_update_state(self):
+        state = os.path.join(self.output_dir, 'state.npz')
+        updated = os.path.join(self.output_dir, 'updated.npz')
+        consensus_map = self.consensus_map.getvalue() + \
+            u"g\td__A; p__B; c__C; o__D; f__G; g__H; s__H z\n" \
+            u"h\td__A; p__B; c__C; o__D; f__E; g__F; s__F y\n"
+
+        pipeline = DecoratePipeline(StringIO(consensus_map), tree=self.tree,
+                                    save_state=state)
+        self.assertIn('save_state', pipeline.stages())
+        pipeline.run()
+
+        for opts in ({}, {'save_bootstraps': True}):
+            self._decorate(self.output, StringIO(consensus_map),
+                           tree=StringIO(u"(((a,b),(c,h))95,(d,(e,g)),f);"),
+                           **opts)
+            self._decorate(self.output + '-updated', StringIO(consensus_map),
+                           update_state=state,
+                           insertions=StringIO(u"g\te\nh\tc\n"),
+                           save_state=updated, **opts)
+
+            self.assertSameOutputs(self.output, self.output + '-updated')
+
+        obs, rank_order = read_state(updated)
+        self.assertEqual(rank_order, ['d', 'p', 'c', 'o', 'f', 'g', 's'])
+        self.assertEqual(obs.names[-4:], [None, 'e', 'g', 'f'])
+
+        # a state round trips
+        write_state(state, obs)
+        obs2, _ = read_state(state)
+        for attr in ('B', 'lengths', 'edges', 'bootstrap', 'ids', 'n_heavy',
+                     'heavy_sums', 'best', 'best_scores'):
+            np.testing.assert_equal(getattr(obs2, attr), getattr(obs, attr))
+        self.assertEqual(obs2.names, obs.names)
+        self.assertEqual(obs2.rank_names, obs.rank_names)
+        self.assertEqual((obs2.min_count, obs2.nameholders), (2, False))
+
+    def test_update_state_insertions_script(self):
+        # the tips are placed through the command line as well
+        paths = {}
+        for name, data in (('map', self.consensus_map.getvalue() +
+                            u"g\td__A; p__B; c__C; o__D; f__G; g__H; s__H z\n"
+                            u"h\td__A; p__B; c__C; o__D; f__E; g__F; s__F y\n"),
+                           ('tree', self.tree.getvalue()),
+                           ('full_tree', u"(((a,b),(c,h))95,(d,(e,g)),f);"),
+                           ('insertions', u"g\te\nh\tc\n")):
+            paths[name] = os.path.join(self.output_dir, name)
+            with open(paths[name], 'w') as fp:
+                fp.write(data)
+        state = os.path.join(self.output_dir, 'state.npz')
+
+        # run the script against this source tree
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(
+            [ROOT] + [p for p in [env.get('PYTHONPATH')] if p])
+
+        def t2t(*args):
+            subprocess.run([sys.executable, SCRIPT, 'decorate'] + list(args),
+                           check=True, capture_output=True, env=env)
+
+        t2t('-m', paths['map'], '-t', paths['tree'], '-o', self.output,
+            '--save-state', state)
+        t2t('-m', paths['map'], '--update-state', state, '--insertions',
+            paths['insertions'], '-o', self.output + '-updated')
+        t2t('-m', paths['map'], '-t', paths['full_tree'], '-o', self.output)
+
+        self.assertSameOutputs(self.output, self.output + '-updated')
+
+    def test_update_state_relabel(self):
+        state = os.path.join(self.output_dir, 'state.npz')
+        DecoratePipeline(self.consensus_map, tree=self.tree,
+                         save_state=state).run()
+
+        # c moves to s__F x and e to f__E
+        consensus_map = self.consensus_map.getvalue().replace(
+            u"c\td__A; p__B; c__C; o__D; f__E; g__F; s__F y",
+            u"c\td__A; p__B; c__C; o__D; f__E; g__F; s__F x").replace(
+            u"e\td__A; p__B; c__C; o__D; f__G; g__H; s__H z",
+            u"e\td__A; p__B; c__C; o__D; f__E; g__F; s__F y")
+
+        self._decorate(self.output, StringIO(consensus_map),
+                       tree=StringIO(self.tree.getvalue()))
+        self._decorate(self.output + '-updated', StringIO(consensus_map),
+                       update_state=state)
+
+        self.assertSameOutputs(self.output, self.output + '-updated')
+
+        with open(self.output + '-updated-changed-clades') as fp:
+            obs = fp.read()
+        self.assertEqual(obs, "#first tip\tlast tip\tbefore\tafter\n"
+                              "a\tf\to__D\tg__F\n"
+                              "a\tc\tg__F\ts__F x\n"
+                              "a\tb\ts__F x\t\n"
+                              "d\te\ts__H z\t\n")
+
+
+class DecorateBatchTests(PipelineOutputTests):
+    def setUp(self):
+        self.rank_order = RANK_ORDER[:]
+        self.output_dir = tempfile.mkdtemp()
+        self.output = os.path.join(self.output_dir, 'out')
+        self.consensus_maps = [
+            u"a\td__A; p__B; c__C; o__D; f__E; g__F; s__F x\n"
+            u"b\td__A; p__B; c__C; o__D; f__E; g__F; s__F x\n"
+            u"c\td__A; p__B; c__C; o__D; f__E; g__F; s__F y\n"
+            u"d\td__A; p__B; c__C; o__D; f__G; g__H; s__H z\n"
+            u"e\td__A; p__B; c__C; o__D; f__G; g__H; s__H z\n",
+            u"a\td__A; p__B; c__C; o__D; f__E; g__F; s__F x\n"
+            u"b\td__A; p__B; c__C; o__D; f__E; g__F; s__F x\n"
+            u"c\td__A; p__B; c__C; o__D; f__E; g__F; s__F x\n"
+            u"d\td__A; p__B; c__I; o__J; f__K; g__L; s__L w\n"
+            u"f\td__A; p__B; c__I; o__J; f__K; g__L; s__L w\n"]
+        self.tree = u"(((a,b),c)95,(d,e),f);"
+
+    def tearDown(self):
+        set_rank_order(self.rank_order)
+        shutil.rmtree(self.output_dir)
+
+    def test_init(self):
+        maps = [StringIO(m) for m in self.consensus_maps]
+        with self.assertRaises(ValueError):
+            DecorateBatch(maps)
+        with self.assertRaises(ValueError):
+            DecorateBatch([], tree=StringIO(self.tree))
+        with self.assertRaises(ValueError):
+            DecorateBatch(maps, tree=StringIO(self.tree), resume='foo.npz')
+        with self.assertRaises(ValueError):
+            DecorateBatch(maps, tree=StringIO(self.tree),
+                          save_state='foo.npz')
+
+    def _check_outputs(self, outputs, **kwargs):
+        for consensus_map, output in zip(self.consensus_maps, outputs):
+            self._decorate(self.output, StringIO(consensus_map),
+                           tree=StringIO(self.tree), **kwargs)
+            self.assertSameOutputs(self.output, output)
+
+    def test_run(self):
+        outputs = [self.output + '-1', self.output + '-2']
+        batch = DecorateBatch([StringIO(m) for m in self.consensus_maps],
+                              tree=StringIO(self.tree))
+        batch.run(outputs)
+        self._check_outputs(outputs)
+
+        report = batch.report()
+        self.assertEqual([s['name'] for s in report['stages']],
+                         ['load_tree', 'index_topology'])
+        self.assertEqual(len(report['maps']), 2)
+        self.assertEqual(report['maps'][0]['stages'][0]['name'],
+                         'load_consensus_map')
+
+        with self.assertRaises(ValueError):
+            batch.run(outputs[:1])
+
+    def test_run_jobs(self):
+        outputs = [self.output + '-1', self.output + '-2']
+        batch = DecorateBatch([StringIO(m) for m in self.consensus_maps],
+                              tree=StringIO(self.tree), add_nameholder=True,
+                              jobs=2, no_suffix=True)
+        batch.run(outputs)
+        self._check_outputs(outputs, add_nameholder=True, no_suffix=True)
+        self.assertEqual(len(batch.report()['maps']), 2)
+
+
+if __name__ == '__main__':
+    main()
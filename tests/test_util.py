@@ -1,11 +1,17 @@
 #!/usr/bin/env python
 
 from unittest import TestCase, main
-from t2t.util import reroot, unzip
+from t2t.util import (reroot, unzip, compile_tree, load_compiled_tree,
+                      parse_tree, read_tree, write_newick)
+from t2t.nlevel import TaxonLabel
 from skbio import TreeNode
 import bp
 
+import os
+import shutil
 import sys
+import tempfile
+from io import BytesIO
 
 if sys.version_info[0] == 2:
     from StringIO import StringIO
@@ -25,7 +31,18 @@ __status__ = "Development"
 class UtilTests(TestCase):
 
     def setUp(self):
-        pass
+        self.newick = "((a:1,b:2)c:3,'d e':4.5,f)r;"
+        self.output_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def assert_trees_equal(self, obs, exp):
+        self.assertEqual(list(obs.B), list(exp.B))
+        for i in range(len(exp.B)):
+            self.assertEqual(obs.name(i), exp.name(i))
+            self.assertEqual(obs.length(i), exp.length(i))
+            self.assertEqual(obs.edge(i), exp.edge(i))
 
     def test_reroot(self):
         """Should correctly reroot a tree"""
@@ -71,5 +88,73 @@ class UtilTests(TestCase):
         for u, l in zip(unzipped, lists):
             self.assertEqual(u, l)
 
+    def test_compile_tree(self):
+        """A compiled tree should load as the tree"""
+        exp = bp.parse_newick(self.newick)
+        path = os.path.join(self.output_dir, 'tree.t2ttre')
+        compile_tree(exp, path)
+        self.assert_trees_equal(load_compiled_tree(path), exp)
+        with open(path, 'rb') as fp:
+            self.assert_trees_equal(load_compiled_tree(fp.read()), exp)
+
+        with self.assertRaises(ValueError):
+            load_compiled_tree(b'(a,b);')
+        with self.assertRaises(ValueError):
+            compile_tree(bp.parse_newick("(a,'b\x00c');"), path)
+
+    def test_parse_tree(self):
+        """parse_tree should compile a tree into the cache on first use"""
+        exp = bp.parse_newick(self.newick)
+        self.assert_trees_equal(parse_tree(self.newick), exp)
+
+        cache = os.path.join(self.output_dir, 'cache')
+        self.assert_trees_equal(parse_tree(self.newick, cache), exp)
+        self.assertEqual(len(os.listdir(cache)), 1)
+        path = os.path.join(cache, os.listdir(cache)[0])
+        self.assert_trees_equal(load_compiled_tree(path), exp)
+
+        # the cached tree is used, rather than parsing again
+        compile_tree(bp.parse_newick("(x,y);"), path)
+        self.assertEqual(parse_tree(self.newick, cache).name(1), 'x')
+
+        parse_tree("(a,b);", cache)
+        self.assertEqual(len(os.listdir(cache)), 2)
+
+    def test_read_tree(self):
+        """read_tree should read newick or compiled trees"""
+        exp = bp.parse_newick(self.newick)
+        path = os.path.join(self.output_dir, 'tree.t2ttre')
+        compile_tree(exp, path)
+        with open(path, 'rb') as fp:
+            content = fp.read()
+
+        self.assert_trees_equal(read_tree(StringIO(self.newick)), exp)
+        self.assert_trees_equal(read_tree(BytesIO(self.newick.encode())),
+                                exp)
+        self.assert_trees_equal(read_tree(path), exp)
+        self.assert_trees_equal(read_tree(BytesIO(content)), exp)
+        with open(path, 'rb') as fp:
+            self.assert_trees_equal(read_tree(fp), exp)
+
+    def test_write_newick(self):
+        """write_newick should write trees as TreeNode.write does"""
+        t = TreeNode.read(StringIO(u"((a:1,(b)x)y:0,'q''s':1e-5,c)z;"))
+        t.find('c').name = 'c d'
+        t.find('b').name = "b's(;"
+        t.find('x').length = 3
+        t.find('y').support = 95
+        t.find('a').name = TaxonLabel(['g__x', 's__y'], 90)
+        t.find('x').name = TaxonLabel([], 55.5)
+
+        for chunk_size in (1, 2, 65536):
+            obs = StringIO()
+            write_newick(t, obs, chunk_size=chunk_size)
+            self.assertEqual(obs.getvalue(), str(t))
+
+        path = os.path.join(self.output_dir, 'tree.nwk')
+        write_newick(TreeNode(name='a'), path)
+        with open(path) as fp:
+            self.assertEqual(fp.read(), "a;\n")
+
 if __name__ == '__main__':
     main()